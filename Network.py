@@ -2,6 +2,12 @@ from lib import *
 from utils import *
 from torrent import Torrent
 from peer import Peer
+from diskio import DiskIOManager
+from piececache import PieceCache
+from timerwheel import TimerWheel
+from contentindex import ContentIndex
+from dht import DHTNode
+from lsd import LocalServiceDiscovery
 
 class Network:
     def __init__(self):
@@ -36,10 +42,46 @@ class Network:
         self.torrent_taken = set()
         self.peer_port = []
         self.peer_to_run = {}
+        self.allocation_modes = {}  # {torrent_path: allocation mode}
+        self.super_seed = set()  # Torrents whose initial seeder super-seeds
 
-    def update_torrent_and_run(self,torrent_paths,no_run_thread=False):
+        # One disk I/O subsystem shared by every peer of this process
+        self.disk_io = DiskIOManager()
+
+        # Read cache for hot pieces, shared by every torrent we seed
+        self.piece_cache = PieceCache(max_bytes=64 * 1024 * 1024)
+
+        # One timer thread drives keep-alives and timeouts of every connection
+        self.timer_wheel = TimerWheel()
+
+        # Data already on disk, so torrents sharing files don't fetch them again
+        self.content_index = ContentIndex()
+
+        # Optional DHT node shared by every torrent, see start_dht()
+        self.dht = None
+        self.dht_threads = []
+
+        # Optional multicast discovery of peers on the LAN, see start_lsd()
+        self.lsd = None
+
+    def update_torrent_and_run(self,torrent_paths,no_run_thread=False,allocation="sparse",super_seed=False):
+        """
+        Add torrents to the network and start their peers.
+
+        Args:
+            torrent_paths (list[str]): Paths of the .torrent files to add.
+            no_run_thread (bool): Run the P2P loop in the calling thread.
+            allocation (str): Storage allocation mode for these torrents
+                ("sparse", "full" or "none").
+            super_seed (bool): Complete torrents among these hand out their
+                pieces one at a time until the swarm holds a full copy.
+        """
         self.shared_files_directory = [torrent_path for torrent_path in torrent_paths if torrent_path not in self.torrent_taken]
         self.torrent_taken.update(self.shared_files_directory)
+        for torrent_path in self.shared_files_directory:
+            self.allocation_modes[torrent_path] = allocation
+            if super_seed:
+                self.super_seed.add(torrent_path)
         self.peer_to_run = {}
         self.num_peer = len(torrent_paths)
         for i in range(self.num_peer):
@@ -71,7 +113,8 @@ class Network:
 
             torrent = Torrent()
 
-            torrent.load_torrent(self.shared_files_directory[torrent_index])
+            torrent_path = self.shared_files_directory[torrent_index]
+            torrent.load_torrent(torrent_path)
 
             peer_ip, peer_port = peer_info["address"]
             peer_directory = peer_info["directory"]
@@ -86,8 +129,20 @@ class Network:
                 peer_ip,
                 peer_port,
                 peer_directory,
+                disk_io=self.disk_io,
+                piece_cache=self.piece_cache,
+                timer_wheel=self.timer_wheel,
+                allocation=self.allocation_modes.get(torrent_path, "sparse"),
+                super_seed=torrent_path in self.super_seed,
+                dht=self.dht,
+                lsd=self.lsd,
             )
 
+            # Copy or link what other torrents already have before asking the swarm
+            self.content_index.import_into(peer.piece_manager)
+            self.content_index.add_torrent(peer.piece_manager)
+            peer._update_is_seeder()
+
             self.peers.append(peer)
 
         for peer in self.peers:
@@ -99,6 +154,14 @@ class Network:
 
             self.connection_with_trackers.append(connection_with_tracker_thread)
 
+        if self.dht is not None:
+            for peer in self.peers:
+                if peer.dht is None:
+                    continue
+                dht_thread = threading.Thread(target=peer.discover_with_dht, daemon=True)
+                dht_thread.start()
+                self.dht_threads.append(dht_thread)
+
         for peer in self.peers:
             peer_server_thread = threading.Thread(target=peer.start_server)
             peer_server_thread.daemon = True
@@ -106,11 +169,63 @@ class Network:
 
             self.peer_servers.append(peer_server_thread)
 
+    def start_dht(self, ip="0.0.0.0", port=6881, bootstrap_nodes=()):
+        """
+        Run a DHT node, so torrents added afterwards find peers without the tracker.
+
+        The tracker is still announced to, but only as a hint: peers keep
+        being found through the DHT (and PEX) while it is down.
+
+        Args:
+            ip (str): Address to bind the UDP socket to.
+            port (int): UDP port of the node, 0 for any free one.
+            bootstrap_nodes (list[tuple]): (ip, port) of DHT nodes to join
+                through, e.g. other machines of the lab.
+
+        Returns:
+            DHTNode: The running node.
+        """
+        if self.dht is None:
+            self.dht = DHTNode(ip, port, bootstrap_nodes)
+            print(f"[INFO] DHT node listening on UDP {self.dht.ip}:{self.dht.port}")
+            nodes = self.dht.bootstrap()
+            print(f"[INFO] DHT bootstrapped with {nodes} nodes")
+        return self.dht
+
+    def start_lsd(self, interface_ip="0.0.0.0"):
+        """
+        Find peers on the local network by multicast, for torrents added afterwards.
+
+        Peers found this way are connected to within milliseconds and
+        before any peer from the tracker, the DHT or PEX.
+
+        Args:
+            interface_ip (str): Address of the LAN interface, e.g. the one
+                dhcp_setup.sh configures; "0.0.0.0" for the default one.
+
+        Returns:
+            LocalServiceDiscovery: The running service.
+        """
+        if self.lsd is None:
+            self.lsd = LocalServiceDiscovery(interface_ip)
+            print(f"[INFO] Local service discovery on {self.lsd.group}:{self.lsd.group_port}")
+        return self.lsd
+
+    def index_directory(self, directory):
+        """
+        Make the files of a directory available to torrents added afterwards.
+
+        Args:
+            directory (str): e.g. a folder holding an earlier download.
+        """
+        self.content_index.add_directory(directory)
+
     def run(self):
         def start_p2p_connections(peer):
             peer.start_clients()
-        # IMPORTANT: Wait for all peers to register with the tracker before starting P2P connections at least 5 seconds
-        time.sleep(5)
+        # IMPORTANT: Wait for all peers to register with the tracker before starting P2P connections
+        for peer in self.peers:
+            peer.registered.wait(timeout=5)
         print('self.peers:',self.peers)
         try:
             with ThreadPoolExecutor(max_workers=10) as executor:
@@ -146,3 +261,15 @@ class Network:
         for thread in self.connection_with_trackers:
             if thread.is_alive():
                 thread.join(timeout=1)
+
+        if self.lsd is not None:
+            self.lsd.shutdown()
+        if self.dht is not None:
+            self.dht.shutdown()
+        for thread in self.dht_threads:
+            if thread.is_alive():
+                thread.join(timeout=1)
+
+        # Flush pieces still queued for writing
+        self.disk_io.shutdown()
+        self.timer_wheel.shutdown()
@@ -0,0 +1,431 @@
+"""
+Reproducible benchmarks for the peer wire protocol, piece storage, peer-to-peer
+transfer and the tracker. Everything runs on loopback with generated data.
+
+Usage:
+    python benchmark.py                                # run every suite
+    python benchmark.py --suites protocol,storage      # run some suites
+    python benchmark.py --output bench.json            # save the JSON results
+    python benchmark.py --compare bench.json           # diff against a saved run
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import bencode
+from message import MessageFactory, MessageParser
+
+SUITES = ("protocol", "storage", "transfer", "tracker")
+
+
+def _ops_per_second(func, min_time=0.3, repeat=3):
+    """Run func in a loop for at least min_time seconds, best of `repeat` runs."""
+    best = 0.0
+    for _ in range(repeat):
+        count = 0
+        start = time.perf_counter()
+        elapsed = 0.0
+        while elapsed < min_time:
+            for _ in range(100):
+                func()
+            count += 100
+            elapsed = time.perf_counter() - start
+        best = max(best, count / elapsed)
+    return round(best, 1)
+
+
+def _percentile(samples, percent):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _make_torrent(root, name, total_size, piece_length, num_files, tracker_url, seed=0):
+    """
+    Generate a multi-file share under root/name and its .torrent file.
+
+    Returns:
+        str: Path to the generated .torrent file.
+    """
+    rng = random.Random(seed)
+    share_dir = os.path.join(root, name)
+    os.makedirs(share_dir, exist_ok=True)
+
+    # Split the total size over the files at random points
+    cuts = sorted(rng.randrange(1, total_size) for _ in range(num_files - 1))
+    sizes = [b - a for a, b in zip([0] + cuts, cuts + [total_size])]
+
+    files = []
+    hasher = hashlib.sha1()
+    pieces = []
+    filled = 0
+    for i, size in enumerate(sizes):
+        path = ["dir", f"file{i}.dat"] if i % 2 else [f"file{i}.dat"]
+        os.makedirs(os.path.join(share_dir, *path[:-1]), exist_ok=True)
+        data = rng.randbytes(size)
+        with open(os.path.join(share_dir, *path), "wb") as f:
+            f.write(data)
+        files.append({"length": size, "path": path})
+
+        # Hash pieces continuously across file boundaries
+        view = memoryview(data)
+        while view:
+            take = min(len(view), piece_length - filled)
+            hasher.update(view[:take])
+            view = view[take:]
+            filled += take
+            if filled == piece_length:
+                pieces.append(hasher.digest())
+                hasher = hashlib.sha1()
+                filled = 0
+    if filled:
+        pieces.append(hasher.digest())
+
+    torrent = {
+        "announce": tracker_url,
+        "info": {
+            "piece length": piece_length,
+            "name": name,
+            "files": files,
+            "pieces": b"".join(pieces),
+        },
+    }
+    torrent_path = os.path.join(root, f"{name}.torrent")
+    with open(torrent_path, "wb") as f:
+        f.write(bencode.encode(torrent))
+    return torrent_path
+
+
+class _TrackerServer:
+    """Run a Tracker on a loopback port in a background thread."""
+
+    def __init__(self, ip="127.0.0.1", port=0):
+        from werkzeug.serving import make_server
+        from tracker import Tracker
+
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        self.tracker = Tracker("bench", ip, port)
+        self.server = make_server(ip, port, self.tracker.register_routes(), threaded=True)
+        self.url = f"http://{ip}:{self.server.server_port}/"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+
+
+def bench_protocol(args):
+    """MessageFactory encode and MessageParser decode throughput."""
+    factory = MessageFactory()
+    parser = MessageParser()
+    info_hash = hashlib.sha1(b"bench").digest()
+    peer_id = b"-BENCH1000-12345678-"
+    block = os.urandom(16 * 1024)
+    bitfield = bytes(1024)
+
+    messages = {
+        "handshake": lambda: factory.handshake(info_hash, peer_id),
+        "have": lambda: factory.have(1234),
+        "request": lambda: factory.request(1234, 0, 16 * 1024),
+        "bitfield": lambda: factory.bitfield(bitfield),
+        "piece_16k": lambda: factory.piece(1234, 0, block),
+    }
+
+    results = {}
+    for name, encode in messages.items():
+        encoded = encode()
+        results[f"encode_{name}_ops"] = _ops_per_second(encode)
+        results[f"decode_{name}_ops"] = _ops_per_second(lambda: parser.parse_message(encoded))
+
+    # Metadata of a torrent with 100k pieces
+    metainfo = bencode.encode(
+        {
+            "announce": "http://127.0.0.1:8000/",
+            "info": {
+                "piece length": 16 * 1024,
+                "name": "bench",
+                "files": [{"length": 16 * 1024, "path": ["dir", f"file{i}.dat"]} for i in range(1000)],
+                "pieces": os.urandom(20 * 100_000),
+            },
+        }
+    )
+    results["decode_torrent_100k_pieces_ops"] = _ops_per_second(
+        lambda: bencode.decode(metainfo, {}, copy_limit=4096), min_time=0.1
+    )
+    return results
+
+
+def bench_storage(args):
+    """PieceManager get/save/verify throughput on a generated torrent."""
+    from diskio import DiskIOManager
+    from piecemanager import PieceManager
+    from piececache import PieceCache
+    from torrent import Torrent
+
+    root = tempfile.mkdtemp(prefix="bench_storage_")
+    try:
+        torrent_path = _make_torrent(
+            root, "share", args.size_mb * 1024 * 1024, args.piece_kb * 1024, args.files, "http://127.0.0.1:1/"
+        )
+        size_mb = args.size_mb
+        results = {}
+        torrent = Torrent()
+        torrent.load_torrent(torrent_path)
+        seeder = PieceManager(torrent, root)
+        total = seeder.get_total_pieces()
+
+        start = time.perf_counter()
+        pieces = [seeder.get_piece(i) for i in range(total)]
+        results["get_mb_s"] = round(size_mb / (time.perf_counter() - start), 2)
+
+        start = time.perf_counter()
+        verified = seeder.verify_all_pieces()
+        results["verify_mb_s"] = round(size_mb / (time.perf_counter() - start), 2)
+        results["verified_pieces"] = verified
+
+        cached = PieceManager(torrent, root, piece_cache=PieceCache(max_bytes=2 * args.size_mb * 1024 * 1024))
+        for i in range(total):
+            cached.get_piece(i)
+        start = time.perf_counter()
+        for i in range(total):
+            cached.get_piece(i)
+        results["get_cached_mb_s"] = round(size_mb / (time.perf_counter() - start), 2)
+
+        leech_dir = os.path.join(root, "leech_sync")
+        leecher = PieceManager(torrent, leech_dir)
+        start = time.perf_counter()
+        for i, data in enumerate(pieces):
+            leecher.save_piece(i, data)
+        results["save_sync_mb_s"] = round(size_mb / (time.perf_counter() - start), 2)
+
+        disk_io = DiskIOManager()
+        leech_dir = os.path.join(root, "leech_async")
+        leecher = PieceManager(torrent, leech_dir, disk_io=disk_io)
+        start = time.perf_counter()
+        for i, data in enumerate(pieces):
+            leecher.save_piece_async(i, data)
+        disk_io.wait_idle()
+        results["save_async_mb_s"] = round(size_mb / (time.perf_counter() - start), 2)
+        results["save_async_complete"] = sum(leecher.bitfield) == total
+
+        # Hash on receive: verified in memory, written once, never read back
+        leech_dir = os.path.join(root, "leech_receive")
+        leecher = PieceManager(torrent, leech_dir, disk_io=disk_io)
+        start = time.perf_counter()
+        for i, data in enumerate(pieces):
+            leecher.receive_block(i, 0, memoryview(data))
+        disk_io.wait_idle()
+        results["receive_verified_mb_s"] = round(size_mb / (time.perf_counter() - start), 2)
+        results["receive_verified_complete"] = sum(leecher.bitfield) == total
+        disk_io.shutdown()
+        return results
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_transfer(args):
+    """End-to-end transfer between N seeders and M leechers on loopback."""
+    from peer import Peer
+    from torrent import Torrent
+
+    root = tempfile.mkdtemp(prefix="bench_transfer_")
+    tracker = _TrackerServer()
+    peers = []
+    threads = []
+    try:
+        torrent_path = _make_torrent(
+            root, "share", args.transfer_mb * 1024 * 1024, args.piece_kb * 1024, args.files, tracker.url
+        )
+        torrent = Torrent()
+        torrent.load_torrent(torrent_path)
+
+        # Distinct loopback addresses, one per peer
+        for i in range(args.seeders + args.leechers):
+            is_seeder = i < args.seeders
+            peer_dir = root if is_seeder else os.path.join(root, f"leecher{i}")
+            peer = Peer(torrent, f"-BENCH1000-{i:08d}-", f"127.0.{i // 250}.{i % 250 + 2}", 7000 + i, peer_dir)
+            peers.append(peer)
+
+        start = time.perf_counter()
+        for peer in peers:
+            for target in (peer.register_with_tracker, lambda p=peer: p.start_server(timeout=1)):
+                thread = threading.Thread(target=target, daemon=True)
+                thread.start()
+                threads.append(thread)
+        leechers = peers[args.seeders :]
+        for peer in leechers:
+            thread = threading.Thread(target=peer.start_clients, daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        deadline = start + args.timeout
+        while time.perf_counter() < deadline:
+            if all(all(peer.piece_manager.bitfield) for peer in leechers):
+                break
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - start
+        complete = sum(1 for peer in leechers if all(peer.piece_manager.bitfield))
+
+        return {
+            "seeders": args.seeders,
+            "leechers": args.leechers,
+            "size_mb": args.transfer_mb,
+            "seconds": round(elapsed, 3),
+            "completed_leechers": complete,
+            "aggregate_mb_s": round(args.transfer_mb * complete / elapsed, 2),
+        }
+    finally:
+        for peer in peers:
+            peer.shutdown_event.set()
+            if peer.server_socket:
+                with contextlib.suppress(OSError):
+                    peer.server_socket.close()
+        tracker.close()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_tracker(args):
+    """Tracker announce throughput and latency with concurrent clients."""
+    tracker = _TrackerServer()
+    info_hash = hashlib.sha1(b"bench").hexdigest()
+    latencies = []
+    lock = threading.Lock()
+
+    def client(client_id):
+        session = requests.Session()
+        samples = []
+        for i in range(args.announces):
+            data = {
+                "info_hash": info_hash,
+                "peer_id": f"-BENCH1000-{client_id:08d}-",
+                "ip": "127.0.0.1",
+                "port": 7000 + client_id,
+                "downloaded": i,
+                "uploaded": 0,
+                "is_seeder": False,
+            }
+            start = time.perf_counter()
+            response = session.get(tracker.url + "announce", json=data)
+            samples.append(time.perf_counter() - start)
+            response.raise_for_status()
+        with lock:
+            latencies.extend(samples)
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.clients) as executor:
+            for future in [executor.submit(client, i) for i in range(args.clients)]:
+                future.result()
+        elapsed = time.perf_counter() - start
+        return {
+            "clients": args.clients,
+            "announces": len(latencies),
+            "qps": round(len(latencies) / elapsed, 1),
+            "p50_ms": round(_percentile(latencies, 50) * 1000, 3),
+            "p99_ms": round(_percentile(latencies, 99) * 1000, 3),
+        }
+    finally:
+        tracker.close()
+
+
+def _metadata():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": int(time.time()),
+    }
+
+
+def compare(old, new):
+    """Print the relative change of every numeric metric between two runs."""
+    for suite, metrics in new["results"].items():
+        for name, value in metrics.items():
+            previous = old.get("results", {}).get(suite, {}).get(name)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if isinstance(previous, (int, float)) and previous:
+                change = (value - previous) / previous * 100
+                print(f"{suite}.{name}: {previous} -> {value} ({change:+.1f}%)")
+            else:
+                print(f"{suite}.{name}: {value}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--suites", default=",".join(SUITES), help="comma separated suites to run")
+    parser.add_argument("--output", help="write the JSON results to this file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    parser.add_argument("--size-mb", type=int, default=32, help="storage benchmark size")
+    parser.add_argument("--transfer-mb", type=int, default=8, help="transfer benchmark size")
+    parser.add_argument("--piece-kb", type=int, default=512, help="piece length in KiB")
+    parser.add_argument("--files", type=int, default=8, help="number of files in generated torrents")
+    parser.add_argument("--seeders", type=int, default=1)
+    parser.add_argument("--leechers", type=int, default=2)
+    parser.add_argument("--timeout", type=float, default=120, help="transfer benchmark timeout in seconds")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent tracker clients")
+    parser.add_argument("--announces", type=int, default=200, help="announces per tracker client")
+    parser.add_argument("--verbose", action="store_true", help="keep the log output of the code under test")
+    args = parser.parse_args(argv)
+
+    suites = [suite.strip() for suite in args.suites.split(",") if suite.strip()]
+    for suite in suites:
+        if suite not in SUITES:
+            parser.error(f"unknown suite {suite}, choose from {', '.join(SUITES)}")
+
+    runners = {
+        "protocol": bench_protocol,
+        "storage": bench_storage,
+        "transfer": bench_transfer,
+        "tracker": bench_tracker,
+    }
+    report = {"meta": _metadata(), "results": {}}
+
+    # The code under test prints from background threads, some of which outlive
+    # their suite; keep that away from the JSON report unless asked for
+    stdout = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+    for suite in suites:
+        print(f"[INFO] Running {suite} benchmark...", file=sys.stderr)
+        report["results"][suite] = runners[suite](args)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output, file=stdout)
+
+    if args.compare:
+        with open(args.compare) as f:
+            with contextlib.redirect_stdout(stdout):
+                compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+class BencodeError(ValueError):
+    """Raised when data is not valid bencode."""
+
+
+# Lists and dictionaries nested deeper than this are rejected; untrusted
+# input (DHT datagrams, pex messages) could otherwise exhaust the stack
+MAX_DEPTH = 64
+
+
+def decode(data, spans=None, copy_limit=None, max_depth=MAX_DEPTH):
+    """
+    Decode bencoded data.
+
+    Byte strings are returned as bytes and dictionary keys as bytes, like
+    bencodepy. Strings longer than `copy_limit` are returned as memoryview
+    slices of `data` instead, so large values such as the "pieces" string of a
+    torrent are never copied.
+
+    When `spans` is given, it is filled with the (start, end) byte offsets of
+    the encoded value of every dictionary key reachable through dictionaries
+    only, keyed by the path of keys, e.g. spans[(b"info",)] for the info
+    dictionary and spans[(b"info", b"pieces")] for its pieces string. The
+    exact info dictionary can then be hashed without re-encoding it.
+
+    Args:
+        data (bytes): The bencoded data.
+        spans (dict): Optional dict receiving {key path: (start, end)}.
+        copy_limit (int): Strings longer than this are returned as memoryview.
+        max_depth (int): Deepest nesting of lists and dictionaries accepted.
+
+    Returns:
+        The decoded value.
+    """
+    data = bytes(data)
+    decoder = _Decoder(data, spans, copy_limit, max_depth)
+    try:
+        value, end = decoder.decode(0, (), 0)
+    except (IndexError, ValueError) as e:
+        if isinstance(e, BencodeError):
+            raise
+        raise BencodeError(f"Invalid bencode data: {e}") from e
+    if end != len(data):
+        raise BencodeError(f"Trailing data after position {end}")
+    return value
+
+
+class _Decoder:
+    __slots__ = ("data", "view", "spans", "copy_limit", "max_depth")
+
+    def __init__(self, data, spans, copy_limit, max_depth):
+        self.data = data
+        self.view = memoryview(data)
+        self.spans = spans
+        self.copy_limit = copy_limit
+        self.max_depth = max_depth
+
+    def decode(self, pos, path, depth):
+        """Decode the value starting at `pos`, returning (value, end position).
+
+        `path` is the key path of the value, or None inside a list. `depth`
+        counts the lists and dictionaries around it.
+        """
+        data = self.data
+        kind = data[pos]
+
+        # String: <length>:<bytes>
+        if 0x30 <= kind <= 0x39:
+            colon = data.index(b":", pos)
+            start = colon + 1
+            end = start + int(data[pos:colon])
+            if end > len(data):
+                raise BencodeError(f"String at position {pos} runs past the end of the data")
+            if self.copy_limit is not None and end - start > self.copy_limit:
+                return self.view[start:end], end
+            return data[start:end], end
+
+        # Integer: i<digits>e
+        if kind == 0x69:
+            end = data.index(b"e", pos)
+            return int(data[pos + 1 : end]), end + 1
+
+        if kind in (0x6C, 0x64) and depth >= self.max_depth:
+            raise BencodeError(f"Nesting deeper than {self.max_depth} at position {pos}")
+
+        # List: l<values>e
+        if kind == 0x6C:
+            pos += 1
+            items = []
+            while data[pos] != 0x65:
+                item, pos = self.decode(pos, None, depth + 1)
+                items.append(item)
+            return items, pos + 1
+
+        # Dictionary: d<key><value>...e
+        if kind == 0x64:
+            pos += 1
+            result = {}
+            while data[pos] != 0x65:
+                if not 0x30 <= data[pos] <= 0x39:
+                    raise BencodeError(f"Dictionary key at position {pos} is not a string")
+                colon = data.index(b":", pos)
+                key_end = colon + 1 + int(data[pos:colon])
+                key = data[colon + 1 : key_end]
+
+                start = key_end
+                key_path = path + (key,) if path is not None and self.spans is not None else None
+                result[key], pos = self.decode(start, key_path, depth + 1)
+                if key_path is not None:
+                    self.spans[key_path] = (start, pos)
+            return result, pos + 1
+
+        raise BencodeError(f"Unexpected byte {chr(kind)!r} at position {pos}")
+
+
+def encode(value):
+    """
+    Encode a value as bencode.
+
+    Supports int, bytes-like objects, str (UTF-8), list/tuple and dict with
+    bytes or str keys. Like bencodepy, dictionary keys keep their insertion
+    order, so decoding and re-encoding an existing .torrent file is lossless.
+    """
+    parts = []
+    _encode(value, parts.append)
+    return b"".join(parts)
+
+
+def _encode(value, write):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        write(b"%d:" % len(value))
+        write(value)
+    elif isinstance(value, str):
+        value = value.encode()
+        write(b"%d:" % len(value))
+        write(value)
+    elif isinstance(value, int):
+        write(b"i%de" % value)
+    elif isinstance(value, (list, tuple)):
+        write(b"l")
+        for item in value:
+            _encode(item, write)
+        write(b"e")
+    elif isinstance(value, dict):
+        write(b"d")
+        for key, item in value.items():
+            if isinstance(key, str):
+                key = key.encode()
+            write(b"%d:" % len(key))
+            write(key)
+            _encode(item, write)
+        write(b"e")
+    else:
+        raise BencodeError(f"Cannot encode value of type {type(value).__name__}")
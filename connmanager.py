@@ -0,0 +1,301 @@
+import threading
+import time
+
+
+class PeerConnection:
+    """State of the outbound link to one known peer."""
+
+    NEW = "new"
+    CONNECTING = "connecting"
+    CONNECTED = "connected"
+    DISCONNECTED = "disconnected"
+    FAILED = "failed"
+    BANNED = "banned"
+
+    __slots__ = ("ip", "port", "peer_id", "state", "failures", "retry_at", "connected_at", "local")
+
+    def __init__(self, ip, port, peer_id):
+        self.ip = ip
+        self.port = port
+        self.peer_id = peer_id
+        self.state = PeerConnection.NEW
+        self.failures = 0  # Consecutive failed attempts
+        self.retry_at = 0.0  # monotonic time of the next allowed attempt
+        self.connected_at = None
+        self.local = False  # Found on our own network, see add_candidates()
+
+    @property
+    def key(self):
+        return (self.ip, self.port, self.peer_id)
+
+
+class ConnectionManager:
+    def __init__(self, own_peer_id, max_connections=30, base_backoff=1.0, max_backoff=60.0):
+        """
+        Tracks peer connections of one torrent.
+
+        Known peers are keyed by (ip, port, peer_id), so several peers behind
+        one IP are distinct, and a peer that disconnects is retried after an
+        exponential backoff instead of being forgotten. At most one outbound
+        and one inbound link are kept per peer_id; links in this protocol are
+        one-directional (the connecting side downloads), so an inbound and an
+        outbound link to the same peer are not duplicates of each other.
+        Misbehaving peers can be throttled, which delays reconnects, or
+        banned, which also refuses their inbound links. Candidates from the
+        tracker, the DHT, peer exchange and local discovery end up in the
+        same table; peers on the local network are connected to first.
+
+        Args:
+            own_peer_id (str): Our peer ID, never connected to.
+            max_connections (int): Limit on inbound plus outbound links.
+            base_backoff (float): Delay before the first retry, in seconds.
+            max_backoff (float): Upper bound of the retry delay, in seconds.
+        """
+        self.own_peer_id = own_peer_id
+        self.max_connections = max_connections
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+        self.peers = {}  # {(ip, port, peer_id): PeerConnection}
+        self.inbound = {}  # {peer_id: addr}
+        self.inbound_ids = {}  # {addr: peer_id}, the reverse of inbound
+        self.banned = set()  # peer_ids never connected to or accepted again
+        self.penalties = {}  # {peer_id: monotonic time}, throttled until then
+        self.lock = threading.Lock()
+
+        self.attempts = 0
+        self.failures = 0
+        self.rejected_inbound = 0
+        self.bans = 0
+        self.throttles = 0
+        self.discovered = {}  # {source: peers first learned from it}
+
+    def add_candidates(self, peers, source="tracker", local=False):
+        """
+        Learn about peers, e.g. from a tracker response or peer exchange.
+
+        Args:
+            peers (list[dict]): Each with "ip", "port" and "peer_id".
+            source (str): Where the peers come from, for the statistics.
+            local (bool): The peers are on our own network, e.g. found by
+                local service discovery; also marks peers already known.
+
+        Returns:
+            int: Number of peers that were not known yet.
+        """
+        added = 0
+        with self.lock:
+            for peer in peers:
+                peer_id = peer.get("peer_id")
+                if peer_id == self.own_peer_id:
+                    continue
+                key = (peer.get("ip"), peer.get("port"), peer_id)
+                if key not in self.peers:
+                    self.peers[key] = PeerConnection(*key)
+                    if peer_id in self.banned:
+                        self.peers[key].state = PeerConnection.BANNED
+                    added += 1
+                if local:
+                    self.peers[key].local = True
+            if added:
+                self.discovered[source] = self.discovered.get(source, 0) + added
+        return added
+
+    def has_candidates(self):
+        """Check whether any peer is known, from whatever source."""
+        with self.lock:
+            return bool(self.peers)
+
+    def _active(self):
+        outbound = sum(
+            1
+            for peer in self.peers.values()
+            if peer.state in (PeerConnection.CONNECTING, PeerConnection.CONNECTED)
+        )
+        return outbound + len(self.inbound)
+
+    def next_to_connect(self):
+        """
+        Pick the peers to connect to now and mark them as connecting.
+
+        Returns:
+            list[tuple]: (ip, port, peer_id) keys, within the free connection slots.
+        """
+        now = time.monotonic()
+        with self.lock:
+            slots = self.max_connections - self._active()
+            busy_ids = {
+                peer.peer_id
+                for peer in self.peers.values()
+                if peer.state in (PeerConnection.CONNECTING, PeerConnection.CONNECTED)
+            }
+            chosen = []
+            # Local peers first: lower latency and more bandwidth
+            for peer in sorted(self.peers.values(), key=lambda peer: not peer.local):
+                if slots <= 0:
+                    break
+                if peer.state in (PeerConnection.CONNECTING, PeerConnection.CONNECTED, PeerConnection.BANNED):
+                    continue
+                if self._retry_at(peer) > now or peer.peer_id in busy_ids:
+                    continue
+                peer.state = PeerConnection.CONNECTING
+                busy_ids.add(peer.peer_id)
+                chosen.append(peer.key)
+                slots -= 1
+            self.attempts += len(chosen)
+            return chosen
+
+    def connected_local(self):
+        """Get the (ip, port) of the local peers we are connected to, as download links key them."""
+        with self.lock:
+            return {
+                (peer.ip, peer.port)
+                for peer in self.peers.values()
+                if peer.local and peer.state == PeerConnection.CONNECTED
+            }
+
+    def next_retry_in(self):
+        """
+        Seconds until the earliest backed-off peer may be retried, or None.
+
+        None also when next_to_connect() could not pick anyone even then: no
+        slot is free, or every waiting peer's ID already has a link. A closing
+        link frees both, and its owner wakes the caller.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if self.max_connections - self._active() <= 0:
+                return None
+            busy_ids = {
+                peer.peer_id
+                for peer in self.peers.values()
+                if peer.state in (PeerConnection.CONNECTING, PeerConnection.CONNECTED)
+            }
+            waits = [
+                max(0.0, self._retry_at(peer) - now)
+                for peer in self.peers.values()
+                if peer.state
+                not in (PeerConnection.CONNECTING, PeerConnection.CONNECTED, PeerConnection.BANNED)
+                and peer.peer_id not in busy_ids
+            ]
+        return min(waits) if waits else None
+
+    def _retry_at(self, peer):
+        return max(peer.retry_at, self.penalties.get(peer.peer_id, 0.0))
+
+    def connected(self, key):
+        """The TCP connection to a peer is up."""
+        with self.lock:
+            peer = self.peers.get(key)
+            if peer is not None:
+                peer.state = PeerConnection.CONNECTED
+                peer.connected_at = time.monotonic()
+
+    def disconnected(self, key, clean=True):
+        """
+        The link to a peer ended.
+
+        Args:
+            key (tuple): (ip, port, peer_id) of the peer.
+            clean (bool): False if the session failed, which backs off retries.
+        """
+        with self.lock:
+            peer = self.peers.get(key)
+            if peer is None or peer.state == PeerConnection.BANNED:
+                return
+            if clean:
+                peer.state = PeerConnection.DISCONNECTED
+                peer.failures = 0
+                peer.retry_at = time.monotonic() + self.base_backoff
+            else:
+                self._fail(peer)
+
+    def _fail(self, peer):
+        peer.state = PeerConnection.FAILED
+        peer.failures += 1
+        delay = min(self.base_backoff * 2 ** (peer.failures - 1), self.max_backoff)
+        peer.retry_at = time.monotonic() + delay
+        self.failures += 1
+
+    def accept_inbound(self, peer_id, addr):
+        """
+        Register an inbound link after its handshake.
+
+        Returns:
+            bool: False if the peer already has an inbound link or no slot is free.
+        """
+        with self.lock:
+            if (
+                peer_id in self.inbound
+                or peer_id in self.banned
+                or self._active() >= self.max_connections
+            ):
+                self.rejected_inbound += 1
+                return False
+            self.inbound[peer_id] = addr
+            self.inbound_ids[addr] = peer_id
+            return True
+
+    def inbound_peer_id(self, addr):
+        """Get the peer ID of the inbound link from an address, or None."""
+        with self.lock:
+            return self.inbound_ids.get(addr)
+
+    def release_inbound(self, peer_id, addr):
+        """Forget an inbound link."""
+        with self.lock:
+            if self.inbound.get(peer_id) == addr:
+                del self.inbound[peer_id]
+                del self.inbound_ids[addr]
+
+    def ban(self, peer_id):
+        """
+        Stop talking to a peer for good, e.g. one that sent corrupt data.
+
+        Open links are not closed here; their owners check is_banned().
+        """
+        with self.lock:
+            if peer_id in self.banned:
+                return
+            self.banned.add(peer_id)
+            self.penalties.pop(peer_id, None)
+            for peer in self.peers.values():
+                if peer.peer_id == peer_id:
+                    peer.state = PeerConnection.BANNED
+            self.bans += 1
+
+    def throttle(self, peer_id, delay):
+        """Don't connect to a peer again for `delay` seconds."""
+        with self.lock:
+            if peer_id in self.banned:
+                return
+            until = time.monotonic() + delay
+            self.penalties[peer_id] = max(self.penalties.get(peer_id, 0.0), until)
+            self.throttles += 1
+
+    def is_banned(self, peer_id):
+        """Check whether a peer is banned."""
+        with self.lock:
+            return peer_id in self.banned
+
+    def get_stats(self):
+        """Get connection metrics."""
+        with self.lock:
+            states = {}
+            for peer in self.peers.values():
+                states[peer.state] = states.get(peer.state, 0) + 1
+            return {
+                "known_peers": len(self.peers),
+                "local_peers": sum(1 for peer in self.peers.values() if peer.local),
+                "states": states,
+                "inbound": len(self.inbound),
+                "active": self._active(),
+                "max_connections": self.max_connections,
+                "attempts": self.attempts,
+                "failures": self.failures,
+                "rejected_inbound": self.rejected_inbound,
+                "banned": len(self.banned),
+                "bans": self.bans,
+                "throttles": self.throttles,
+                "discovered": dict(self.discovered),
+            }
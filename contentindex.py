@@ -0,0 +1,258 @@
+import hashlib
+import os
+import shutil
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# ioctl number of FICLONE on Linux: share all extents of a file (copy-on-write)
+FICLONE = 0x40049409
+
+
+class ContentIndex:
+    def __init__(self):
+        """
+        Local index of content that is already on disk, shared by every torrent of a Network.
+
+        Pieces are keyed by their SHA-1 digest, files by size (their SHA-1 is
+        computed on demand and cached). When a torrent is added,
+        import_into() fills it from this data instead of the swarm:
+
+        1. Every wanted file none of whose pieces is verified yet is matched
+           against indexed files of the same size, by checking the pieces of
+           the new torrent that lie wholly inside the file; at least one must
+           match. Candidates with the same (size, SHA-1) are checked once. A
+           match is placed with a hardlink if those pieces cover the whole
+           file, which proves the content identical, and otherwise with a
+           reflink or a plain copy, which never touch the source. The pieces
+           over the file are then verified as usual.
+        2. Every piece still missing is looked up by digest among the
+           verified pieces of the other torrents, read, re-hashed and written.
+
+        Sources are checked live, so only verified pieces and fully verified
+        files of registered torrents are ever used.
+        """
+        self.pieces = {}  # {digest: [(piece_manager, index)]}
+        self.files = {}  # {size: [(path, piece_manager or None, file_number)]}
+        self.file_hashes = {}  # {path: (mtime_ns, size, sha1)}
+        self.lock = threading.Lock()
+
+        self.files_linked = 0
+        self.files_reflinked = 0
+        self.files_copied = 0
+        self.pieces_imported = 0
+        self.bytes_imported = 0
+
+    def add_torrent(self, piece_manager):
+        """Index the pieces and files of a torrent; only verified ones are ever used."""
+        with self.lock:
+            for index in range(piece_manager.total_pieces):
+                self.pieces.setdefault(piece_manager.piece_hashes[index], []).append((piece_manager, index))
+            for file_number, file_data in enumerate(piece_manager.files):
+                if file_data["length"] and file_data["path"] not in piece_manager.partfile_paths:
+                    entry = (file_data["path"], piece_manager, file_number)
+                    self.files.setdefault(file_data["length"], []).append(entry)
+
+    def add_directory(self, directory):
+        """Index every file under a directory, e.g. an old download folder."""
+        with self.lock:
+            for cur_dir, _, names in os.walk(directory):
+                for name in names:
+                    path = os.path.join(cur_dir, name)
+                    try:
+                        size = os.path.getsize(path)
+                    except OSError:
+                        continue
+                    if size:
+                        self.files.setdefault(size, []).append((path, None, None))
+
+    def file_hash(self, path):
+        """Get the SHA-1 of a file, cached until the file changes."""
+        stat = os.stat(path)
+        cached = self.file_hashes.get(path)
+        if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+        digest = hashlib.sha1()
+        with open(path, "rb", buffering=0) as file:
+            buffer = bytearray(1024 * 1024)
+            view = memoryview(buffer)
+            while True:
+                count = file.readinto(buffer)
+                if not count:
+                    break
+                digest.update(view[:count])
+        self.file_hashes[path] = (stat.st_mtime_ns, stat.st_size, digest.digest())
+        return self.file_hashes[path][2]
+
+    def import_into(self, piece_manager):
+        """
+        Complete a torrent from local data as far as possible.
+
+        Returns:
+            int: Number of pieces that became complete.
+        """
+        before = sum(piece_manager.bitfield)
+        placed = []
+        for file_number, file_data in enumerate(piece_manager.files):
+            if file_data["path"] in piece_manager.partfile_paths or not file_data["length"]:
+                continue
+            # Placing a file rewrites the edges of the pieces it shares with its
+            # neighbours, so it must not touch any verified piece
+            if any(piece_manager.bitfield[i] == 1 for i in piece_manager.file_index.file_pieces(file_number)):
+                continue
+            if self._import_file(piece_manager, file_number):
+                placed.append(file_number)
+
+        # The placed bytes count once the pieces over them verify
+        for file_number in placed:
+            for index in piece_manager.file_index.file_pieces(file_number):
+                if piece_manager.bitfield[index] == 0:
+                    piece_manager.verify_piece(index)
+
+        for index in range(piece_manager.total_pieces):
+            if piece_manager.bitfield[index] == 0 and piece_manager.is_wanted(index):
+                self._import_piece(piece_manager, index)
+
+        imported = sum(piece_manager.bitfield) - before
+        if imported:
+            print(f"[INFO] ContentIndex completed {imported} pieces of {piece_manager.torrent_file.name} locally")
+        return imported
+
+    def _file_usable(self, path, piece_manager, file_number):
+        """A file of a torrent is only a source once all its pieces are verified."""
+        if piece_manager is None:
+            return os.path.exists(path)
+        return all(piece_manager.bitfield[i] == 1 for i in piece_manager.file_index.file_pieces(file_number))
+
+    def _import_file(self, piece_manager, file_number):
+        file_index = piece_manager.file_index
+        path = file_index.paths[file_number]
+        size = file_index.lengths[file_number]
+        with self.lock:
+            candidates = [c for c in self.files.get(size, []) if c[0] != path]
+
+        candidates = [c for c in candidates if self._file_usable(*c)]
+        checked = set()  # (size, SHA-1) of contents already tried
+        for source, source_manager, source_number in candidates:
+            try:
+                if len(candidates) > 1:
+                    # Copies of one file need checking once
+                    content = (size, self.file_hash(source))
+                    if content in checked:
+                        continue
+                    checked.add(content)
+                matched, proven = self._match_file(piece_manager, file_number, source)
+                if matched:
+                    self._place(piece_manager, source, path, proven)
+                    return True
+            except OSError as e:
+                print(f"[WARNING] ContentIndex could not use {source} for {path}: {e}")
+        return False
+
+    def _match_file(self, piece_manager, file_number, source):
+        """
+        Check a candidate file against the pieces lying wholly inside the target file.
+
+        Returns:
+            tuple: (matched, proven). `matched` needs at least one such piece,
+            all of them matching; `proven` means they cover every byte, so the
+            files are identical.
+        """
+        file_index = piece_manager.file_index
+        piece_length = file_index.piece_length
+        start = file_index.offsets[file_number]
+        end = start + file_index.lengths[file_number]
+
+        first = -(-start // piece_length)
+        covered_from = covered_to = None
+        with open(source, "rb") as file:
+            index = first
+            while index < piece_manager.total_pieces:
+                piece_start = index * piece_length
+                piece_end = piece_start + file_index.piece_size(index)
+                if piece_end > end:
+                    break
+                file.seek(piece_start - start)
+                data = file.read(piece_end - piece_start)
+                if not piece_manager.piece_hashes.matches(index, hashlib.sha1(data).digest()):
+                    return False, False
+                if covered_from is None:
+                    covered_from = piece_start
+                covered_to = piece_end
+                index += 1
+        if covered_from is None:
+            return False, False  # No whole piece inside: nothing proves a match
+        return True, covered_from == start and covered_to == end
+
+    def _place(self, piece_manager, source, path, proven):
+        """Put the content of `source` at `path`: hardlink if proven identical, else reflink, else copy."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = os.path.getsize(source)
+
+        if proven:
+            temp = f"{path}.link"
+            try:
+                os.link(source, temp)
+                os.replace(temp, path)
+                with self.lock:
+                    self.files_linked += 1
+                print(f"[INFO] ContentIndex hardlinked {source} -> {path}")
+                return
+            except OSError:
+                if os.path.exists(temp):
+                    os.remove(temp)
+
+        piece_manager.prepare_file(path)
+        if fcntl is not None:
+            try:
+                with open(source, "rb") as src, open(path, "r+b") as dst:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                with self.lock:
+                    self.files_reflinked += 1
+                print(f"[INFO] ContentIndex reflinked {source} -> {path}")
+                return
+            except OSError:
+                pass  # Not supported by the file system, or across devices
+
+        with open(source, "rb") as src, open(path, "r+b") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+            dst.truncate(size)
+        with self.lock:
+            self.files_copied += 1
+            self.bytes_imported += size
+        print(f"[INFO] ContentIndex copied {source} -> {path}")
+
+    def _import_piece(self, piece_manager, index):
+        digest = piece_manager.piece_hashes[index]
+        with self.lock:
+            sources = list(self.pieces.get(digest, []))
+        for source_manager, source_index in sources:
+            if (source_manager, source_index) == (piece_manager, index):
+                continue
+            if source_manager.bitfield[source_index] != 1:
+                continue
+            data = source_manager.get_piece(source_index)
+            # Re-hash: the source may have changed on disk since it was verified
+            if data and piece_manager.piece_hashes.matches(index, hashlib.sha1(data).digest()):
+                piece_manager.save_piece(index, data, verified=True)
+                with self.lock:
+                    self.pieces_imported += 1
+                    self.bytes_imported += len(data)
+                return True
+        return False
+
+    def get_stats(self):
+        """Get deduplication metrics."""
+        with self.lock:
+            return {
+                "indexed_pieces": sum(len(sources) for sources in self.pieces.values()),
+                "indexed_files": sum(len(files) for files in self.files.values()),
+                "files_linked": self.files_linked,
+                "files_reflinked": self.files_reflinked,
+                "files_copied": self.files_copied,
+                "pieces_imported": self.pieces_imported,
+                "bytes_imported": self.bytes_imported,
+            }
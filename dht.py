@@ -0,0 +1,527 @@
+import hashlib
+import os
+import socket
+import struct
+import threading
+import time
+
+import bencode
+from pex import decode_peers, encode_peers
+
+K = 8  # Nodes per bucket and results per lookup
+ALPHA = 3  # Parallel queries of a lookup
+ID_SIZE = 20
+
+# Compact node entry: node ID, IPv4 address, port
+_NODE = struct.Struct("!20s4sH")
+
+
+def distance(a, b):
+    """XOR distance of two node IDs, as an int."""
+    return int.from_bytes(a, "big") ^ int.from_bytes(b, "big")
+
+
+def encode_nodes(nodes):
+    """Pack nodes into 26-byte compact entries."""
+    entries = []
+    for node in nodes:
+        try:
+            entries.append(_NODE.pack(node.id, socket.inet_aton(node.ip), node.port))
+        except (OSError, struct.error):
+            continue
+    return b"".join(entries)
+
+
+def decode_nodes(data):
+    """Unpack compact nodes, see encode_nodes()."""
+    nodes = []
+    for offset in range(0, len(data) - len(data) % _NODE.size, _NODE.size):
+        node_id, ip, port = _NODE.unpack_from(data, offset)
+        if port:
+            nodes.append(NodeInfo(node_id, socket.inet_ntoa(ip), port))
+    return nodes
+
+
+class NodeInfo:
+    """A DHT node known to the routing table."""
+
+    __slots__ = ("id", "ip", "port", "last_seen", "failures")
+
+    def __init__(self, node_id, ip, port):
+        self.id = node_id
+        self.ip = ip
+        self.port = port
+        self.last_seen = 0.0
+        self.failures = 0  # Queries in a row that timed out
+
+    @property
+    def address(self):
+        return (self.ip, self.port)
+
+
+class RoutingTable:
+    def __init__(self, own_id, k=K, max_failures=2):
+        """
+        Kademlia routing table: one bucket of at most `k` nodes per distance bit.
+
+        Bucket i holds the nodes whose XOR distance to us has its highest set
+        bit at position i, so there is room for many close nodes and few far
+        ones. A full bucket keeps its long-lived nodes; a new node only takes
+        the place of one that stopped answering.
+
+        Args:
+            own_id (bytes): Our node ID.
+            k (int): Bucket size.
+            max_failures (int): Timeouts after which a node may be replaced.
+        """
+        self.own_id = own_id
+        self.k = k
+        self.max_failures = max_failures
+        self.buckets = [[] for _ in range(ID_SIZE * 8)]
+        self.lock = threading.Lock()
+
+    def _bucket(self, node_id):
+        return self.buckets[distance(self.own_id, node_id).bit_length() - 1]
+
+    def update(self, node_id, ip, port):
+        """
+        A node was heard from: add it or mark it as recently seen.
+
+        Returns:
+            bool: True if the node is in the table afterwards.
+        """
+        if node_id == self.own_id or len(node_id) != ID_SIZE:
+            return False
+        with self.lock:
+            bucket = self._bucket(node_id)
+            for node in bucket:
+                if node.id == node_id:
+                    node.ip, node.port = ip, port
+                    node.last_seen = time.monotonic()
+                    node.failures = 0
+                    # Most recently seen last
+                    bucket.remove(node)
+                    bucket.append(node)
+                    return True
+
+            node = NodeInfo(node_id, ip, port)
+            node.last_seen = time.monotonic()
+            if len(bucket) < self.k:
+                bucket.append(node)
+                return True
+            stale = max(bucket, key=lambda n: n.failures)
+            if stale.failures >= self.max_failures:
+                bucket.remove(stale)
+                bucket.append(node)
+                return True
+            return False
+
+    def failed(self, node_id):
+        """A query to a node timed out."""
+        with self.lock:
+            for node in self._bucket(node_id):
+                if node.id == node_id:
+                    node.failures += 1
+                    return
+
+    def closest(self, target, count=None):
+        """Get the known nodes closest to a target ID, closest first."""
+        with self.lock:
+            nodes = [node for bucket in self.buckets for node in bucket]
+        nodes.sort(key=lambda node: distance(node.id, target))
+        return nodes[: count or self.k]
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(bucket) for bucket in self.buckets)
+
+
+class _PendingQuery:
+    __slots__ = ("node_id", "event", "response", "sent")
+
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.event = threading.Event()
+        self.response = None
+        self.sent = time.monotonic()
+
+
+class DHTNode:
+    def __init__(
+        self,
+        ip="0.0.0.0",
+        port=0,
+        bootstrap_nodes=(),
+        node_id=None,
+        k=K,
+        alpha=ALPHA,
+        timeout=1.0,
+        peer_ttl=30 * 60,
+        max_values=40,
+        max_peers_per_torrent=100,
+        max_torrents=1000,
+    ):
+        """
+        A Kademlia DHT node: finds peers of a torrent without a tracker.
+
+        Nodes talk KRPC over UDP, i.e. bencoded dictionaries with the queries
+        ping, find_node, get_peers and announce_peer. Every node stores the
+        peers announced for the info hashes closest to its own ID. A lookup
+        asks the `alpha` closest known nodes at a time for nodes even closer
+        to the target, until the `k` closest have answered; get_peers also
+        collects the peers they store, and announce_peer stores us on them.
+        Peers are compact (ip, port, peer_id) entries like in pex messages.
+
+        One node serves every torrent of a process (see Network.start_dht()).
+
+        Args:
+            ip (str): Address to bind the UDP socket to.
+            port (int): UDP port, 0 for any free one.
+            bootstrap_nodes (list[tuple]): (ip, port) of nodes to join through.
+            node_id (bytes): 20-byte node ID, random by default.
+            k (int): Bucket size and number of nodes a lookup converges on.
+            alpha (int): Queries in flight per lookup.
+            timeout (float): Seconds to wait for an answer.
+            peer_ttl (float): Seconds an announced peer is kept.
+            max_values (int): Peers returned per get_peers answer at most.
+            max_peers_per_torrent (int): Peers stored per info hash at most;
+                the oldest announce makes room for a new one.
+            max_torrents (int): Info hashes stored at most; announces for
+                new ones are dropped while full.
+        """
+        self.id = node_id or os.urandom(ID_SIZE)
+        self.k = k
+        self.alpha = alpha
+        self.timeout = timeout
+        self.peer_ttl = peer_ttl
+        self.max_values = max_values
+        self.max_peers_per_torrent = max_peers_per_torrent
+        self.max_torrents = max_torrents
+        self.bootstrap_nodes = list(bootstrap_nodes)
+        self.routing_table = RoutingTable(self.id, k)
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((ip, port))
+        self.ip, self.port = self.socket.getsockname()
+
+        # Oldest announce first, since all live for peer_ttl
+        self.storage = {}  # {info_hash: {(ip, port, peer_id): expiry}}
+        self.next_sweep = time.monotonic() + 60
+        self.pending = {}  # {transaction ID: _PendingQuery}
+        self.next_transaction = 0
+        self.secret = os.urandom(16)
+        self.previous_secret = self.secret
+        self.secret_changed = time.monotonic()
+        self.lock = threading.Lock()
+        self.shutdown_event = threading.Event()
+
+        self.queries_sent = 0
+        self.queries_received = 0
+        self.timeouts = 0
+
+        self.thread = threading.Thread(target=self._run, name="dht", daemon=True)
+        self.thread.start()
+
+    # Outgoing queries
+
+    def _send(self, address, message):
+        try:
+            self.socket.sendto(bencode.encode(message), address)
+        except OSError as e:
+            print(f"[DEBUG] DHT could not send to {address}: {e}")
+
+    def _start_query(self, address, method, args, node_id=None):
+        with self.lock:
+            # Queries nobody waits for (add_node()) are dropped once long unanswered
+            expired = time.monotonic() - 10 * self.timeout
+            for transaction, pending in list(self.pending.items()):
+                if pending.sent < expired:
+                    del self.pending[transaction]
+            self.next_transaction = (self.next_transaction + 1) & 0xFFFF
+            transaction = struct.pack("!H", self.next_transaction)
+            pending = self.pending[transaction] = _PendingQuery(node_id)
+            self.queries_sent += 1
+        args = dict(args, id=self.id)
+        self._send(address, {b"t": transaction, b"y": b"q", b"q": method, b"a": args})
+        return transaction, pending
+
+    def _finish_query(self, transaction, pending):
+        answered = pending.event.wait(self.timeout)
+        with self.lock:
+            self.pending.pop(transaction, None)
+            if not answered:
+                self.timeouts += 1
+        if not answered and pending.node_id is not None:
+            self.routing_table.failed(pending.node_id)
+        return pending.response
+
+    def query(self, address, method, args=None, node_id=None):
+        """
+        Send a query and wait for the answer.
+
+        Returns:
+            dict: The "r" dictionary of the answer, or None on timeout or error.
+        """
+        return self._finish_query(*self._start_query(address, method, args or {}, node_id))
+
+    def ping(self, address):
+        """Ping a node; it joins the routing table if it answers."""
+        return self.query(address, b"ping") is not None
+
+    def add_node(self, address):
+        """Ping a node without waiting, e.g. one a peer told us about in a port message."""
+        self._start_query(address, b"ping", {})
+
+    def bootstrap(self):
+        """
+        Join the DHT: look up our own ID through the bootstrap nodes.
+
+        Returns:
+            int: Number of nodes in the routing table afterwards.
+        """
+        for address in self.bootstrap_nodes:
+            self.ping(address)
+        self._lookup(self.id, b"find_node")
+        return len(self.routing_table)
+
+    def _lookup(self, target, method):
+        """
+        Iterative lookup of the nodes closest to a target.
+
+        Returns:
+            tuple: (closest nodes that answered with their tokens as
+            [(NodeInfo, token)], peers found as a set of (ip, port, peer_id)).
+        """
+        key = b"target" if method == b"find_node" else b"info_hash"
+        shortlist = {node.id: node for node in self.routing_table.closest(target, self.k)}
+        queried = set()
+        answered = {}  # {node_id: (NodeInfo, token)}
+        peers = set()
+
+        while True:
+            candidates = sorted(
+                (node for node in shortlist.values() if node.id not in queried),
+                key=lambda node: distance(node.id, target),
+            )
+            closest_answered = sorted(answered, key=lambda node_id: distance(node_id, target))[: self.k]
+            if closest_answered and len(closest_answered) >= self.k:
+                # Done once nothing unqueried is closer than the k-th answer
+                limit = distance(closest_answered[-1], target)
+                candidates = [node for node in candidates if distance(node.id, target) < limit]
+            if not candidates:
+                break
+
+            batch = candidates[: self.alpha]
+            started = []
+            for node in batch:
+                queried.add(node.id)
+                started.append((node, self._start_query(node.address, method, {key: target}, node.id)))
+            for node, query in started:
+                response = self._finish_query(*query)
+                if response is None:
+                    continue
+                # Answers are untrusted: fields of the wrong type are skipped
+                token = response.get(b"token")
+                answered[node.id] = (node, token if isinstance(token, bytes) else None)
+                nodes = response.get(b"nodes", b"")
+                for found in decode_nodes(nodes) if isinstance(nodes, bytes) else ():
+                    if found.id != self.id and found.id not in shortlist:
+                        shortlist[found.id] = found
+                values = response.get(b"values", [])
+                for value in values if isinstance(values, list) else ():
+                    if isinstance(value, bytes):
+                        peers.update(peer for peer in decode_peers(value) if peer[1])
+
+        closest = sorted(answered.values(), key=lambda item: distance(item[0].id, target))[: self.k]
+        return closest, peers
+
+    def get_peers(self, info_hash):
+        """
+        Find peers of a torrent.
+
+        Returns:
+            list[tuple]: (ip, port, peer_id) of every peer found.
+        """
+        _, peers = self._lookup(info_hash, b"get_peers")
+        peers.update(self._stored_peers(info_hash))
+        return sorted(peers)
+
+    def announce(self, info_hash, port, peer_id):
+        """
+        Register a peer of a torrent on the nodes closest to its info hash.
+
+        Returns:
+            list[tuple]: Peers found on the way, see get_peers().
+        """
+        closest, peers = self._lookup(info_hash, b"get_peers")
+        args = {b"info_hash": info_hash, b"port": port, b"peer_id": peer_id.encode()}
+        started = [
+            self._start_query(node.address, b"announce_peer", dict(args, token=token), node.id)
+            for node, token in closest
+            if token is not None
+        ]
+        for query in started:
+            self._finish_query(*query)
+        # We may be among the closest nodes ourselves
+        if self.ip != "0.0.0.0":
+            self._store_peer(info_hash, (self.ip, port, peer_id))
+        peers.update(self._stored_peers(info_hash))
+        return sorted(peers)
+
+    # Incoming messages
+
+    def _run(self):
+        while not self.shutdown_event.is_set():
+            try:
+                data, address = self.socket.recvfrom(65536)
+            except OSError:
+                break
+            # Any datagram, however malformed, only costs itself; this thread
+            # must outlive it
+            try:
+                message = bencode.decode(data)
+                kind = message.get(b"y") if isinstance(message, dict) else None
+                if kind == b"q":
+                    self._on_query(message, address)
+                elif kind in (b"r", b"e"):
+                    self._on_response(message, address)
+            except bencode.BencodeError:
+                continue  # Not KRPC
+            except Exception as e:
+                print(f"[WARNING] DHT bad message from {address}: {e!r}")
+
+    def _on_response(self, message, address):
+        with self.lock:
+            pending = self.pending.pop(message.get(b"t"), None)
+        if pending is None:
+            return
+        if message[b"y"] == b"r":
+            response = message.get(b"r")
+            if not isinstance(response, dict):
+                pending.event.set()  # Answered, but with nothing usable
+                return
+            node_id = response.get(b"id", b"")
+            if isinstance(node_id, bytes):
+                self.routing_table.update(node_id, address[0], address[1])
+            pending.response = response
+        pending.event.set()
+
+    def _on_query(self, message, address):
+        args = message.get(b"a", {})
+        method = message.get(b"q")
+        node_id = args.get(b"id", b"")
+        transaction = message.get(b"t", b"")
+        with self.lock:
+            self.queries_received += 1
+        self.routing_table.update(node_id, address[0], address[1])
+
+        response = {b"id": self.id}
+        if method == b"ping":
+            pass
+        elif method == b"find_node":
+            response[b"nodes"] = encode_nodes(self.routing_table.closest(args[b"target"], self.k))
+        elif method == b"get_peers":
+            info_hash = args[b"info_hash"]
+            if not isinstance(info_hash, bytes) or len(info_hash) != ID_SIZE:
+                self._send(address, {b"t": transaction, b"y": b"e", b"e": [203, b"Bad info_hash"]})
+                return
+            response[b"token"] = self._token(address[0])
+            response[b"nodes"] = encode_nodes(self.routing_table.closest(info_hash, self.k))
+            peers = self._stored_peers(info_hash)[: self.max_values]
+            if peers:
+                response[b"values"] = [encode_peers(peers)]
+        elif method == b"announce_peer":
+            if not self._valid_token(args.get(b"token", b""), address[0]):
+                self._send(address, {b"t": transaction, b"y": b"e", b"e": [203, b"Bad token"]})
+                return
+            port = args.get(b"port")
+            if not isinstance(port, int) or not 0 < port < 65536:
+                self._send(address, {b"t": transaction, b"y": b"e", b"e": [203, b"Bad port"]})
+                return
+            peer_id = args.get(b"peer_id", b"").decode(errors="replace")
+            info_hash = args.get(b"info_hash")
+            if not isinstance(info_hash, bytes) or len(info_hash) != ID_SIZE:
+                self._send(address, {b"t": transaction, b"y": b"e", b"e": [203, b"Bad info_hash"]})
+                return
+            self._store_peer(info_hash, (address[0], port, peer_id))
+        else:
+            self._send(address, {b"t": transaction, b"y": b"e", b"e": [204, b"Method unknown"]})
+            return
+        self._send(address, {b"t": transaction, b"y": b"r", b"r": response})
+
+    # Tokens prove a node asked get_peers from the address it announces from
+
+    def _token(self, ip):
+        self._rotate_secret()
+        return hashlib.sha1(self.secret + ip.encode()).digest()[:8]
+
+    def _valid_token(self, token, ip):
+        self._rotate_secret()
+        return token in (
+            hashlib.sha1(self.secret + ip.encode()).digest()[:8],
+            hashlib.sha1(self.previous_secret + ip.encode()).digest()[:8],
+        )
+
+    def _rotate_secret(self):
+        with self.lock:
+            if time.monotonic() - self.secret_changed > 5 * 60:
+                self.previous_secret = self.secret
+                self.secret = os.urandom(16)
+                self.secret_changed = time.monotonic()
+
+    # Peer storage
+
+    def _store_peer(self, info_hash, peer):
+        info_hash = bytes(info_hash)
+        now = time.monotonic()
+        with self.lock:
+            if now >= self.next_sweep:
+                self._sweep(now)
+            peers = self.storage.get(info_hash)
+            if peers is None:
+                if len(self.storage) >= self.max_torrents:
+                    return
+                peers = self.storage[info_hash] = {}
+            # Re-inserted, so the dict stays ordered by expiry
+            peers.pop(peer, None)
+            while len(peers) >= self.max_peers_per_torrent:
+                del peers[next(iter(peers))]
+            peers[peer] = now + self.peer_ttl
+
+    def _sweep(self, now):
+        """Drop expired announces of every info hash; called with the lock held."""
+        for info_hash, peers in list(self.storage.items()):
+            for peer, expiry in list(peers.items()):
+                if expiry >= now:
+                    break  # The rest expire later
+                del peers[peer]
+            if not peers:
+                del self.storage[info_hash]
+        self.next_sweep = now + 60
+
+    def _stored_peers(self, info_hash):
+        now = time.monotonic()
+        with self.lock:
+            peers = self.storage.get(bytes(info_hash), {})
+            return [peer for peer, expiry in peers.items() if expiry >= now]
+
+    def get_stats(self):
+        """Get DHT metrics."""
+        with self.lock:
+            return {
+                "nodes": len(self.routing_table),
+                "torrents": len(self.storage),
+                "stored_peers": sum(len(peers) for peers in self.storage.values()),
+                "queries_sent": self.queries_sent,
+                "queries_received": self.queries_received,
+                "timeouts": self.timeouts,
+            }
+
+    def shutdown(self):
+        """Close the socket and stop the receive thread."""
+        self.shutdown_event.set()
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+        self.thread.join(timeout=1)
@@ -0,0 +1,225 @@
+import os
+import queue
+import threading
+
+
+class DiskJob:
+    """A unit of work for the disk I/O workers."""
+
+    WRITE = "write"
+    READ = "read"
+
+    __slots__ = ("kind", "piece_manager", "index", "data", "callback", "func", "args", "verified")
+
+    def __init__(self, kind, piece_manager=None, index=None, data=None, callback=None, func=None, args=(), verified=False):
+        self.kind = kind
+        self.piece_manager = piece_manager
+        self.index = index
+        self.data = data
+        self.callback = callback
+        self.func = func
+        self.args = args
+        self.verified = verified  # Hashed before queueing, skip the read-back check
+
+
+class DiskIOManager:
+    def __init__(self, num_workers=2, max_pending=64, max_batch=16):
+        """
+        Background disk I/O subsystem shared by the peers of a Network.
+
+        Piece writes are queued on a bounded job queue and handled by worker
+        threads, so the network threads never block on makedirs/open/seek/write
+        or on the hash check that follows. Each worker drains up to `max_batch`
+        queued jobs at once and merges writes that are adjacent in the same file
+        into a single sequential pwrite.
+
+        Args:
+            num_workers (int): Number of disk worker threads.
+            max_pending (int): Maximum number of queued jobs. When the queue is
+                full, submit_piece() blocks, which stops the calling network
+                thread from reading more data off its socket (backpressure).
+            max_batch (int): Maximum number of jobs coalesced by one worker pass.
+        """
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.max_batch = max_batch
+        self.shutdown_event = threading.Event()
+
+        self.bytes_written = 0
+        self.write_calls = 0
+        self.pieces_written = 0
+        self.stats_lock = threading.Lock()
+
+        self.workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(target=self._worker, name=f"disk-io-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit_piece(self, piece_manager, index, data, callback=None, verified=False):
+        """
+        Queue a downloaded piece to be written and verified in the background.
+
+        Blocks while the job queue is full.
+
+        Args:
+            piece_manager (PieceManager): Owner of the piece.
+            index (int): The index of the piece.
+            data (bytes): The piece data.
+            callback (callable): Called as callback(index, verified) from a
+                disk worker once the piece has been written and checked.
+            verified (bool): The data already matched the piece hash, so it is
+                not read back from disk after writing.
+        """
+        if self.shutdown_event.is_set():
+            print(f"[WARNING] DiskIOManager is shut down, dropping piece {index}")
+            return False
+        self.jobs.put(DiskJob(DiskJob.WRITE, piece_manager, index, data, callback, verified=verified))
+        return True
+
+    def submit_read(self, func, *args):
+        """Run a read-side task (e.g. read-ahead) on a disk worker. Never blocks."""
+        if self.shutdown_event.is_set():
+            return False
+        try:
+            self.jobs.put_nowait(DiskJob(DiskJob.READ, func=func, args=args))
+            return True
+        except queue.Full:
+            # Read-ahead is only an optimisation, never stall the caller for it
+            return False
+
+    def is_congested(self):
+        """Check whether the job queue is full."""
+        return self.jobs.full()
+
+    def pending(self):
+        """Get the number of queued jobs."""
+        return self.jobs.qsize()
+
+    def wait_idle(self):
+        """Block until every queued job has been processed."""
+        self.jobs.join()
+
+    def get_stats(self):
+        """Get write counters for the subsystem."""
+        with self.stats_lock:
+            return {
+                "pieces_written": self.pieces_written,
+                "bytes_written": self.bytes_written,
+                "write_calls": self.write_calls,
+                "pending": self.jobs.qsize(),
+            }
+
+    def _worker(self):
+        while not self.shutdown_event.is_set() or not self.jobs.empty():
+            try:
+                job = self.jobs.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            batch = [job]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                writes = [job for job in batch if job.kind == DiskJob.WRITE]
+                if writes:
+                    self._process_writes(writes)
+                for job in batch:
+                    if job.kind == DiskJob.READ:
+                        try:
+                            job.func(*job.args)
+                        except Exception as e:
+                            print(f"[ERROR] DiskIOManager read job failed: {e}")
+            finally:
+                for _ in batch:
+                    self.jobs.task_done()
+
+    def _process_writes(self, jobs):
+        """Write a batch of pieces with coalesced I/O, then verify the ones not hashed yet."""
+        failed_paths = set()
+
+        # Group the segments of all pieces per file
+        segments = {}
+        job_paths = []
+        for job in jobs:
+            paths = set()
+            for file_path, offset, chunk in job.piece_manager.split_piece(job.index, job.data):
+                segments.setdefault(file_path, (job.piece_manager, []))[1].append((offset, chunk))
+                paths.add(file_path)
+            job_paths.append(paths)
+
+        for file_path, (piece_manager, chunks) in segments.items():
+            try:
+                piece_manager.prepare_file(file_path)
+                self._write_file(file_path, chunks)
+            except OSError as e:
+                print(f"[ERROR] DiskIOManager failed to write {file_path}: {e}")
+                failed_paths.add(file_path)
+
+        with self.stats_lock:
+            self.pieces_written += len(jobs)
+
+        for job, paths in zip(jobs, job_paths):
+            piece_manager = job.piece_manager
+            written = bool(paths) and not (paths & failed_paths)
+            if written and job.verified:
+                piece_manager.mark_piece_completed(job.index)
+                verified = True
+            else:
+                verified = written and piece_manager.verify_piece(job.index)
+            piece_manager.finish_pending_piece(job.index)
+            if not verified:
+                print(f"[ERROR] Piece {job.index} failed verification after saving.")
+            if job.callback:
+                try:
+                    job.callback(job.index, verified)
+                except Exception as e:
+                    print(f"[ERROR] DiskIOManager callback for piece {job.index} failed: {e}")
+
+    def _write_file(self, file_path, chunks):
+        """Merge adjacent chunks of one file and write each run with one pwrite."""
+        chunks.sort(key=lambda chunk: chunk[0])
+
+        runs = []  # [start_offset, [buffers], total_length]
+        for offset, chunk in chunks:
+            if runs and runs[-1][0] + runs[-1][2] == offset:
+                runs[-1][1].append(chunk)
+                runs[-1][2] += len(chunk)
+            else:
+                runs.append([offset, [chunk], len(chunk)])
+
+        fd = os.open(file_path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+        try:
+            for start, buffers, total in runs:
+                data = buffers[0] if len(buffers) == 1 else b"".join(buffers)
+                _pwrite_all(fd, data, start)
+                with self.stats_lock:
+                    self.bytes_written += total
+                    self.write_calls += 1
+        finally:
+            os.close(fd)
+
+    def shutdown(self, wait=True):
+        """Stop the workers once every queued job has been handled."""
+        self.shutdown_event.set()
+        if wait:
+            for worker in self.workers:
+                worker.join()
+
+
+def _pwrite_all(fd, data, offset):
+    """Write all of `data` at `offset`, using pwrite where the platform has it."""
+    view = memoryview(data)
+    if hasattr(os, "pwrite"):
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
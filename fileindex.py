@@ -0,0 +1,90 @@
+from array import array
+from bisect import bisect_right
+
+
+class FileOffsetIndex:
+    def __init__(self, files, piece_length):
+        """
+        Compact piece-to-file index for multi-file torrents.
+
+        The files of a torrent form one continuous byte stream that is cut into
+        pieces. Instead of storing the file segments of every piece, only the
+        cumulative start offset of each file is kept in an array, and a byte
+        range is resolved to file segments with a binary search when needed.
+
+        Args:
+            files (list[dict]): Files in torrent order, each with "path" and "length".
+            piece_length (int): Nominal length of a piece in bytes.
+        """
+        self.piece_length = piece_length
+        self.paths = [file_info["path"] for file_info in files]
+        self.lengths = array("q", (file_info["length"] for file_info in files))
+
+        # offsets[i] is where file i starts in the stream, offsets[-1] is the total size
+        self.offsets = array("q", [0])
+        for length in self.lengths:
+            self.offsets.append(self.offsets[-1] + length)
+        self.total_length = self.offsets[-1]
+
+    def piece_size(self, index):
+        """Get the real length of a piece (the last one is usually shorter)."""
+        start = index * self.piece_length
+        if index < 0 or start >= self.total_length:
+            return 0
+        return min(self.piece_length, self.total_length - start)
+
+    def resolve(self, start, length):
+        """
+        Turn a range of the torrent byte stream into file segments.
+
+        Args:
+            start (int): Offset in the byte stream.
+            length (int): Number of bytes.
+
+        Returns:
+            list[tuple]: (file_path, file_offset, length) for every file the
+            range touches, in stream order.
+        """
+        end = min(start + length, self.total_length)
+        segments = []
+        if start < 0 or start >= end:
+            return segments
+
+        # Last file starting at or before `start`; bisect_right skips empty files
+        file_index = bisect_right(self.offsets, start) - 1
+        position = start
+        while position < end and file_index < len(self.lengths):
+            file_start = self.offsets[file_index]
+            file_end = file_start + self.lengths[file_index]
+            if file_end > position:
+                take = min(end, file_end) - position
+                segments.append((self.paths[file_index], position - file_start, take))
+                position += take
+            file_index += 1
+        return segments
+
+    def piece_segments(self, index, begin=0, length=None):
+        """
+        Get the file segments of a piece, or of a block inside it.
+
+        Args:
+            index (int): The index of the piece.
+            begin (int): Offset of the block inside the piece.
+            length (int): Length of the block, the rest of the piece by default.
+
+        Returns:
+            list[tuple]: (file_path, file_offset, length) segments.
+        """
+        size = self.piece_size(index)
+        if length is None:
+            length = size - begin
+        length = min(length, size - begin)
+        return self.resolve(index * self.piece_length + begin, length)
+
+    def file_pieces(self, file_index):
+        """Get the range of piece indices that hold data of a file."""
+        start = self.offsets[file_index]
+        length = self.lengths[file_index]
+        if length == 0:
+            return range(0)
+        return range(start // self.piece_length, (start + length - 1) // self.piece_length + 1)
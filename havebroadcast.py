@@ -0,0 +1,193 @@
+import threading
+
+from message import MessageFactory
+
+
+class _PeerView:
+    """What we know about one connected peer."""
+
+    __slots__ = ("sender", "has", "told")
+
+    def __init__(self, sender, has, told):
+        self.sender = sender  # MessageSender of the connection
+        self.has = has  # bytearray, 1 for pieces the peer holds
+        self.told = told  # bytearray, 1 for pieces the peer knows we hold
+
+
+class HaveBroadcaster:
+    def __init__(self, total_pieces, get_bitfield, interval=1.0):
+        """
+        Announces completed pieces to connected peers in batches.
+
+        Completions are queued and flushed every `interval` seconds by one
+        background thread. For each peer, pieces it already holds or was
+        already told about are skipped, and the rest go out either as a run of
+        have messages in a single send or as one fresh bitfield, whichever is
+        fewer bytes.
+
+        It also keeps `availability`, the number of connections whose peer
+        holds each piece, for rarest-first piece picking.
+
+        Args:
+            total_pieces (int): Number of pieces in the torrent.
+            get_bitfield (callable): Returns our current bitfield.
+            interval (float): Seconds between flushes.
+        """
+        self.total_pieces = total_pieces
+        self.get_bitfield = get_bitfield
+        self.interval = interval
+        self.message_factory = MessageFactory()
+
+        self.peers = {}  # {key: _PeerView}
+        self.availability = [0] * total_pieces  # Connections holding each piece
+        self.pending = set()  # Completed pieces not flushed yet
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.shutdown_event = threading.Event()
+
+        self.haves_sent = 0
+        self.bitfields_sent = 0
+        self.suppressed = 0
+        self.bytes_sent = 0
+
+        self.thread = threading.Thread(target=self._run, name="have-broadcast", daemon=True)
+        self.thread.start()
+
+    def add_peer(self, key, sender, has=None, told=None):
+        """
+        Start tracking a connection.
+
+        Args:
+            key: Unique key of the connection.
+            sender (MessageSender): Used to write announcements.
+            has (bytes): The peer's bitfield, if known.
+            told (bytes): Our bitfield as last sent to the peer, if any.
+        """
+        view = _PeerView(
+            sender,
+            self._fit(has) if has is not None else bytearray(self.total_pieces),
+            self._fit(told) if told is not None else bytearray(self.total_pieces),
+        )
+        with self.lock:
+            old = self.peers.get(key)
+            if old is not None:
+                self._count(old.has, -1)
+            self.peers[key] = view
+            self._count(view.has, 1)
+
+    def remove_peer(self, key):
+        """Stop tracking a connection."""
+        with self.lock:
+            view = self.peers.pop(key, None)
+            if view is not None:
+                self._count(view.has, -1)
+
+    def _fit(self, bitfield):
+        """Copy a bitfield, cut or zero-padded to one entry per piece; peers may send any length."""
+        fitted = bytearray(bitfield[: self.total_pieces])
+        fitted.extend(bytes(self.total_pieces - len(fitted)))
+        return fitted
+
+    def _count(self, has, delta):
+        availability = self.availability
+        for index in range(min(len(has), len(availability))):
+            if has[index]:
+                availability[index] += delta
+
+    def record_bitfield(self, key, bitfield):
+        """The peer sent its bitfield."""
+        with self.lock:
+            view = self.peers.get(key)
+            if view is not None:
+                self._count(view.has, -1)
+                view.has = self._fit(bitfield)
+                self._count(view.has, 1)
+
+    def record_have(self, key, index):
+        """The peer announced a piece."""
+        with self.lock:
+            view = self.peers.get(key)
+            if view is not None and 0 <= index < self.total_pieces and not view.has[index]:
+                view.has[index] = 1
+                self.availability[index] += 1
+
+    def record_told(self, key, index):
+        """The peer was told outside the broadcaster that we hold a piece."""
+        with self.lock:
+            view = self.peers.get(key)
+            if view is not None and 0 <= index < self.total_pieces:
+                view.told[index] = 1
+
+    def peer_has(self, key, index):
+        """Check whether a peer is known to hold a piece."""
+        with self.lock:
+            view = self.peers.get(key)
+            return view is not None and view.has[index] == 1
+
+    def piece_completed(self, index):
+        """Queue a verified piece for the next flush."""
+        with self.lock:
+            self.pending.add(index)
+        self.wakeup.set()
+
+    def flush(self):
+        """Announce the queued pieces to every peer that doesn't know about them."""
+        with self.lock:
+            if not self.pending:
+                return
+            pending = sorted(self.pending)
+            self.pending.clear()
+            peers = list(self.peers.items())
+
+        bitfield_cost = 5 + self.total_pieces
+        for key, view in peers:
+            with self.lock:
+                announce = [i for i in pending if not view.has[i] and not view.told[i]]
+                self.suppressed += len(pending) - len(announce)
+            if not announce:
+                continue
+
+            try:
+                if bitfield_cost < 9 * len(announce):
+                    bitfield = self.get_bitfield()
+                    view.sender.send_bitfield(bitfield)
+                    with self.lock:
+                        view.told = self._fit(bitfield)
+                        self.bitfields_sent += 1
+                        self.bytes_sent += bitfield_cost
+                else:
+                    view.sender.sendall(b"".join(self.message_factory.have(i) for i in announce))
+                    with self.lock:
+                        for i in announce:
+                            view.told[i] = 1
+                        self.haves_sent += len(announce)
+                        self.bytes_sent += 9 * len(announce)
+            except OSError as e:
+                print(f"[DEBUG] HaveBroadcaster dropping {key}: {e}")
+                self.remove_peer(key)
+
+    def _run(self):
+        while not self.shutdown_event.is_set():
+            self.wakeup.wait()
+            # Let more completions pile up before sending
+            if self.shutdown_event.wait(self.interval):
+                break
+            self.wakeup.clear()
+            self.flush()
+
+    def get_stats(self):
+        """Get announcement metrics."""
+        with self.lock:
+            return {
+                "peers": len(self.peers),
+                "haves_sent": self.haves_sent,
+                "bitfields_sent": self.bitfields_sent,
+                "suppressed": self.suppressed,
+                "bytes_sent": self.bytes_sent,
+            }
+
+    def shutdown(self):
+        """Stop the flush thread."""
+        self.shutdown_event.set()
+        self.wakeup.set()
+        self.thread.join()
@@ -0,0 +1,278 @@
+import os
+import select
+import socket
+import threading
+import time
+
+LSD_GROUP = "239.192.152.143"
+LSD_PORT = 6771
+
+
+def build_announce(info_hash, port, peer_id, cookie, group=LSD_GROUP, group_port=LSD_PORT):
+    """
+    Build a local service discovery announce.
+
+    The format is the BT-SEARCH message of BEP 14 with a Peer-Id header
+    added, since peers are keyed by peer ID here.
+
+    Args:
+        info_hash (bytes): Info hash of the torrent.
+        port (int): Our listen port for the torrent.
+        peer_id (str): Our peer ID for the torrent.
+        cookie (str): Identifies the sender, so it can skip its own messages.
+
+    Returns:
+        bytes: The datagram.
+    """
+    return (
+        "BT-SEARCH * HTTP/1.1\r\n"
+        f"Host: {group}:{group_port}\r\n"
+        f"Port: {port}\r\n"
+        f"Infohash: {info_hash.hex()}\r\n"
+        f"Peer-Id: {peer_id}\r\n"
+        f"cookie: {cookie}\r\n"
+        "\r\n\r\n"
+    ).encode()
+
+
+def parse_announce(data):
+    """
+    Parse an announce, see build_announce().
+
+    Returns:
+        dict: {"port", "info_hashes", "peer_id", "cookie"}, or None if the
+        datagram is not a valid announce.
+    """
+    try:
+        lines = data.decode("ascii").split("\r\n")
+    except UnicodeDecodeError:
+        return None
+    if not lines or lines[0] != "BT-SEARCH * HTTP/1.1":
+        return None
+    message = {"port": None, "info_hashes": [], "peer_id": None, "cookie": None}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        name, value = name.strip().lower(), value.strip()
+        try:
+            if name == "port":
+                message["port"] = int(value)
+            elif name == "infohash":
+                message["info_hashes"].append(bytes.fromhex(value))
+            elif name == "peer-id":
+                message["peer_id"] = value
+            elif name == "cookie":
+                message["cookie"] = value
+        except ValueError:
+            return None
+    if not message["info_hashes"] or message["peer_id"] is None or not 0 < (message["port"] or 0) < 65536:
+        return None
+    return message
+
+
+class _Registration:
+    """A torrent announced on the local network."""
+
+    __slots__ = ("info_hash", "port", "peer_id", "on_peers", "next_announce", "replied")
+
+    def __init__(self, info_hash, port, peer_id, on_peers):
+        self.info_hash = info_hash
+        self.port = port
+        self.peer_id = peer_id
+        self.on_peers = on_peers
+        self.next_announce = 0.0  # Right away
+        self.replied = {}  # {address: monotonic time of our last answer}
+
+
+class LocalServiceDiscovery:
+    def __init__(
+        self,
+        interface_ip="0.0.0.0",
+        group=LSD_GROUP,
+        port=LSD_PORT,
+        interval=5 * 60,
+        min_reply_interval=1.0,
+        ttl=1,
+    ):
+        """
+        Local service discovery: finds peers on the same network by multicast.
+
+        Every registered torrent is announced to a multicast group with its
+        info hash, listen port and peer ID, once when registered and then
+        every `interval` seconds. A peer receiving the announce of a torrent
+        it also has passes the sender to the torrent's callback, and answers
+        at once with its own announce, unicast to the sender, so a new peer
+        learns about the peers already there within milliseconds instead of
+        waiting for their next periodic announce. A torrent answers the same
+        sender at most once per `min_reply_interval`.
+
+        One service serves every torrent of a process (see Network.start_lsd()).
+
+        Args:
+            interface_ip (str): Address of the interface to multicast on,
+                "0.0.0.0" for the default one.
+            group (str): Multicast group.
+            port (int): UDP port of the group.
+            interval (float): Seconds between the announces of a torrent.
+            min_reply_interval (float): Seconds between answers to one sender.
+            ttl (int): Multicast TTL; 1 keeps announces on the local subnet.
+        """
+        self.interface_ip = interface_ip
+        self.group = group
+        self.group_port = port
+        self.interval = interval
+        self.min_reply_interval = min_reply_interval
+        self.cookie = os.urandom(8).hex()
+
+        # Receives the group's announces
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            # Several processes on one host all listen to the group
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind(("", port))
+        membership = socket.inet_aton(group) + socket.inet_aton(interface_ip)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+
+        # Sends everything, from a port of our own: answers to the shared
+        # group port could reach any process of the sender's host
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sender.bind((interface_ip, 0))
+        self.sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if interface_ip != "0.0.0.0":
+            self.sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface_ip))
+
+        self.registrations = {}  # {(info_hash, peer_id): _Registration}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.shutdown_event = threading.Event()
+
+        self.announces_sent = 0
+        self.replies_sent = 0
+        self.announces_received = 0
+        self.peers_found = 0
+
+        self.thread = threading.Thread(target=self._run, name="lsd", daemon=True)
+        self.thread.start()
+        self.announcer = threading.Thread(target=self._announce_loop, name="lsd-announce", daemon=True)
+        self.announcer.start()
+
+    def register(self, info_hash, port, peer_id, on_peers):
+        """
+        Announce a torrent on the local network and report peers found for it.
+
+        Args:
+            info_hash (bytes): Info hash of the torrent.
+            port (int): Our listen port for the torrent.
+            peer_id (str): Our peer ID for the torrent.
+            on_peers (callable): Called with a list of {"ip", "port",
+                "peer_id"} dicts of local peers, on the receive thread.
+        """
+        with self.lock:
+            self.registrations[(bytes(info_hash), peer_id)] = _Registration(
+                bytes(info_hash), port, peer_id, on_peers
+            )
+        self.wakeup.set()
+
+    def unregister(self, info_hash, peer_id):
+        """Stop announcing a torrent."""
+        with self.lock:
+            self.registrations.pop((bytes(info_hash), peer_id), None)
+
+    def _send(self, registration, address):
+        message = build_announce(
+            registration.info_hash,
+            registration.port,
+            registration.peer_id,
+            self.cookie,
+            self.group,
+            self.group_port,
+        )
+        try:
+            self.sender.sendto(message, address)
+            return True
+        except OSError as e:
+            print(f"[DEBUG] LSD could not send to {address}: {e}")
+            return False
+
+    def _announce_loop(self):
+        while not self.shutdown_event.is_set():
+            now = time.monotonic()
+            with self.lock:
+                due = [r for r in self.registrations.values() if r.next_announce <= now]
+                for registration in due:
+                    registration.next_announce = now + self.interval
+            for registration in due:
+                if self._send(registration, (self.group, self.group_port)):
+                    with self.lock:
+                        self.announces_sent += 1
+
+            with self.lock:
+                next_due = min((r.next_announce for r in self.registrations.values()), default=None)
+            self.wakeup.wait(None if next_due is None else max(0.0, next_due - time.monotonic()))
+            self.wakeup.clear()
+
+    def _run(self):
+        sockets = [self.socket, self.sender]
+        while not self.shutdown_event.is_set():
+            try:
+                readable, _, _ = select.select(sockets, [], [], 1.0)
+                received = [sock.recvfrom(2048) for sock in readable]
+            except (OSError, ValueError):
+                break  # Closed by shutdown()
+            for data, address in received:
+                message = parse_announce(data)
+                if message is None or message["cookie"] == self.cookie:
+                    continue  # Not an announce, or our own looped back
+                try:
+                    self._on_announce(message, address)
+                except Exception as e:
+                    print(f"[WARNING] LSD bad announce from {address}: {e}")
+
+    def _on_announce(self, message, address):
+        now = time.monotonic()
+        peer = {"ip": address[0], "port": message["port"], "peer_id": message["peer_id"]}
+        matches = []
+        replies = []
+        with self.lock:
+            self.announces_received += 1
+            for info_hash in message["info_hashes"]:
+                for registration in self.registrations.values():
+                    if registration.info_hash != info_hash or registration.peer_id == peer["peer_id"]:
+                        continue
+                    matches.append(registration)
+                    if now - registration.replied.get(address, 0.0) >= self.min_reply_interval:
+                        registration.replied[address] = now
+                        replies.append(registration)
+            self.peers_found += len(matches)
+
+        # Answer first, so the new peer can connect to us while we connect to it
+        for registration in replies:
+            if self._send(registration, address):
+                with self.lock:
+                    self.replies_sent += 1
+        for registration in matches:
+            registration.on_peers([peer])
+
+    def get_stats(self):
+        """Get local discovery metrics."""
+        with self.lock:
+            return {
+                "torrents": len(self.registrations),
+                "announces_sent": self.announces_sent,
+                "replies_sent": self.replies_sent,
+                "announces_received": self.announces_received,
+                "peers_found": self.peers_found,
+            }
+
+    def shutdown(self):
+        """Stop announcing and close the socket."""
+        self.shutdown_event.set()
+        self.wakeup.set()
+        for sock in (self.socket, self.sender):
+            try:
+                sock.close()
+            except OSError:
+                pass
+        self.thread.join(timeout=1)
+        self.announcer.join(timeout=1)
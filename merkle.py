@@ -0,0 +1,130 @@
+import hashlib
+
+# Blocks are the unit of transfer and of per-block verification
+BLOCK_SIZE = 16 * 1024
+DIGEST_SIZE = 20
+# Leaf used to pad a piece's tree to a power of two
+ZERO_HASH = bytes(DIGEST_SIZE)
+
+
+def block_size_for(piece_length):
+    """
+    Get the block size used for a piece length.
+
+    Blocks must tile a piece exactly. Piece lengths that are not a multiple of
+    BLOCK_SIZE get one block per piece, which is valid but gains nothing.
+    """
+    if piece_length % BLOCK_SIZE == 0:
+        return BLOCK_SIZE
+    return piece_length
+
+
+def hash_blocks(data, block_size=BLOCK_SIZE):
+    """
+    Hash consecutive blocks of data; the last block may be short.
+
+    Returns:
+        list[bytes]: The SHA-1 digest of every block.
+    """
+    view = memoryview(data)
+    return [
+        hashlib.sha1(view[offset : offset + block_size]).digest()
+        for offset in range(0, len(view), block_size)
+    ]
+
+
+def merkle_root(leaves):
+    """
+    Compute the root of a binary SHA-1 Merkle tree.
+
+    The leaves are padded with ZERO_HASH up to a power of two, and every
+    inner node is the SHA-1 of its two children concatenated.
+
+    Args:
+        leaves (list[bytes]): Block digests, in order.
+
+    Returns:
+        bytes: The root digest, ZERO_HASH for no leaves.
+    """
+    if not leaves:
+        return ZERO_HASH
+    width = 1
+    while width < len(leaves):
+        width *= 2
+    level = list(leaves) + [ZERO_HASH] * (width - len(leaves))
+    while len(level) > 1:
+        level = [hashlib.sha1(level[i] + level[i + 1]).digest() for i in range(0, len(level), 2)]
+    return level[0]
+
+
+class BlockHashes:
+    def __init__(self, leaves, roots, piece_length, total_length, block_size=BLOCK_SIZE):
+        """
+        Table of the block digests of a torrent, with a Merkle root per piece.
+
+        The roots live in the info dictionary and are covered by the info
+        hash; the leaves are stored next to it and only trusted once they
+        rebuild those roots (see verify()). Since every piece but the last is
+        full, the leaves of piece i start at leaf i * blocks_per_piece and a
+        block's leaf is simply its byte offset in the torrent / block_size.
+
+        Args:
+            leaves (bytes): Concatenated 20-byte block digests, in torrent order.
+            roots (bytes): Concatenated 20-byte Merkle roots, one per piece.
+            piece_length (int): Piece length in bytes.
+            total_length (int): Total size of the torrent content.
+            block_size (int): Block length in bytes; divides piece_length.
+        """
+        if piece_length % block_size:
+            raise ValueError(f"Block size {block_size} does not divide piece length {piece_length}")
+        # Decoded strings may be views of the .torrent bytes
+        self.leaves = bytes(leaves)
+        self.roots = bytes(roots)
+        self.piece_length = piece_length
+        self.total_length = total_length
+        self.block_size = block_size
+        self.blocks_per_piece = piece_length // block_size
+        self.total_pieces = len(roots) // DIGEST_SIZE
+
+    def piece_size(self, index):
+        """Get the length of a piece; the last one may be short."""
+        return min(self.piece_length, self.total_length - index * self.piece_length)
+
+    def blocks_in_piece(self, index):
+        """Get the number of blocks of a piece."""
+        return -(-self.piece_size(index) // self.block_size)
+
+    def block_range(self, index, block):
+        """Get (begin, length) of a block inside its piece."""
+        begin = block * self.block_size
+        return begin, min(self.block_size, self.piece_size(index) - begin)
+
+    def leaf(self, index, block):
+        """Get the expected digest of a block of a piece."""
+        offset = (index * self.blocks_per_piece + block) * DIGEST_SIZE
+        return self.leaves[offset : offset + DIGEST_SIZE]
+
+    def block_matches(self, index, block, data):
+        """Check block data against its leaf without slicing the table."""
+        if not 0 <= block < self.blocks_in_piece(index):
+            return False
+        offset = (index * self.blocks_per_piece + block) * DIGEST_SIZE
+        return self.leaves.startswith(hashlib.sha1(data).digest(), offset)
+
+    def verify(self):
+        """
+        Check the leaves against the piece roots.
+
+        Returns:
+            list[int]: Indexes of pieces whose leaves don't rebuild their root.
+        """
+        expected_leaves = -(-self.total_length // self.block_size)
+        if len(self.leaves) != expected_leaves * DIGEST_SIZE:
+            return list(range(self.total_pieces))
+        bad = []
+        for index in range(self.total_pieces):
+            leaves = [self.leaf(index, block) for block in range(self.blocks_in_piece(index))]
+            root = self.roots[index * DIGEST_SIZE : (index + 1) * DIGEST_SIZE]
+            if merkle_root(leaves) != root:
+                bad.append(index)
+        return bad
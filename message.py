@@ -1,15 +1,137 @@
 import struct
+import threading
+import time
+from collections import namedtuple
+
+
+# Precompiled codecs for the fixed-size parts of every message
+_LENGTH = struct.Struct("!I")
+_HEADER = struct.Struct("!IB")  # <len><id>
+_HAVE = struct.Struct("!IBI")  # <len><id><piece index>
+_INDEX_BEGIN_LENGTH = struct.Struct("!IBIII")  # <len><id><index><begin><length>
+_PIECE_HEADER = struct.Struct("!IBII")  # <len><id><index><begin>, block follows
+_PORT = struct.Struct("!IBH")
+_HANDSHAKE = struct.Struct("!IB19s8s20s20s")
+
+# Extensions announced in the handshake reserved bytes, as (byte, bit mask)
+RESERVED_PEX = (5, 0x02)
+RESERVED_DHT = (7, 0x01)  # Port messages carry the DHT port
+_NO_EXTENSIONS = bytes(8)
+
+# Messages without payload never change, build them once
+_KEEP_ALIVE = _LENGTH.pack(0)
+_CHOKE = _HEADER.pack(1, 0)
+_UNCHOKE = _HEADER.pack(1, 1)
+_INTERESTED = _HEADER.pack(1, 2)
+_NOT_INTERESTED = _HEADER.pack(1, 3)
+_REQUEST_BITFIELD = _HEADER.pack(1, 5)
+_DONT_HAVE_PIECE = _HEADER.pack(1, 10)
+_DENY_UNCHOKE = _HEADER.pack(1, 11)
+_DISCONNECT = _HEADER.pack(1, 12)
+
+# Per-thread header buffers reused by send_piece/send_bitfield
+_buffers = threading.local()
+
+
+def send_message(sock, parts):
+    """
+    Send a message given as a list of buffers, without joining them.
+
+    Uses scatter/gather socket.sendmsg where the platform has it, so a header
+    and a large payload go out in one system call without being copied into a
+    new bytes object.
+    """
+    if not hasattr(sock, "sendmsg"):
+        for part in parts:
+            sock.sendall(part)
+        return
+
+    views = [memoryview(part) for part in parts]
+    while views:
+        sent = sock.sendmsg(views)
+        # Drop what was sent, sendmsg may stop part-way through a buffer
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if views and sent:
+            views[0] = views[0][sent:]
+
+
+class MessageSender:
+    def __init__(self, sock):
+        """
+        Serialises whole messages written to one socket by several threads.
+
+        A connection is written by its own thread and by background senders
+        such as the have broadcaster; holding the lock for a complete message
+        keeps their frames from interleaving on the wire.
+
+        Args:
+            sock (socket.socket): The connected socket.
+        """
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.last_sent = time.monotonic()
+
+    def sendall(self, data):
+        """Send one or more complete messages."""
+        with self.lock:
+            self.sock.sendall(data)
+            self.last_sent = time.monotonic()
+
+    def try_sendall(self, data):
+        """
+        Send messages unless another thread is writing right now.
+
+        Returns:
+            bool: True if the data was sent.
+        """
+        if not self.lock.acquire(blocking=False):
+            return False
+        try:
+            self.sock.sendall(data)
+            self.last_sent = time.monotonic()
+            return True
+        except OSError:
+            return False
+        finally:
+            self.lock.release()
+
+    def send_bitfield(self, bitfield):
+        """Send a bitfield message, see MessageFactory.send_bitfield."""
+        with self.lock:
+            MessageFactory.send_bitfield(self.sock, bitfield)
+            self.last_sent = time.monotonic()
+
+    def send_piece(self, index, begin, block):
+        """Send a piece message, see MessageFactory.send_piece."""
+        with self.lock:
+            MessageFactory.send_piece(self.sock, index, begin, block)
+            self.last_sent = time.monotonic()
+
+
+def reserved_bytes(*extensions):
+    """Build the handshake reserved field announcing the given extensions."""
+    reserved = bytearray(8)
+    for byte, mask in extensions:
+        reserved[byte] |= mask
+    return bytes(reserved)
+
+
+def supports(reserved, extension):
+    """Check whether a handshake reserved field announces an extension."""
+    byte, mask = extension
+    return bool(reserved[byte] & mask)
 
 
 class MessageFactory:
     @staticmethod
-    def handshake(info_hash, peer_id):
+    def handshake(info_hash, peer_id, reserved=_NO_EXTENSIONS):
         pstr = b"BitTorrent protocol"
-        reserved = b"\x00" * 8  # 8 zero bytes for reserved field
+        # 8 reserved bytes, with a bit set for every extension we support
         pstrlen = len(pstr)  # Length of the protocol string, usually 19
 
-        handshake = struct.pack(
-            f"!IB{pstrlen}s8s20s20s",
+        return _HANDSHAKE.pack(
             19,
             pstrlen,
             pstr,
@@ -17,188 +139,424 @@ class MessageFactory:
             info_hash,
             peer_id,
         )
-        return handshake
 
     @staticmethod
     def keep_alive():
         """Keep-alive message: <len=0000>"""
-        return struct.pack("!I", 0)  # Length prefix of 0, no message ID or payload
+        return _KEEP_ALIVE  # Length prefix of 0, no message ID or payload
 
     @staticmethod
     def choke():
         """Choke message: <len=0001><id=0>"""
-        return struct.pack("!IB", 1, 0)  # Length prefix of 1, ID of 0
+        return _CHOKE
     @staticmethod
     def deny_unchoke():
         """Unchoke message: <len=0001><id=11>"""
-        return struct.pack("!IB", 1, 11)  # Length prefix of 1, ID of 1
+        return _DENY_UNCHOKE
     @staticmethod
     def unchoke():
         """Unchoke message: <len=0001><id=1>"""
-        return struct.pack("!IB", 1, 1)  # Length prefix of 1, ID of 1
+        return _UNCHOKE
 
     @staticmethod
     def interested():
         """Interested message: <len=0001><id=2>"""
-        return struct.pack("!IB", 1, 2)  # Length prefix of 1, ID of 2
+        return _INTERESTED
 
     @staticmethod
     def not_interested():
         """Not interested message: <len=0001><id=3>"""
-        return struct.pack("!IB", 1, 3)  # Length prefix of 1, ID of 3
+        return _NOT_INTERESTED
 
     @staticmethod
     def have(piece_index):
         """Have message: <len=0005><id=4><piece index>"""
-        return struct.pack(
-            "!IBI", 5, 4, piece_index
-        )  # Length prefix of 5, ID of 4, piece index
+        return _HAVE.pack(5, 4, piece_index)  # Length prefix of 5, ID of 4, piece index
 
     @staticmethod
     def request_bitfield():
         """Bitfield message: <len=0001+X><id=5><bitfield>"""
-        return struct.pack("!IB", 1, 5)
+        return _REQUEST_BITFIELD
     @staticmethod
     def bitfield(bitfield):
         """Bitfield message: <len=0001+X><id=5><bitfield>"""
-        bitfield_length = len(bitfield)
-        return struct.pack(f"!IB{bitfield_length}s", 1 + bitfield_length, 5, bitfield)
+        return _HEADER.pack(1 + len(bitfield), 5) + bitfield
+
+    @staticmethod
+    def send_bitfield(sock, bitfield):
+        """Send a bitfield message as [header, bitfield] without copying the bitfield."""
+        header = _thread_buffer("bitfield_header", _HEADER.size)
+        _HEADER.pack_into(header, 0, 1 + len(bitfield), 5)
+        send_message(sock, [header, bitfield])
 
     @staticmethod
     def request(index, begin, length):
         """Request message: <len=0013><id=6><index><begin><length>"""
-        return struct.pack(
-            "!IBIII", 13, 6, index, begin, length
-        )  # Length prefix of 13, ID of 6
+        return _INDEX_BEGIN_LENGTH.pack(13, 6, index, begin, length)  # Length prefix of 13, ID of 6
 
     @staticmethod
     def piece(index, begin, block):
         """Piece message: <len=0009+X><id=7><index><begin><block>"""
-        block_length = len(block)
-        return struct.pack(
-            f"!IBII{block_length}s", 9 + block_length, 7, index, begin, block
-        )
+        # One copy of the block; use send_piece() to avoid even that
+        return _PIECE_HEADER.pack(9 + len(block), 7, index, begin) + block
+
+    @staticmethod
+    def send_piece(sock, index, begin, block):
+        """Send a piece message as [header, block]; the block is never copied."""
+        header = _thread_buffer("piece_header", _PIECE_HEADER.size)
+        _PIECE_HEADER.pack_into(header, 0, 9 + len(block), 7, index, begin)
+        send_message(sock, [header, block])
+
     @staticmethod
     def dont_have_piece():
         """dont_have_piece message: <len=0001+X><id=10>"""
-        return struct.pack("!IB", 1, 10)
+        return _DONT_HAVE_PIECE
     @staticmethod
     def cancel(index, begin, length):
         """Cancel message: <len=0013><id=8><index><begin><length>"""
-        return struct.pack(
-            "!IBIII", 13, 8, index, begin, length
-        )  # Length prefix of 13, ID of 8
+        return _INDEX_BEGIN_LENGTH.pack(13, 8, index, begin, length)  # Length prefix of 13, ID of 8
     @staticmethod
     def disconnect():
         """Disconnect message: <len=0001><id=12>"""
-        return struct.pack("!IB", 1, 12)
+        return _DISCONNECT
     @staticmethod
     def port(listen_port):
         """Port message: <len=0003><id=9><listen-port>"""
-        return struct.pack(
-            "!IBH", 3, 9, listen_port
-        )  # Length prefix of 3, ID of 9, port
+        return _PORT.pack(3, 9, listen_port)  # Length prefix of 3, ID of 9, port
     @staticmethod
     def start_get_pieces(index, begin, length):
         """Start_get_pieces message: <len=0001><id=13>"""
-        return struct.pack(
-            "!IBIII", 13, 13, index, begin, length
-        )  # Length prefix of 13, ID of 6
+        return _INDEX_BEGIN_LENGTH.pack(13, 13, index, begin, length)  # Length prefix of 13, ID of 6
+    @staticmethod
+    def pex(payload):
+        """Peer exchange message: <len=0001+X><id=14><bencoded added/dropped peers>"""
+        return _HEADER.pack(1 + len(payload), 14) + payload
+
 
+def _thread_buffer(name, size):
+    """Get a header buffer owned by the calling thread."""
+    buffer = getattr(_buffers, name, None)
+    if buffer is None:
+        buffer = bytearray(size)
+        setattr(_buffers, name, buffer)
+    return buffer
 
 
 class MessageParser:
+    """
+    Table-driven parser turning raw frames into message objects.
+
+    The decoder of every message ID is looked up in PARSERS, a dict built once
+    at import time, and fixed-size fields are read with precompiled Structs.
+    Piece blocks and bitfields are returned as memoryviews into the frame, so
+    parsing never copies a payload.
+    """
+
     @staticmethod
     def parse_message(data):
         """
         Parses a received message from a peer.
-        Returns a dictionary with message details.
+
+        Args:
+            data (bytes | bytearray | memoryview): One message, length prefix included.
+
+        Returns:
+            A message object from this module; check `.id` against the message
+            ID constants (or `.type` for the name) to tell them apart.
         """
         # Minimum length for a valid message (keep-alive)
         if len(data) < 4:
             raise ValueError("Invalid message length")
 
-        # Read the message length prefix (first 4 bytes)
-        length_prefix = struct.unpack("!I", data[:4])[0]
+        # A handshake starts with the pstrlen 19 inside the length field
+        if _LENGTH.unpack_from(data, 0)[0] == 19 and len(data) >= _HANDSHAKE.size:
+            return MessageParser.parse_handshake(data)
+        return MessageParser.parse_frame(data)
+
+    @staticmethod
+    def parse_handshake(data):
+        """Parse a handshake message."""
+        if len(data) < _HANDSHAKE.size:
+            raise ValueError("Invalid handshake length")
+        _, _, protocol, reserved, info_hash, peer_id = _HANDSHAKE.unpack_from(data, 0)
+        return Handshake(HANDSHAKE, protocol.decode(), reserved, info_hash, peer_id)
+
+    @staticmethod
+    def parse_frame(data):
+        """
+        Parse one length-prefixed message that is not a handshake.
+
+        Args:
+            data (bytes | bytearray | memoryview): The complete frame.
+
+        Returns:
+            The message object.
+        """
+        length_prefix = _LENGTH.unpack_from(data, 0)[0]
 
         # Keep-alive message (length = 0)
         if length_prefix == 0:
-            return {"type": "keep_alive"}
-        if length_prefix == 19:
-            data = data[4:]
-            pstrlen = struct.unpack("!B", data[:1])[0]
-            protocol, reserved, info_hash, peer_id = struct.unpack(
-                f"!{pstrlen}s8s20s20s", data[1 : 1 + pstrlen + 48]
-            )
-            return {
-                "type": "handshake",
-                "protocol": protocol.decode(),
-                "reserved": reserved,
-                "info_hash": info_hash,
-                "peer_id": peer_id,
-            }
-
-        # Read message ID (1 byte after the length prefix)
-        message_id = struct.unpack("!B", data[4:5])[0]
-
-        # Depending on message_id, interpret the rest of the message
-        message_map = {
-            0: "choke",
-            1: "unchoke",
-            2: "interested",
-            3: "not_interested",
-            4: "have",
-            5: "bitfield",
-            6: "request",
-            7: "piece",
-            8: "cancel",
-            9: "port",
-            10: "dont_have_piece",
-            11: "deny_unchoke",
-            12: "disconnect",
-            13: "start_get_pieces",
-        }
-
-        # Check for valid message ID
-        if message_id not in message_map:
+            return _KEEP_ALIVE_MESSAGE
+        if len(data) < 4 + length_prefix:
+            raise ValueError("Truncated message")
+
+        message_id = data[4]
+        parser = PARSERS.get(message_id)
+        if parser is None:
             print(f"Unknown message ID: {message_id}")
             raise ValueError("Unknown message ID")
+        return parser(data, 4 + length_prefix)
+
+
+# Largest length prefix a reader accepts by default: a 4 MiB block plus its header
+MAX_MESSAGE_SIZE = 4 * 1024 * 1024 + 9
+
+
+class MessageReader:
+    def __init__(self, sock, buffer_size=64 * 1024, max_message_size=MAX_MESSAGE_SIZE):
+        """
+        Reads length-prefixed messages from a socket into one reusable buffer.
+
+        Bytes are received with recv_into straight into a preallocated buffer
+        and every complete frame is parsed in place, so a piece message costs
+        no intermediate copies. Message payloads (piece blocks, bitfields) are
+        memoryviews into that buffer and are only valid until the next read;
+        copy them if they have to live longer.
+
+        Args:
+            sock (socket.socket): The connected socket.
+            buffer_size (int): Initial buffer size, grown to fit the largest message.
+            max_message_size (int): Largest length prefix accepted; a peer
+                announcing a bigger message is treated as a protocol error.
+        """
+        self.sock = sock
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # First unread byte
+        self.end = 0  # End of received data
+        self.last_received = time.monotonic()
+        self.max_message_size = max_message_size
+
+    def _fill(self, size):
+        """
+        Make sure `size` unread bytes are buffered.
+
+        Returns:
+            bool: False if the connection closed first.
+        """
+        if self.end - self.start >= size:
+            return True
+
+        pending = self.end - self.start
+        if size > len(self.buffer):
+            # Grow into a new buffer; views handed out earlier keep the old one alive
+            buffer = bytearray(max(size, 2 * len(self.buffer)))
+            buffer[:pending] = self.view[self.start : self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+            self.start, self.end = 0, pending
+        elif self.start + size > len(self.buffer):
+            # Move the unread tail to the front to make room
+            self.buffer[:pending] = self.view[self.start : self.end]
+            self.start, self.end = 0, pending
+
+        while self.end - self.start < size:
+            received = self.sock.recv_into(self.view[self.end :])
+            if not received:
+                return False
+            self.end += received
+            self.last_received = time.monotonic()
+        return True
+
+    def _take(self, size):
+        frame = self.view[self.start : self.start + size]
+        self.start += size
+        if self.start == self.end:
+            self.start = self.end = 0
+        return frame
+
+    def read_handshake(self):
+        """
+        Read the handshake that opens a connection.
+
+        Returns:
+            Handshake: The message, or None if the connection closed.
+        """
+        if not self._fill(_HANDSHAKE.size):
+            return None
+        return MessageParser.parse_handshake(self._take(_HANDSHAKE.size))
+
+    def read_message(self):
+        """
+        Read the next message.
+
+        Returns:
+            The message object, or None if the connection closed or the peer
+            announced a message over `max_message_size`.
+        """
+        if not self._fill(4):
+            return None
+        length = _LENGTH.unpack_from(self.buffer, self.start)[0]
+        if length > self.max_message_size:
+            # Never buffer it: the prefix alone could ask for 4 GiB
+            print(f"[ERROR] Message of {length} bytes exceeds the {self.max_message_size} byte limit")
+            return None
+        size = 4 + length
+        if not self._fill(size):
+            return None
+        return MessageParser.parse_frame(self._take(size))
+
+
+# Message IDs
+CHOKE = 0
+UNCHOKE = 1
+INTERESTED = 2
+NOT_INTERESTED = 3
+HAVE = 4
+BITFIELD = 5
+REQUEST = 6
+PIECE = 7
+CANCEL = 8
+PORT = 9
+DONT_HAVE_PIECE = 10
+DENY_UNCHOKE = 11
+DISCONNECT = 12
+START_GET_PIECES = 13
+PEX = 14
+# Messages without an ID on the wire
+KEEP_ALIVE = -1
+HANDSHAKE = -2
+
+MESSAGE_NAMES = {
+    CHOKE: "choke",
+    UNCHOKE: "unchoke",
+    INTERESTED: "interested",
+    NOT_INTERESTED: "not_interested",
+    HAVE: "have",
+    BITFIELD: "bitfield",
+    REQUEST: "request",
+    PIECE: "piece",
+    CANCEL: "cancel",
+    PORT: "port",
+    DONT_HAVE_PIECE: "dont_have_piece",
+    DENY_UNCHOKE: "deny_unchoke",
+    DISCONNECT: "disconnect",
+    START_GET_PIECES: "start_get_pieces",
+    PEX: "pex",
+    KEEP_ALIVE: "keep_alive",
+    HANDSHAKE: "handshake",
+}
+
+
+class _Typed:
+    __slots__ = ()
+
+    @property
+    def type(self):
+        """Name of the message, e.g. "piece"."""
+        return MESSAGE_NAMES[self.id]
+
+
+# Message objects are tuples, so building one is a single allocation
+class Message(_Typed, namedtuple("Message", "id")):
+    __slots__ = ()
+
+
+class Handshake(_Typed, namedtuple("Handshake", "id protocol reserved info_hash peer_id")):
+    __slots__ = ()
+
+
+class Have(_Typed, namedtuple("Have", "id piece_index")):
+    __slots__ = ()
+
+
+class Bitfield(_Typed, namedtuple("Bitfield", "id bitfield")):
+    __slots__ = ()
+
+
+class BlockRequest(_Typed, namedtuple("BlockRequest", "id index begin length")):
+    """request, cancel and start_get_pieces share this layout."""
+
+    __slots__ = ()
+
+
+class Piece(_Typed, namedtuple("Piece", "id index begin block")):
+    __slots__ = ()
+
+
+class Port(_Typed, namedtuple("Port", "id listen_port")):
+    __slots__ = ()
+
+
+class PexMessage(_Typed, namedtuple("PexMessage", "id payload")):
+    __slots__ = ()
+
+
+# Messages without payload are immutable, share one instance per ID
+_SIMPLE_MESSAGES = {
+    message_id: Message(message_id)
+    for message_id in (
+        CHOKE,
+        UNCHOKE,
+        INTERESTED,
+        NOT_INTERESTED,
+        DONT_HAVE_PIECE,
+        DENY_UNCHOKE,
+        DISCONNECT,
+    )
+}
+_KEEP_ALIVE_MESSAGE = Message(KEEP_ALIVE)
+
+_INDEX = struct.Struct("!I")
+_INDEX_BEGIN = struct.Struct("!II")
+_THREE_INTS = struct.Struct("!III")
+_LISTEN_PORT = struct.Struct("!H")
+
+
+def _parse_simple(data, end):
+    return _SIMPLE_MESSAGES[data[4]]
+
+
+def _parse_have(data, end):
+    return Have(HAVE, _INDEX.unpack_from(data, 5)[0])
+
+
+def _parse_bitfield(data, end):
+    return Bitfield(BITFIELD, memoryview(data)[5:end])
+
+
+def _parse_block_request(data, end):
+    return BlockRequest(data[4], *_THREE_INTS.unpack_from(data, 5))
+
+
+def _parse_piece(data, end):
+    index, begin = _INDEX_BEGIN.unpack_from(data, 5)
+    return Piece(PIECE, index, begin, memoryview(data)[13:end])
+
+
+def _parse_port(data, end):
+    return Port(PORT, _LISTEN_PORT.unpack_from(data, 5)[0])
+
+
+def _parse_pex(data, end):
+    return PexMessage(PEX, memoryview(data)[5:end])
+
 
-        message_type = message_map[message_id]
-        payload = data[5:]  # Remaining bytes after message_id
-
-        # Parse based on message type
-        if message_type == "have":
-            piece_index = struct.unpack("!I", payload)[0]
-            return {"type": "have", "piece_index": piece_index}
-
-        elif message_type == "bitfield":
-            return {"type": "bitfield", "bitfield": payload}
-        elif message_type == "start_get_pieces":
-            index, begin, length = struct.unpack("!III", payload)
-            return {"type": "start_get_pieces", "index": index, "begin": begin, "length": length}
-        elif message_type == "request":
-            index, begin, length = struct.unpack("!III", payload)
-            return {"type": "request", "index": index, "begin": begin, "length": length}
-
-        elif message_type == "piece":
-            index, begin = struct.unpack("!II", payload[:8])
-            block = payload[8:]
-            return {"type": "piece", "index": index, "begin": begin, "block": block}
-
-        elif message_type == "cancel":
-            index, begin, length = struct.unpack("!III", payload)
-            return {"type": "cancel", "index": index, "begin": begin, "length": length}
-
-        elif message_type == "port":
-            listen_port = struct.unpack("!H", payload)[0]
-            return {"type": "port", "listen_port": listen_port}
-        elif message_type == "dont_have_piece":
-            return {"type": "dont_have_piece"}
-        elif message_type == "deny_unchoke":
-            return {"type": "deny_unchoke"}
-        elif message_type == "disconnect":
-            return {"type": "disconnect"}
-        else:
-            # Messages like choke, unchoke, interested, not_interested
-            return {"type": message_type}
+# Decoder for every message ID: parser(frame, frame end) -> message
+PARSERS = {
+    CHOKE: _parse_simple,
+    UNCHOKE: _parse_simple,
+    INTERESTED: _parse_simple,
+    NOT_INTERESTED: _parse_simple,
+    HAVE: _parse_have,
+    BITFIELD: _parse_bitfield,
+    REQUEST: _parse_block_request,
+    PIECE: _parse_piece,
+    CANCEL: _parse_block_request,
+    PORT: _parse_port,
+    DONT_HAVE_PIECE: _parse_simple,
+    DENY_UNCHOKE: _parse_simple,
+    DISCONNECT: _parse_simple,
+    START_GET_PIECES: _parse_block_request,
+    PEX: _parse_pex,
+}
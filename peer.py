@@ -1,8 +1,19 @@
 from lib import *
+import io
 from torrent import *
 from message import *
 from peerqueue import DownloadQueue
-from piecemanager import PieceManager
+from piecemanager import PieceManager, SKIP
+from diskio import DiskIOManager
+from piececache import PieceCache
+from havebroadcast import HaveBroadcaster
+from connmanager import ConnectionManager
+from reputation import PeerReputation
+from piecepicker import PiecePicker
+from streaming import TorrentStream
+from superseed import SuperSeeder
+from pex import PeerExchange
+from timerwheel import TimerWheel, ConnectionWatchdog
 
 
 class Peer:
@@ -13,6 +24,20 @@ class Peer:
         ip,
         port,
         dir,
+        disk_io=None,
+        piece_cache=None,
+        allocation="sparse",
+        max_connections=30,
+        timer_wheel=None,
+        keep_alive_interval=60,
+        idle_timeout=180,
+        request_timeout=30,
+        file_priorities=None,
+        super_seed=False,
+        pex_interval=60.0,
+        dht=None,
+        dht_interval=15 * 60,
+        lsd=None,
     ):
         self.id = id
         self.ip = ip
@@ -27,27 +52,129 @@ class Peer:
         self.interval = 0
 
         self.dir = dir
+
+        # Disk I/O runs off the network threads; share one subsystem per Network
+        self.owns_disk_io = disk_io is None
+        self.disk_io = disk_io if disk_io is not None else DiskIOManager()
+        self.piece_cache = piece_cache if piece_cache is not None else PieceCache()
+
+        # Every inbound and outbound link holds one worker
+        self.connection_manager = ConnectionManager(id, max_connections=max_connections)
+        self.executor = ThreadPoolExecutor(max_workers=max_connections)
+        # Throttles and bans peers proven to send corrupt blocks
+        self.reputation = PeerReputation(self.connection_manager)
+
         print("INITIALIZING PIECE MANAGER FOR PEER")
-        self.piece_manager = PieceManager(torrent, dir)
+        self.piece_manager = PieceManager(
+            torrent,
+            dir,
+            disk_io=self.disk_io,
+            piece_cache=self.piece_cache,
+            read_ahead=2,
+            allocation=allocation,
+            reputation=self.reputation,
+            file_priorities=file_priorities,
+        )
         print(f"[DEBUG] {self.id} bitfield: {self.piece_manager.get_bitfield()}")
         self.download_queue = DownloadQueue(self.piece_manager.get_total_pieces())
 
+        # Tells connected peers about completed pieces in batches
+        self.have_broadcaster = HaveBroadcaster(
+            self.piece_manager.get_total_pieces(), self.piece_manager.get_bitfield
+        )
+        # An initial seeder may hand out pieces one at a time instead of all at once
+        self.super_seeder = None
+        if super_seed:
+            if all(self.piece_manager.get_bitfield()):
+                self.super_seeder = SuperSeeder(
+                    self.piece_manager.get_total_pieces(), self.have_broadcaster.availability
+                )
+            else:
+                print(f"[WARNING] {self.id} Super-seeding needs every piece, seeding normally")
+        # Streams' deadlines first, then rarest-first from what peers announced
+        self.piece_picker = PiecePicker(
+            self.piece_manager.get_total_pieces(),
+            self.have_broadcaster.availability,
+            self.piece_manager.piece_priorities,
+        )
+
         self.am_choking = 1
         self.am_interested = 0
         self.peer_choking = 1
         self.peer_interested = 0
 
-        self.executor = ThreadPoolExecutor(max_workers=10)
+        # Keep-alives, idle drops and request timeouts all run on one timer wheel
+        self.owns_timer_wheel = timer_wheel is None
+        self.timer_wheel = timer_wheel if timer_wheel is not None else TimerWheel()
+        self.watchdog = ConnectionWatchdog(
+            self.timer_wheel,
+            keep_alive_interval=keep_alive_interval,
+            idle_timeout=idle_timeout,
+        )
+        self.request_timeout = request_timeout
+        self.request_timeouts = 0
+        # Extra rounds for blocks that failed their hash, with block hashes
+        self.block_retries = 2
+        self.handshake_timeout = 10  # Connect and handshake, before the watchdog applies
+        # Re-announce this soon while the tracker knows no other peer
+        self.empty_announce_interval = 5
+
         self.shutdown_event = threading.Event()
 
+        # Set after the first tracker announce, so callers can wait for it
+        self.registered = threading.Event()
+        # Wakes start_clients: new tracker peers, or a link closed and freed a slot
+        self.peers_changed = threading.Event()
+        # Notified when a queued piece leaves the disk queue (saved or rejected)
+        self.piece_available = threading.Condition()
+
+        # Connected peers gossip whom they know, so the tracker is rarely needed
+        self.peer_exchange = PeerExchange(
+            id,
+            port,
+            self.connection_manager,
+            self.timer_wheel,
+            on_peers=self.peers_changed.set,
+            interval=pex_interval,
+        )
+        # An optional DHT node (shared per Network) finds peers without the tracker
+        self.dht = dht
+        self.dht_interval = dht_interval
+        extensions = [RESERVED_PEX]
+        if dht is not None:
+            extensions.append(RESERVED_DHT)
+        self.handshake_reserved = reserved_bytes(*extensions)
+        # Optional multicast discovery of peers on the same LAN (shared per Network)
+        self.lsd = lsd
+
         self.tracker_url = torrent.tracker_url
         self.name = torrent.name
         self.piece_length = torrent.piece_length
+        # Whole pieces are requested, so a piece message may carry one
+        self.max_message_size = max(MAX_MESSAGE_SIZE, 9 + self.piece_length)
         self.info_hash = torrent.info_hash
         self.info = torrent.info
         self.message_factory = MessageFactory()
         self.message_parser = MessageParser()
 
+        # handle_client dispatches incoming messages by ID through this table
+        self.message_handlers = {
+            KEEP_ALIVE: self._on_keep_alive,
+            HAVE: self._on_have,
+            BITFIELD: self._on_bitfield,
+            INTERESTED: self._on_interested,
+            NOT_INTERESTED: self._on_not_interested,
+            REQUEST: self._on_request,
+            START_GET_PIECES: self._on_start_get_pieces,
+            PIECE: self._on_piece,
+            PEX: self._on_pex,
+            PORT: self._on_port,
+            CHOKE: self._on_choke,
+            UNCHOKE: self._on_unchoke,
+            CANCEL: self._on_cancel,
+            DISCONNECT: self._on_disconnect,
+        }
+
         # self._update_is_seeder()
 
     # def _update_is_seeder(self):
@@ -64,40 +191,91 @@ class Peer:
     def register_with_tracker(self):
         try:
             while not self.shutdown_event.is_set():
-                """Register with the tracker and get a list of peers."""
-                data = {
-                    "info_hash": self.info_hash.hex(),
-                    "peer_id": self.id,
-                    "ip": self.ip,
-                    "port": self.port,
-                    "downloaded": self.downloaded,
-                    "uploaded": self.uploaded,
-                    "is_seeder": self.is_seeder,
-                }
+                try:
+                    self._announce_to_tracker()
+                except requests.RequestException as e:
+                    # The tracker is only a hint: keep retrying while the DHT and PEX find peers
+                    print(f"[ERROR] registering with tracker: {e}")
+                    self.interval = self.empty_announce_interval
+
+                self.registered.set()
+
+                # Wait for the next announce, or return at once on shutdown. Peers
+                # learned through PEX make long intervals fine, but alone in the
+                # swarm there is nobody to learn from
+                interval = self.interval
+                if not any(p.get("peer_id") != self.id for p in self.available_peers):
+                    interval = min(interval, self.empty_announce_interval)
+                self.shutdown_event.wait(interval)
+        finally:
+            self.registered.set()
+
+    def _announce_to_tracker(self):
+        """Register with the tracker and get a list of peers."""
+        data = {
+            "info_hash": self.info_hash.hex(),
+            "peer_id": self.id,
+            "ip": self.ip,
+            "port": self.port,
+            "downloaded": self.downloaded,
+            "uploaded": self.uploaded,
+            "is_seeder": self.is_seeder,
+        }
+
+        print(
+            f"[DEBUG] register_with_tracker() {self.id} Registering with tracker: {self.tracker_url + "announce"}"
+        )
+        response = requests.get(self.tracker_url + "announce", json=data)
+
+        # Parse the reponse received from tracker
+        if response.status_code == 200:
+            peer_data = response.json()
+
+            self.available_peers = peer_data.get("peers", [])
+            self.interval = peer_data.get("interval", 0)
+            self.connection_manager.add_candidates(self.available_peers, source="tracker")
+            self.peers_changed.set()
+            # print(
+            #     f"[DEBUG] register_with_tracker() {self.id} Updated available peers: {[(available_peer["peer_id"], available_peer["port"], available_peer["is_seeder"]) for available_peer in self.available_peers]}"
+            # )
+        else:
+            print(
+                f"[ERROR] {self.id} register_with_tracker() Failed to fetch peers. Status code: {response.status_code}"
+            )
 
-                print(
-                    f"[DEBUG] register_with_tracker() {self.id} Registering with tracker: {self.tracker_url + "announce"}"
-                )
-                response = requests.get(self.tracker_url + "announce", json=data)
-
-                # Parse the reponse received from tracker
-                if response.status_code == 200:
-                    peer_data = response.json()
-
-                    self.available_peers = peer_data.get("peers", [])
-                    self.interval = peer_data.get("interval", 0)
-                    # print(
-                    #     f"[DEBUG] register_with_tracker() {self.id} Updated available peers: {[(available_peer["peer_id"], available_peer["port"], available_peer["is_seeder"]) for available_peer in self.available_peers]}"
-                    # )
-                else:
-                    print(
-                        f"[ERROR] {self.id} register_with_tracker() Failed to fetch peers. Status code: {response.status_code}"
-                    )
+    def discover_with_dht(self):
+        """
+        Announce ourselves on the DHT and look up peers, periodically.
 
-                # Sleep for interval
-                time.sleep(self.interval)
-        except requests.RequestException as e:
-            print(f"[ERROR] registering with tracker: {e}")
+        Found peers go to the connection manager like the tracker's. Runs
+        until shutdown; does nothing without a DHT node.
+        """
+        if self.dht is None:
+            return
+        try:
+            while not self.shutdown_event.is_set():
+                try:
+                    peers = self.dht.announce(self.info_hash, self.port, self.id)
+                except Exception as e:
+                    # One bad node must not end discovery for this torrent
+                    print(f"[ERROR] {self.id} DHT announce failed: {e!r}")
+                    peers = []
+                candidates = [
+                    {"ip": ip, "port": port, "peer_id": peer_id}
+                    for ip, port, peer_id in peers
+                    if peer_id != self.id
+                ]
+                learned = self.connection_manager.add_candidates(candidates, source="dht")
+                if learned:
+                    print(f"[INFO] {self.id} Learned {learned} peers through the DHT")
+                    self.peers_changed.set()
+                self.registered.set()
+
+                # Look again soon while nobody else has announced
+                interval = self.dht_interval if candidates else self.empty_announce_interval
+                self.shutdown_event.wait(interval)
+        finally:
+            self.registered.set()
 
     # def get_peers(self):
     #     """Get the list of peers from the tracker"""
@@ -110,14 +288,23 @@ class Peer:
     #     except request.RequestException as e:
     #         print(f"[ERROR] fetching data from tracker: {e}")
 
-    def start_server(self,timeout=100000):
-        """Start the peer server to handle piece requests."""
+    def start_server(self, timeout=None):
+        """
+        Start the peer server to handle piece requests.
+
+        Args:
+            timeout (float): Accept timeout in seconds. By default accept()
+                blocks until a peer connects or shutdown() closes the socket.
+        """
 
         try:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.server_socket.bind((self.ip, self.port))
             self.server_socket.listen()
+            if self.lsd is not None:
+                # Announce once we can be connected to
+                self.lsd.register(self.info_hash, self.port, self.id, self._on_local_peers)
             self.server_socket.settimeout(timeout)
             print(
                 f"[DEBUG] start_server() {self.id} listening on {self.ip}:{self.port}"
@@ -135,60 +322,53 @@ class Peer:
                 except socket.timeout:
                     print(f"[DEBUG] start_server() {self.id} Timeout while waiting for connection")
         except Exception as e:
-            print(f"Error in server: {e}")
+            # shutdown() closing the listening socket ends accept() with an error
+            if not self.shutdown_event.is_set():
+                print(f"Error in server: {e}")
         finally:
             self.server_socket.close()
 
 
+    def _on_local_peers(self, peers):
+        """Peers of our torrent found on the LAN: connect to them right away."""
+        learned = self.connection_manager.add_candidates(peers, source="lsd", local=True)
+        if learned:
+            print(f"[INFO] {self.id} Found {learned} peers on the local network")
+            self.peers_changed.set()
+
     def start_clients(self):
         """Start client threads to connect to available peers and download pieces."""
 
         try:
-            #avoid same ip
             print(
                 f"[DEBUG] start_clients() {self.id} Starting client threads for P2P connections..."
             )
 
-            # Set to track already connected peers
-            connected_peers = set()
-
             while not self.shutdown_event.is_set():
 
-                if not self.available_peers:
+                if not self.connection_manager.has_candidates():
                     print(
                         f"[DEBUG] start_clients() {self.id} No available peers. Waiting for updates..."
                     )
-                    time.sleep(self.interval)  # Wait for registering with tracker
+                    # Woken by the tracker thread or PEX as soon as there are peers
+                    self.peers_changed.wait()
+                    self.peers_changed.clear()
                     continue
-                
-                # Iterate over the list of available peers
-                for peer in self.available_peers:
-                    if self.is_seeder:
-                        continue        
-                    peer_ip = peer.get("ip")
-                    peer_port = peer.get("port")
-                    #avoid same ip
-                    if peer_ip == self.ip:
-                        continue
-                    # peer_key = (peer_ip, peer_port)
-                    peer_key = peer_ip
-
-                    if peer_key in connected_peers:
-                        # Skip already connected peers
-                        continue
-
-                    if peer_ip == self.ip and peer_port == self.port:
-                        # Skip connecting to itself
-                        continue
 
-                    # Mark the peer as connected
-                    connected_peers.add(peer_key)
+                # Nothing to fetch once every wanted file is complete
+                if self.is_seeder or self.piece_manager.is_finished():
+                    # Candidates stay undialed; wait for a file priority change or shutdown
+                    self.peers_changed.wait()
+                    self.peers_changed.clear()
+                    continue
 
+                for peer_key in self.connection_manager.next_to_connect():
                     # Start a thread to handle the connection and download
-                    self.executor.submit(self._connect_and_download, peer_ip, peer_port)
+                    self.executor.submit(self._connect_and_download, peer_key)
 
-                # Sleep briefly to avoid busy-looping
-                time.sleep(self.interval)
+                # Sleep until the peer list changes, a link closes, or a backoff expires
+                self.peers_changed.wait(self.connection_manager.next_retry_in())
+                self.peers_changed.clear()
 
         except Exception as e:
             print(f"[ERROR] start_clients() {self.id} Error in start_clients: {e}")
@@ -198,6 +378,8 @@ class Peer:
 
     def handle_client(self, conn, addr):
         peer_id = addr
+        remote_id = None
+        watch = None
         print(f"[DEBUG] handle_client() {self.id} Accept connection from {addr}")
 
         try:
@@ -208,16 +390,39 @@ class Peer:
             ##                       ##
             ###########################
 
-            # Receive client handshake
-            request = conn.recv(1024)
-            data = self.message_parser.parse_message(request)
-            if data is None or data["type"] != "handshake":
+            # Receive client handshake; the watchdog takes over once it is done
+            conn.settimeout(self.handshake_timeout)
+            reader = MessageReader(conn, max_message_size=self.max_message_size)
+            data = reader.read_handshake()
+            if data is None:
                 print(f"[ERROR] Invalid handshake from {addr}")
                 return
+            conn.settimeout(None)
+
+            # One inbound link per peer, within the connection limit
+            remote_id = data.peer_id.decode(errors="replace")
+            if not self.connection_manager.accept_inbound(remote_id, addr):
+                print(f"[INFO] handle_client() {self.id} Rejecting duplicate or excess link from {addr}")
+                return
 
             # Send server handshake
-            response = self.message_factory.handshake(self.info_hash, self.id.encode())
-            conn.sendall(response)
+            sender = MessageSender(conn)
+            response = self.message_factory.handshake(self.info_hash, self.id.encode(), self.handshake_reserved)
+            sender.sendall(response)
+            pex = supports(data.reserved, RESERVED_PEX)
+
+            # Send our bitfield so the client can skip asking piece by piece;
+            # later completions reach it through the have broadcaster
+            bitfield = self.piece_manager.get_bitfield()
+            if self.super_seeder is not None:
+                # Super-seeding shows a few pieces only and reveals the rest over time
+                bitfield = self.super_seeder.add_peer(peer_id, sender)
+            sender.send_bitfield(bitfield)
+            self.have_broadcaster.add_peer(peer_id, sender, told=bitfield)
+            watch = self.watchdog.watch(sender, reader, addr)
+            if pex:
+                # The listen port arrives with the peer's first pex message
+                self.peer_exchange.add_link(peer_id, sender, addr[0], remote_id)
 
             ##########################
             ##                      ##
@@ -225,160 +430,25 @@ class Peer:
             ##                      ##
             ##########################
 
-            peer_bitfield = None
-
             while True:
                 try:
-                    request = conn.recv(1024)
+                    data = reader.read_message()
 
                     # Handle connection closure
-                    if not request:
+                    if data is None:
                         print(f"[INFO] Connection closed by peer {addr}")
                         break
 
-                    # Parse message
-                    data = self.message_parser.parse_message(request)
-
-                    # Handle error message
-                    if data is None:
-                        print(f"[ERROR] Received invalid message from {addr}")
-                        continue
-
-                    # Handle "keep-alive" message
-                    if data["type"] == "keep-alive":
-                        print(f"[DEBUG] Received keep-alive from {addr}")
-                        continue
-
-                    # Handle "handshake" message
-                    if data["type"] == "handshake":
-                        print(f"[INFO] Received handshake from {addr}")
-                        continue
+                    if self.connection_manager.is_banned(remote_id):
+                        print(f"[INFO] Closing link to banned peer {addr}")
+                        break
 
-                    # Handle "bitfield" message
-                    if data["type"] == "bitfield":
-                        peer_bitfield = data["bitfield"]
-                        peer_bitfield = self.message_factory.bitfield(peer_bitfield)
-                        print(
-                            f"[DEBUG] handle_client() {self.id} Received bitfield from {addr}"
-                        )
-                        print(f"[DEBUG] handle_client() {self.id} bitfield: {peer_bitfield}")
-                        self.download_queue.update_bitfield(peer_id, peer_bitfield)
+                    handler = self.message_handlers.get(data.id)
+                    if handler is None:
+                        print(f"[WARNING] Unexpected {data.type} message from {addr}")
                         continue
-
-                    # Handle "interested" message
-                    if data["type"] == "interested":
-                        self.download_queue.add_interested_peer(peer_id)
-                        if self.download_queue.unchoke_peer(peer_id):
-                            print(
-                                f"[DEBUG] handle_client() {self.id} Unchoked peer at {addr}"
-                            )
-                            unchoke_msg = self.message_factory.unchoke()
-                            conn.sendall(unchoke_msg)
-                        else:
-                            print(
-                                f"[DEBUG] handle_client() {self.id} Can't Unchoked peer at {addr}"
-                            )
-                            deny_msg = self.message_factory.deny_unchoke()
-                            conn.sendall(deny_msg)
-                            continue
-                        
-
-                    # Handle "uninterested" message
-                    elif data["type"] == "uninterested":
-                        self.download_queue.remove_interested_peer(peer_id)
-                        self.download_queue.choke_peer(peer_id)
-                        print(f"[INFO] Choking peer {addr}")
-
-                    # Handle "request" message for a piece
-                    elif data["type"] == "request":
-                        index, begin, length = (
-                            data["index"],
-                            data["begin"],
-                            data["length"],
-                        )
-                        piece_data = self.piece_manager.get_piece(index)
-                        if self.piece_manager.get_bitfield()[index] == 1:
-                            have_piece = self.message_factory.have(index)
-                            conn.sendall(have_piece)
-                            print(f"[DEBUG] handle_client() {self.id} have piece {index} ")
-                        else:
-                            print(f"[DEBUG] handle_client() {self.id} piece {index} not found")
-                            piece_msg = self.message_factory.dont_have_piece()
-                            conn.sendall(piece_msg)
-                    elif data["type"] == "start_get_pieces":
-                        index, begin, length = (
-                            data["index"],
-                            data["begin"],
-                            data["length"],
-                        )
-                        if self.download_queue.capacity < len(self.download_queue.unchoked_peers):
-
-                            deny_msg = self.message_factory.deny_unchoke()
-                            conn.sendall(deny_msg)
-                            print(f"[INFO] Peer {addr} is denied")
-                            continue
-                        if self.download_queue.add_request(
-                            peer_id, index, begin, length
-                        ):
-                            print(
-                                f"[DEBUG] handle_client() {self.id} added request for block {index} from peer {peer_id}"
-                            )
-                            piece_data = self.piece_manager.get_piece(index)
-
-                            if piece_data:
-                                piece_msg = self.message_factory.piece(
-                                    index, begin, piece_data
-                                )
-                                conn.sendall(piece_msg)
-                                self.download_queue.mark_completed(
-                                    peer_id, index, begin
-                                )
-                                print(
-                                    f"[DEBUG] handle_client() {self.id} sent piece {index} to {addr}"
-                                )
-                            else:
-                                print(
-                                    f"[DEBUG] handle_client() {self.id} piece {index} not found"
-                                )
-                                piece_msg = self.message_factory.dont_have_piece()
-                                conn.sendall(piece_msg)
-
-                                # tạo ra một cái protocal nữa ở messgae thông báo là không có piêc đó để leecher nó hỏi piece kahcs
-
-
-                    # Handle "piece" message
-                    elif data["type"] == "piece":
-                        index, begin, block = (
-                            data["index"],
-                            data["begin"],
-                            data["block"],
-                        )
-                        self.piece_manager.save_piece(index, block)
-                        self.download_queue.mark_completed(peer_id, index, begin)
-                        print(f"[INFO] Received block {begin} from {addr}")
-
-                    # Handle "choke" message
-                    elif data["type"] == "choke":
-                        self.download_queue.choke_peer(peer_id)
-                        print(f"[INFO] Peer {addr} choked us")
-
-                    # Handle "unchoke" message
-                    elif data["type"] == "unchoke":
-                        self.download_queue.unchoked_peers.add(peer_id)
-                        print(f"[INFO] Peer {addr} unchoked us")
-
-                    # Handle "cancel" message
-                    elif data["type"] == "cancel":
-                        index, begin, length = (
-                            data["index"],
-                            data["begin"],
-                            data["length"],
-                        )
-                        self.download_queue.cancel_request(peer_id, index, begin)
-                        print(f"[INFO] Cancelled request for block {begin} from {addr}")
-
-                    else:
-                        print(f"[WARNING] Unknown message type from {addr}")
+                    if handler(sender, peer_id, addr, data):
+                        break
 
                 except socket.timeout:
                     print(f"[WARNING] Timeout while waiting for data from {addr}")
@@ -391,11 +461,141 @@ class Peer:
                     break
 
         finally:
+            if watch is not None:
+                self.watchdog.unwatch(watch)
+            if remote_id is not None:
+                self.connection_manager.release_inbound(remote_id, addr)
+            self.have_broadcaster.remove_peer(peer_id)
+            self.peer_exchange.remove_link(peer_id)
+            if self.super_seeder is not None:
+                self.super_seeder.remove_peer(peer_id)
             conn.close()
             self.download_queue.handle_disconnect(peer_id)
-            time.sleep(1)
             print(f"[DEBUG] handle_client {self.id} close connection with {addr}")
 
+    # Message handlers for handle_client, dispatched by message ID through
+    # self.message_handlers. `conn` is the MessageSender of the connection.
+    # A handler returns True to close the connection.
+
+    def _on_keep_alive(self, conn, peer_id, addr, data):
+        print(f"[DEBUG] Received keep-alive from {addr}")
+
+    def _on_have(self, conn, peer_id, addr, data):
+        self.have_broadcaster.record_have(peer_id, data.piece_index)
+        self.download_queue.record_have(peer_id, data.piece_index)
+        if self.super_seeder is not None:
+            self.super_seeder.record_have(peer_id, data.piece_index)
+
+    def _on_bitfield(self, conn, peer_id, addr, data):
+        # The payload is a view into the receive buffer, keep a copy
+        peer_bitfield = bytearray(data.bitfield)
+        print(f"[DEBUG] handle_client() {self.id} Received bitfield from {addr}")
+        print(f"[DEBUG] handle_client() {self.id} bitfield: {peer_bitfield}")
+        self.download_queue.update_bitfield(peer_id, peer_bitfield)
+        self.have_broadcaster.record_bitfield(peer_id, peer_bitfield)
+        if self.super_seeder is not None:
+            self.super_seeder.record_bitfield(peer_id, peer_bitfield)
+
+    def _on_interested(self, conn, peer_id, addr, data):
+        self.download_queue.add_interested_peer(peer_id)
+        if self.download_queue.unchoke_peer(peer_id):
+            print(f"[DEBUG] handle_client() {self.id} Unchoked peer at {addr}")
+            conn.sendall(self.message_factory.unchoke())
+        else:
+            print(f"[DEBUG] handle_client() {self.id} Can't Unchoked peer at {addr}")
+            conn.sendall(self.message_factory.deny_unchoke())
+
+    def _on_not_interested(self, conn, peer_id, addr, data):
+        self.download_queue.remove_interested_peer(peer_id)
+        self.download_queue.choke_peer(peer_id)
+        print(f"[INFO] Choking peer {addr}")
+
+    def _on_request(self, conn, peer_id, addr, data):
+        index = data.index
+        # Only the bitfield is needed to answer, don't touch the disk
+        if self._may_serve(peer_id, index):
+            conn.sendall(self.message_factory.have(index))
+            self.have_broadcaster.record_told(peer_id, index)
+            print(f"[DEBUG] handle_client() {self.id} have piece {index} ")
+        else:
+            print(f"[DEBUG] handle_client() {self.id} piece {index} not found")
+            conn.sendall(self.message_factory.dont_have_piece())
+
+    def _on_start_get_pieces(self, conn, peer_id, addr, data):
+        index, begin, length = data.index, data.begin, data.length
+        if self.download_queue.capacity < len(self.download_queue.unchoked_peers):
+            conn.sendall(self.message_factory.deny_unchoke())
+            print(f"[INFO] Peer {addr} is denied")
+            return
+        if not self._may_serve(peer_id, index) or not self.download_queue.add_request(
+            peer_id, index, begin, length
+        ):
+            # The client waits for an answer either way
+            conn.sendall(self.message_factory.dont_have_piece())
+            return
+        print(
+            f"[DEBUG] handle_client() {self.id} added request for block {index} from peer {peer_id}"
+        )
+        piece_data = self.piece_manager.get_piece(index)
+
+        # Serve the requested range only, e.g. blocks that failed their hash
+        block = memoryview(piece_data)[begin : begin + length] if piece_data else None
+        if block:
+            # Header and block go out in one sendmsg, no copy
+            conn.send_piece(index, begin, block)
+            self.download_queue.mark_completed(peer_id, index, begin)
+            if self.super_seeder is not None:
+                self.super_seeder.served(len(block))
+            print(f"[DEBUG] handle_client() {self.id} sent piece {index} to {addr}")
+        else:
+            print(f"[DEBUG] handle_client() {self.id} piece {index} not found")
+            conn.sendall(self.message_factory.dont_have_piece())
+
+    def _may_serve(self, peer_id, index):
+        """Check whether a piece is ours to upload and, when super-seeding, shown to the peer."""
+        if not 0 <= index < self.piece_manager.total_pieces or self.piece_manager.bitfield[index] != 1:
+            return False
+        return self.super_seeder is None or self.super_seeder.is_revealed(peer_id, index)
+
+    def _on_pex(self, conn, peer_id, addr, data):
+        self.peer_exchange.receive(peer_id, data.payload)
+
+    def _on_port(self, conn, peer_id, addr, data):
+        # The peer runs a DHT node on this UDP port
+        if self.dht is not None and data.listen_port:
+            self.dht.add_node((addr[0], data.listen_port))
+
+    def _on_piece(self, conn, peer_id, addr, data):
+        # Hashed in memory; only a verified piece is queued for the disk. Bad
+        # blocks count against the handshake peer ID, which is what gets banned
+        if self.piece_manager.receive_block(
+            data.index,
+            data.begin,
+            data.block,
+            self._on_piece_saved,
+            owner=peer_id,
+            source=self.connection_manager.inbound_peer_id(addr),
+        ) is False:
+            self._on_hash_failure(data.index, peer_id)
+        self.download_queue.mark_completed(peer_id, data.index, data.begin)
+        print(f"[INFO] Received block {data.begin} from {addr}")
+
+    def _on_choke(self, conn, peer_id, addr, data):
+        self.download_queue.choke_peer(peer_id)
+        print(f"[INFO] Peer {addr} choked us")
+
+    def _on_unchoke(self, conn, peer_id, addr, data):
+        self.download_queue.unchoked_peers.add(peer_id)
+        print(f"[INFO] Peer {addr} unchoked us")
+
+    def _on_cancel(self, conn, peer_id, addr, data):
+        self.download_queue.cancel_request(peer_id, data.index, data.begin)
+        print(f"[INFO] Cancelled request for block {data.begin} from {addr}")
+
+    def _on_disconnect(self, conn, peer_id, addr, data):
+        print(f"[INFO] Peer {addr} disconnected")
+        return True
+
     def get_missing_pieces_from_peer(self, peer_bitfield):
         """
         Determine which pieces the peer has that we are missing.
@@ -424,27 +624,38 @@ class Peer:
             print(f"[ERROR] Error reading piece {index} from {self.shared_dir}: {e}")
             return b""
 
-    def _connect_and_download(self, peer_ip, peer_port):
+    def _connect_and_download(self, peer_key):
         """Handle the connection and download process for a single peer."""
+        peer_ip, peer_port, _ = peer_key
+        clean = False
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-                client_socket.connect((peer_ip, peer_port))
+            with socket.create_connection(
+                (peer_ip, peer_port), timeout=self.handshake_timeout
+            ) as client_socket:
+                self.connection_manager.connected(peer_key)
                 print(
                     f"[DEBUG] _connect_and_download() {self.id} Connected to peer at {peer_ip}:{peer_port}"
                 )
 
                 # Perform the download process
-
-                self.download_piece(client_socket, peer_ip, peer_port)
+                clean = self.download_piece(client_socket, peer_ip, peer_port)
 
         except Exception as e:
             print(f"[ERROR] Failed to connect to peer {peer_ip}:{peer_port}: {e}")
         finally:
             print(f"[DEBUG] _connect_and_download() {self.id} Closing connection to {peer_ip}:{peer_port}")
-            socket.socket(socket.AF_INET, socket.SOCK_STREAM).close()
+            self.connection_manager.disconnected(peer_key, clean)
+            self.peers_changed.set()
 
-    def download_piece(self, client_socket, peer_ip, peer_port,unchoke_retry=5):
-        """Download all pieces sequentially from a peer."""
+    def download_piece(self, client_socket, peer_ip, peer_port):
+        """
+        Download all pieces sequentially from a peer.
+
+        Returns:
+            bool: True if the download finished, False if the session failed.
+        """
+        peer_key = (peer_ip, peer_port)
+        watch = None
         try:
 
             ###########################
@@ -454,17 +665,27 @@ class Peer:
             ###########################
 
             # Send client handshake
-            handshake = self.message_factory.handshake(self.info_hash, self.id.encode())
-            client_socket.sendall(handshake)
+            sender = MessageSender(client_socket)
+            handshake = self.message_factory.handshake(self.info_hash, self.id.encode(), self.handshake_reserved)
+            sender.sendall(handshake)
 
             # Receive server handshake
-            response = client_socket.recv(1024)
-            data = self.message_parser.parse_message(response)
-            if data["type"] != "handshake":
-                return
+            reader = MessageReader(client_socket, max_message_size=self.max_message_size)
+            data = reader.read_handshake()
+            if data is None:
+                return False
+            client_socket.settimeout(None)
+            # Blocks are credited to the peer ID, whatever address it uses
+            remote_id = data.peer_id.decode(errors="replace")
             print(
                 f"[DEBUG] download_piece() {self.id} Handshake with ({peer_ip, peer_port}) completed"
             )
+            watch = self.watchdog.watch(sender, reader, (peer_ip, peer_port))
+            if supports(data.reserved, RESERVED_PEX):
+                self.peer_exchange.add_link(peer_key, sender, peer_ip, remote_id, peer_port)
+            if self.dht is not None and supports(data.reserved, RESERVED_DHT):
+                # Lets the other side's DHT node add ours to its routing table
+                sender.sendall(self.message_factory.port(self.dht.port))
 
             ###########################
             ##                       ##
@@ -472,13 +693,10 @@ class Peer:
             ##                       ##
             ###########################
 
-            # Send client bitfield
-            bitfield_msg = self.message_factory.bitfield(
-                self.piece_manager.get_bitfield()
-            )
-            client_socket.sendall(bitfield_msg)
-
-            time.sleep(0.5)  # Sleep briefly to avoid busy-waiting
+            # Send client bitfield; from now on the broadcaster keeps the peer updated
+            bitfield = self.piece_manager.get_bitfield()
+            sender.send_bitfield(bitfield)
+            self.have_broadcaster.add_peer(peer_key, sender, told=bitfield)
 
             ############################
             ##                        ##
@@ -486,118 +704,347 @@ class Peer:
             ##                        ##
             ############################
 
-
-
-            # Recieve server unchoke
-            while True:  # (maybe unnecessary)
-                # Send client interested
-                if unchoke_retry <= 0:
-                    print(
-                        f"[DEBUG] download_piece() {self.id} Unchoke denied from ({peer_ip, peer_port})"
-                    )
-                    break
-                interested_msg = self.message_factory.interested()
-                client_socket.sendall(interested_msg)
+            # Send client interested and wait for the answer
+            interested_msg = self.message_factory.interested()
+            sender.sendall(interested_msg)
+            print(
+                f"[DEBUG] download_piece() {self.id} Waiting for unchoke from ({peer_ip, peer_port})"
+            )
+            data = self._read_reply(reader, (UNCHOKE, DENY_UNCHOKE), peer_key)
+            if data is None:
+                return False
+            if data.id == DENY_UNCHOKE:
+                # The connection manager retries this peer after a backoff
                 print(
-                    f"[DEBUG] download_piece() {self.id} Waiting for unchoke from ({peer_ip, peer_port})"
+                    f"[DEBUG] download_piece() {self.id} Unchoke denied from ({peer_ip, peer_port})"
                 )
-                response = client_socket.recv(1024)
-                data = self.message_parser.parse_message(response)
-                if data["type"] == "unchoke":
-                    break
-                elif data["type"] == "deny_unchoke":
-                    unchoke_retry -=1
-                    print(
-                        f"[DEBUG] download_piece() {self.id} Waiting for unchoke from ({peer_ip, peer_port}), Retry in 5 seconds"
-                    )
-                    time.sleep(5)
-
-                time.sleep(0.5)  # Sleep briefly to avoid busy-waiting
+                return False
 
             ##########################
             ##                      ##
             ##   STEP 4: DOWNLOAD   ##
             ##                      ##
             ##########################
-            missing_index = 0
-            
+            refused = set()  # Pieces the peer said it doesn't have
+            failed = set()  # Pieces the peer sent corrupt
+
             while True:
 
+                # Throttled peers keep their link but wait to be reconnected
+                if self.connection_manager.is_banned(remote_id):
+                    print(f"[INFO] {self.id} Dropping link to banned peer {peer_key}")
+                    return False
+
                 missing_piece = self.piece_manager.get_next_missing_piece()
-                missing_piece = missing_piece[missing_index:]
 
                 # If no more missing pieces, break the loop
                 if missing_piece is None:
                     print("[INFO] All pieces have been downloaded.")
-                    break
-                if missing_index > len(missing_piece):
-                    time.sleep(2)
+                    # Seeders stop opening download links
+                    self._update_is_seeder()
+                    return True
+
+                missing_piece = self._defer_to_local_peers(self.piece_picker.order(missing_piece), peer_key)
+
+                # Prefer a piece the peer announced, it needs no request round trip
+                index, begin = None, 0
+                for candidate in missing_piece:
+                    # An announcement overrides an earlier refusal, e.g. from a super-seeder
+                    if candidate not in failed and self.have_broadcaster.peer_has(peer_key, candidate):
+                        index = candidate
+                        break
+
+                if index is None:
+                    unasked = [i for i in missing_piece if i not in refused and i not in failed]
+                    # Nothing left to ask this peer for, or only pieces in flight elsewhere
+                    if not unasked:
+                        if not self._wait_for_pieces(reader, peer_key):
+                            break
+                        continue
+                    index = unasked[0]
+
+                # Another connection may have taken it since the list was built
+                if not self.piece_manager.claim_piece(index, peer_key):
                     continue
                 print(
-                    f"[DEBUG] download_piece() {self.id} requesting piece {missing_piece[0]} from ({peer_ip},{peer_port})"
+                    f"[DEBUG] download_piece() {self.id} requesting piece {index} from ({peer_ip},{peer_port})"
                 )
 
-                # Request the next missing piece
-                index, begin = missing_piece[0], 0
-                request_msg = self.message_factory.request(index, begin, self.piece_length)
-                client_socket.sendall(request_msg)
+                # Hand the piece to other connections if this peer is too slow
+                request_timer = self.timer_wheel.schedule(
+                    self.request_timeout, self._request_timed_out, index, peer_key
+                )
 
                 # Step 5: Receive the requested piece
                 try:
-                    response = client_socket.recv(1024)
-                    
-                    piece_data = self.message_parser.parse_message(response)
-
-                    if not response:
-                        print("[ERROR] No response received. Retrying...")
-                        continue
-
-                    if piece_data["type"] == "have":
-                        ack_msg = self.message_factory.start_get_pieces(index, begin, self.piece_length)
-                        client_socket.sendall(ack_msg)
-                        def recv_all(sock, length):
-                            """Utility function to receive a specific number of bytes from the socket."""
-                            data = b""
-                            while len(data) < length:
-                                usual_len = len(data)
-                                packet = sock.recv(length - len(data))
-                                if not packet:
-                                    return None  # Connection closed unexpectedly
-                                data += packet
-                            usual_len = len(data)
-                            print(usual_len)
-                            return data
-
-                        # Usage:
-                        expected_length = 13 + self.piece_manager.get_piece_length(index)
-                        response = recv_all(client_socket, expected_length)
-                        piece_data = self.message_parser.parse_message(response)
-                        print("Saving piece")
-                        self.piece_manager.save_piece(
-                            piece_data["index"], piece_data["block"]
-                        )
-                        self.piece_manager.mark_piece_completed(piece_data["index"])
-
-                        print(
-                            f"[INFO] Successfully downloaded piece {piece_data['index']}"
-                        )
-                    if piece_data["type"] == "dont_have_piece":
+                    if self.have_broadcaster.peer_has(peer_key, index):
+                        data = None
+                    else:
+                        # Ask whether the peer has the next missing piece
+                        request_msg = self.message_factory.request(index, begin, self.piece_length)
+                        sender.sendall(request_msg)
+                        data = self._read_reply(reader, (HAVE, DONT_HAVE_PIECE), peer_key, index)
+                        if data is None:
+                            print("[ERROR] Connection closed while waiting for a piece")
+                            break
+
+                    if data is None or data.id == HAVE:
+                        data, result = self._download_ranges(sender, reader, index, peer_key, remote_id)
+                        if data is None:
+                            print("[ERROR] Connection closed while receiving a piece")
+                            break
+                        if data.id == DENY_UNCHOKE:
+                            print(f"[INFO] Peer {peer_ip} denied the piece request")
+                            break
+
+                    if data.id == PIECE:
+                        if not result:
+                            # Don't take this piece from the same peer again; with
+                            # block hashes its good blocks stay for other peers
+                            failed.add(index)
+                            self._on_hash_failure(index, peer_key)
+                        else:
+                            print(f"[INFO] Successfully downloaded piece {index}")
+                    elif data.id == DONT_HAVE_PIECE:
                         print(
                             f"[INFO] Peer {peer_ip} does not have the requested piece"
                         )
-                        missing_index+=1
+                        refused.add(index)
 
                 except socket.timeout:
                     print("[WARNING] Timeout while receiving piece. Retrying...")
                     continue
+                finally:
+                    request_timer.cancel()
+                    # Saved pieces are pending on the disk queue now, so this
+                    # only gives back pieces that didn't arrive
+                    self._release_piece(index, peer_key)
 
         except Exception as e:
             print(f"[ERROR] Error downloading from {peer_ip}:{peer_port}: {e}")
         finally:
+            if watch is not None:
+                self.watchdog.unwatch(watch)
+            self.have_broadcaster.remove_peer(peer_key)
+            self.peer_exchange.remove_link(peer_key)
+            self.piece_manager.release_claims(peer_key)
             # self._update_is_seeder()
             print(f"[DEBUG] download_piece() UPDATES SEEDER STATUS {self.id} Closing connection to {peer_ip}:{peer_port}")
-            time.sleep(1)
+        return False
+
 
+    def _download_ranges(self, sender, reader, index, peer_key, remote_id):
+        """
+        Fetch the missing ranges of a claimed piece from a peer.
+
+        Without block hashes this is the whole piece in one piece message.
+        With them, only blocks not yet verified are requested, so a piece
+        partly received over another link is completed here, and blocks that
+        fail their hash are requested again up to `block_retries` times.
+
+        Returns:
+            tuple: (last message, receive_block() result). The message is
+            None if the connection closed; the result is True once the piece
+            was verified and queued.
+        """
+        result = None
+        for _ in range(self.block_retries + 1):
+            ranges = self.piece_manager.missing_blocks(index)
+            # The peer answers in order, so all ranges are asked for at once
+            sender.sendall(
+                b"".join(
+                    self.message_factory.start_get_pieces(index, begin, length)
+                    for begin, length in ranges
+                )
+            )
+            for _ in ranges:
+                # Arrives into the reader's buffer in one piece message
+                data = self._read_reply(reader, (PIECE, DONT_HAVE_PIECE, DENY_UNCHOKE), peer_key)
+                if data is None or data.id != PIECE:
+                    return data, result
+                # Hashed straight from the reader's buffer; a verified piece
+                # is queued for one disk write, which blocks only when the
+                # disk queue is full and so throttles this socket
+                result = self.piece_manager.receive_block(
+                    data.index,
+                    data.begin,
+                    data.block,
+                    self._on_piece_saved,
+                    owner=peer_key,
+                    source=remote_id,
+                )
+                if result is False:
+                    return data, result
+            if result or self.piece_manager.block_hashes is None:
+                return data, result
+            print(f"[WARNING] {self.id} Re-fetching bad blocks of piece {index} from {peer_key}")
+        return data, result
+
+    def _read_reply(self, reader, expected, peer_key, index=None):
+        """
+        Read messages until one of the expected IDs arrives.
+
+        Have, bitfield and pex announcements arriving in between are recorded
+        for the peer. A have only counts as the reply if it is for `index`.
+
+        Args:
+            reader (MessageReader): Reader of the connection.
+            expected (tuple[int]): Message IDs that answer the last request.
+            peer_key: Key of the connection in the have broadcaster.
+            index (int): Piece index the last request was about.
+
+        Returns:
+            The message, or None if the connection closed.
+        """
+        while True:
+            data = reader.read_message()
+            if data is None:
+                return None
+            if data.id == HAVE:
+                self.have_broadcaster.record_have(peer_key, data.piece_index)
+                if HAVE in expected and data.piece_index == index:
+                    return data
+            elif data.id == BITFIELD:
+                self.have_broadcaster.record_bitfield(peer_key, data.bitfield)
+            elif data.id == PEX:
+                self.peer_exchange.receive(peer_key, data.payload)
+            elif data.id in expected:
+                return data
+            elif data.id != KEEP_ALIVE:
+                print(f"[WARNING] {self.id} Ignoring unexpected {data.type} message")
+
+    def _defer_to_local_peers(self, pieces, peer_key):
+        """
+        On a link to a remote peer, move pieces a connected LAN peer holds to the back.
+
+        The remote link then fetches what only it can provide, while the
+        faster local links take the rest. Pieces with a deadline keep their
+        place, whoever holds them.
+
+        Args:
+            pieces (list[int]): Missing pieces, most urgent first.
+            peer_key (tuple): (ip, port) of the link.
+        """
+        local = self.connection_manager.connected_local()
+        if not local or peer_key in local:
+            return pieces
+        deadlines = self.piece_picker.deadlines
+        peer_has = self.have_broadcaster.peer_has
+        return sorted(
+            pieces,
+            key=lambda index: index not in deadlines and any(peer_has(key, index) for key in local),
+        )
+
+    def _wait_for_pieces(self, reader, peer_key, timeout=5.0):
+        """
+        Block until there may be something new to download from a peer.
+
+        While our own pieces sit on the disk queue, waits for one of them to
+        finish (a rejected piece becomes missing again). Otherwise waits for
+        the peer to announce a piece on the connection.
+
+        Returns:
+            bool: False if the connection closed or we are shutting down.
+        """
+        if self.shutdown_event.is_set():
+            return False
+        if self.piece_manager.has_pending_pieces():
+            with self.piece_available:
+                self.piece_available.wait(timeout)
+            return True
+
+        sock = reader.sock
+        previous_timeout = sock.gettimeout()
+        sock.settimeout(timeout)
+        try:
+            # Back to the download loop as soon as the peer announces something
+            data = reader.read_message()
+            if data is None:
+                return False
+            if data.id == HAVE:
+                self.have_broadcaster.record_have(peer_key, data.piece_index)
+            elif data.id == BITFIELD:
+                self.have_broadcaster.record_bitfield(peer_key, data.bitfield)
+            elif data.id == PEX:
+                self.peer_exchange.receive(peer_key, data.payload)
+            return True
+        except socket.timeout:
+            return True
+        finally:
+            sock.settimeout(previous_timeout)
+
+    def _release_piece(self, index, peer_key):
+        """Give a claimed piece back and wake downloaders waiting for work."""
+        if self.piece_manager.release_piece(index, peer_key):
+            with self.piece_available:
+                self.piece_available.notify_all()
+
+    def _request_timed_out(self, index, peer_key):
+        """Timer wheel callback: a piece took too long, let other peers fetch it."""
+        if self.piece_manager.release_piece(index, peer_key):
+            print(
+                f"[WARNING] {self.id} Request for piece {index} to {peer_key} timed out, re-queueing"
+            )
+            self.request_timeouts += 1
+            with self.piece_available:
+                self.piece_available.notify_all()
+
+    def _on_hash_failure(self, index, peer_key):
+        """A piece from a peer didn't match its hash; it is missing again."""
+        print(f"[WARNING] {self.id} Piece {index} from {peer_key} failed verification")
+        with self.piece_available:
+            self.piece_available.notify_all()
+
+    def _on_piece_saved(self, index, verified):
+        """Disk worker callback: announce a piece once it is written and verified."""
+        if verified:
+            self.have_broadcaster.piece_completed(index)
+            self.piece_picker.piece_completed(index)
+        with self.piece_available:
+            self.piece_available.notify_all()
+
+    def set_file_priority(self, file_number, priority):
+        """
+        Change the download priority of a file, SKIP (0) to leave it out.
+
+        Args:
+            file_number (int): Index of the file in the torrent.
+            priority (int): SKIP, NORMAL_PRIORITY or higher.
+        """
+        self.piece_manager.set_file_priority(file_number, priority)
+        self._update_is_seeder()
+        # start_clients reconnects if a file was added back
+        self.peers_changed.set()
+        with self.piece_available:
+            self.piece_available.notify_all()
+
+    def open_stream(self, file_number, read_ahead=4, timeout=None):
+        """
+        Open a file of the torrent for reading while it downloads.
+
+        Reads block until their bytes are verified, and the read position
+        steers which pieces are downloaded first.
+
+        Args:
+            file_number (int): Index of the file in the torrent.
+            read_ahead (int): Pieces past the read position to prioritise.
+            timeout (float): Seconds a read may wait, forever by default.
+
+        Returns:
+            io.BufferedReader: Seekable binary file object; close it to drop
+            its priorities.
+        """
+        if self.piece_manager.file_priorities[file_number] == SKIP:
+            raise ValueError(f"File {file_number} is skipped, set its priority first")
+        stream = TorrentStream(
+            self.piece_manager,
+            self.piece_picker,
+            self.piece_available,
+            file_number,
+            read_ahead=read_ahead,
+            timeout=timeout,
+        )
+        return io.BufferedReader(stream, buffer_size=max(io.DEFAULT_BUFFER_SIZE, self.piece_length))
 
     def save_piece(self, file_path, index, data):
         """Save a piece to the file."""
@@ -621,7 +1068,17 @@ class Peer:
 
     def shutdown(self):
         self.shutdown_event.set()
+        if self.lsd is not None:
+            self.lsd.unregister(self.info_hash, self.id)
+        self.peers_changed.set()
+        with self.piece_available:
+            self.piece_available.notify_all()
         self.executor.shutdown(wait=True)
+        self.have_broadcaster.shutdown()
+        if self.owns_timer_wheel:
+            self.timer_wheel.shutdown()
+        if self.owns_disk_io:
+            self.disk_io.shutdown()
         if self.server_socket:
             try:
                 self.server_socket.shutdown(socket.SHUT_RDWR)
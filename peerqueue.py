@@ -115,6 +115,15 @@ class DownloadQueue:
         with self.lock:
             self.bitfield[peer_id] = bitfield
 
+    def record_have(self, peer_id, index):
+        """Mark a piece announced by a peer in its bitfield."""
+        with self.lock:
+            bitfield = self.bitfield.get(peer_id)
+            if bitfield is None:
+                bitfield = self.bitfield[peer_id] = bytearray(self.total_pieces)
+            if 0 <= index < len(bitfield):
+                bitfield[index] = 1
+
     def get_next_request(self):
         """Get the next missing piece to request."""
         with self.lock:
@@ -0,0 +1,250 @@
+import socket
+import struct
+import threading
+import time
+
+import bencode
+from message import MessageFactory
+
+# Compact peer entry: IPv4 address, listen port, peer ID
+_ENTRY = struct.Struct("!4sH20s")
+
+
+def encode_peers(peers):
+    """
+    Pack peers into the compact format of pex messages.
+
+    Args:
+        peers (iterable[tuple]): (ip, port, peer_id) of every peer.
+
+    Returns:
+        bytes: 26 bytes per peer.
+    """
+    entries = []
+    for ip, port, peer_id in peers:
+        try:
+            entries.append(_ENTRY.pack(socket.inet_aton(ip), port, peer_id.encode()))
+        except (OSError, struct.error):
+            continue  # Not an IPv4 address or port
+    return b"".join(entries)
+
+
+def decode_peers(data):
+    """Unpack compact peers, see encode_peers()."""
+    peers = []
+    for offset in range(0, len(data) - len(data) % _ENTRY.size, _ENTRY.size):
+        ip, port, peer_id = _ENTRY.unpack_from(data, offset)
+        peers.append((socket.inet_ntoa(ip), port, peer_id.rstrip(b"\x00").decode(errors="replace")))
+    return peers
+
+
+class _PexLink:
+    """Peer exchange state of one connection."""
+
+    __slots__ = ("sender", "ip", "peer_id", "address", "sent", "timer", "last_received")
+
+    def __init__(self, sender, ip, peer_id, address):
+        self.sender = sender
+        self.ip = ip  # Address the connection comes from
+        self.peer_id = peer_id
+        self.address = address  # (ip, listen port, peer_id) once known
+        self.sent = set()  # Peers the other side was told about
+        self.timer = None
+        self.last_received = None
+
+
+class PeerExchange:
+    def __init__(
+        self,
+        own_peer_id,
+        own_port,
+        connection_manager,
+        timer_wheel,
+        on_peers=None,
+        interval=60.0,
+        max_added=50,
+    ):
+        """
+        Peer exchange (PEX): connected peers tell each other whom they are connected to.
+
+        Peers that set RESERVED_PEX in their handshake send a pex message
+        right after it, listing the peers they are connected to and their own
+        listen port, then at most once per `interval` only what changed: peers
+        added and dropped since the last message. Learned peers go to the
+        connection manager next to the tracker's, so new peers are found
+        through the swarm and the tracker can be asked much less often.
+
+        Args:
+            own_peer_id (str): Our peer ID, never passed on.
+            own_port (int): Our listen port, so inbound peers can be passed on.
+            connection_manager (ConnectionManager): Receives learned peers.
+            timer_wheel (TimerWheel): Schedules the periodic messages.
+            on_peers (callable): Called after new peers were learned.
+            interval (float): Seconds between two messages on a connection.
+            max_added (int): Peers listed as added in one message at most.
+        """
+        self.own_peer_id = own_peer_id
+        self.own_port = own_port
+        self.connection_manager = connection_manager
+        self.timer_wheel = timer_wheel
+        self.on_peers = on_peers
+        self.interval = interval
+        self.max_added = max_added
+        self.message_factory = MessageFactory()
+
+        self.links = {}  # {key: _PexLink}
+        self.lock = threading.Lock()
+
+        self.messages_sent = 0
+        self.messages_received = 0
+        self.messages_ignored = 0
+        self.peers_learned = 0
+
+    def add_link(self, key, sender, ip, peer_id, listen_port=None):
+        """
+        Start exchanging peers over a connection whose other side supports PEX.
+
+        Args:
+            key: Unique key of the connection.
+            sender (MessageSender): Used to write pex messages.
+            ip (str): Address of the other side.
+            peer_id (str): Peer ID of the other side.
+            listen_port (int): Its listen port, if known (outbound links);
+                inbound peers report it in their pex messages.
+        """
+        address = (ip, listen_port, peer_id) if listen_port is not None else None
+        with self.lock:
+            old = self.links.get(key)
+            self.links[key] = _PexLink(sender, ip, peer_id, address)
+        if old is not None and old.timer is not None:
+            old.timer.cancel()
+        # On the link's own thread, so the first message may wait for the socket
+        self._send(key, blocking=True)
+
+    def remove_link(self, key):
+        """Stop exchanging peers over a connection."""
+        with self.lock:
+            link = self.links.pop(key, None)
+        if link is not None and link.timer is not None:
+            link.timer.cancel()
+
+    def connected_peers(self):
+        """Get (ip, port, peer_id) of every connected peer whose listen address is known."""
+        with self.lock:
+            return {link.address for link in self.links.values() if link.address is not None}
+
+    def _send(self, key, blocking=False):
+        """
+        Send the changes since the last message on a link, and schedule the next one.
+
+        Runs on the timer wheel unless `blocking`, so it never waits for a
+        socket another thread is writing to: the message is retried on the
+        next tick instead.
+        """
+        with self.lock:
+            link = self.links.get(key)
+            if link is None:
+                return
+            current = {
+                link_.address
+                for link_ in self.links.values()
+                if link_.address is not None and link_.address[2] != link.peer_id
+            }
+            added = sorted(current - link.sent)[: self.max_added]
+            dropped = sorted(link.sent - current)
+            first = link.timer is None
+
+        if first or added or dropped:
+            payload = bencode.encode(
+                {
+                    b"added": encode_peers(added),
+                    b"dropped": encode_peers(dropped),
+                    b"port": self.own_port,
+                }
+            )
+            message = self.message_factory.pex(payload)
+            if blocking:
+                try:
+                    link.sender.sendall(message)
+                except OSError as e:
+                    print(f"[DEBUG] PEX dropping {key}: {e}")
+                    self.remove_link(key)
+                    return
+            elif not link.sender.try_sendall(message):
+                # Busy or closed; a closed link is removed by its own thread
+                with self.lock:
+                    if self.links.get(key) is link:
+                        link.timer = self.timer_wheel.schedule(self.timer_wheel.tick, self._send, key)
+                return
+
+        with self.lock:
+            if first or added or dropped:
+                link.sent = (link.sent - set(dropped)) | set(added)
+                self.messages_sent += 1
+            if self.links.get(key) is link:
+                link.timer = self.timer_wheel.schedule(self.interval, self._send, key)
+
+    def receive(self, key, payload):
+        """
+        Handle a pex message from a connection.
+
+        Args:
+            key: Key of the connection.
+            payload (bytes): The bencoded message body.
+        """
+        now = time.monotonic()
+        with self.lock:
+            link = self.links.get(key)
+            if link is None:
+                return
+            # The first message comes right after the handshake, then one per interval
+            if link.last_received is not None and now - link.last_received < self.interval / 2:
+                self.messages_ignored += 1
+                return
+            link.last_received = now
+
+        try:
+            message = bencode.decode(payload)
+            if not isinstance(message, dict):
+                raise ValueError("not a dictionary")
+            added = message.get(b"added", b"")
+            port = message.get(b"port")
+            if not isinstance(added, bytes):
+                raise ValueError("added is not a string")
+            if not isinstance(message.get(b"dropped", b""), bytes):
+                raise ValueError("dropped is not a string")
+            added = decode_peers(added)
+        except (ValueError, OSError) as e:
+            print(f"[WARNING] Ignoring malformed pex message from {key}: {e}")
+            return
+
+        with self.lock:
+            self.messages_received += 1
+            if isinstance(port, int) and 0 < port < 65536 and link.address is None:
+                link.address = (link.ip, port, link.peer_id)
+            if link.address is not None:
+                added.append(link.address)
+
+        candidates = [
+            {"ip": ip, "port": port, "peer_id": peer_id}
+            for ip, port, peer_id in added
+            if peer_id != self.own_peer_id and port
+        ]
+        learned = self.connection_manager.add_candidates(candidates, source="pex")
+        if learned:
+            with self.lock:
+                self.peers_learned += learned
+            print(f"[INFO] Learned {learned} peers through PEX from {key}")
+            if self.on_peers is not None:
+                self.on_peers()
+
+    def get_stats(self):
+        """Get peer exchange metrics."""
+        with self.lock:
+            return {
+                "links": len(self.links),
+                "messages_sent": self.messages_sent,
+                "messages_received": self.messages_received,
+                "messages_ignored": self.messages_ignored,
+                "peers_learned": self.peers_learned,
+            }
@@ -0,0 +1,100 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class PieceCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        """
+        Size-bounded LRU cache of verified piece data.
+
+        Seeding the same piece to many leechers then costs one disk read instead
+        of one per request. The cache can be shared by several PieceManagers, so
+        entries are keyed by (owner, index).
+
+        Args:
+            max_bytes (int): Memory cap for cached piece data. 0 disables caching.
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # {key: bytes}, least recently used first
+        self.size = 0
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetched = 0
+
+    def get(self, key):
+        """Get cached data for a key, or None on a miss."""
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def contains(self, key):
+        """Check whether a key is cached without touching the statistics."""
+        with self.lock:
+            return key in self.entries
+
+    def put(self, key, data, prefetch=False):
+        """
+        Insert data, evicting least recently used entries to stay under the cap.
+
+        Args:
+            key: Cache key, usually (owner, piece index).
+            data (bytes): The piece data.
+            prefetch (bool): True when the data was loaded by read-ahead.
+        """
+        if not data or len(data) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = data
+            self.size += len(data)
+            if prefetch:
+                self.prefetched += 1
+
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Drop a cached entry."""
+        with self.lock:
+            data = self.entries.pop(key, None)
+            if data is not None:
+                self.size -= len(data)
+
+    def clear(self):
+        """Drop every cached entry."""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def hit_ratio(self):
+        """Get the fraction of lookups served from memory."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return self.hits / lookups if lookups else 0.0
+
+    def get_stats(self):
+        """Get cache metrics."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "prefetched": self.prefetched,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+            }
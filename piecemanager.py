@@ -1,182 +1,216 @@
 import os
 import hashlib
-import bencodepy
+import threading
+from fileindex import FileOffsetIndex
+from torrent import PieceHashes
+
+# How target files are created when a torrent is added:
+#   sparse - create every file at its final size without reserving blocks
+#   full   - reserve all blocks up front with posix_fallocate
+#   none   - create files lazily on the first write
+ALLOCATION_MODES = ("sparse", "full", "none")
+
+# File priorities: pieces of higher priority files are downloaded first,
+# and pieces only made of skipped files are not downloaded at all
+SKIP = 0
+NORMAL_PRIORITY = 1
+
+
+class IncomingPiece:
+    """A piece being received; blocks are hashed as they arrive, in order."""
+
+    __slots__ = ("index", "length", "owner", "hasher", "blocks", "sources", "received")
+
+    def __init__(self, index, length, owner=None):
+        self.index = index
+        self.length = length
+        self.owner = owner
+        self.hasher = hashlib.sha1()
+        self.blocks = []
+        self.sources = []  # [(begin, length, source)], who sent each block
+        self.received = 0
+
+    def add_block(self, begin, block, source=None):
+        """
+        Hash and keep the next block of the piece.
+
+        Returns:
+            bool: False if the block is not the next one in order.
+        """
+        if begin != self.received or self.received + len(block) > self.length:
+            return False
+        self.hasher.update(block)
+        # Blocks usually live in a reusable receive buffer, keep a copy
+        self.blocks.append(bytes(block))
+        self.sources.append((begin, len(block), source))
+        self.received += len(block)
+        return True
+
+    def is_complete(self):
+        return self.received == self.length
+
+    def data(self):
+        return self.blocks[0] if len(self.blocks) == 1 else b"".join(self.blocks)
+
+
+class BlockVerifiedPiece:
+    """
+    A piece of a torrent with block hashes; each block is checked on arrival.
+
+    Blocks may come in any order and from several connections. A block that
+    doesn't match its leaf hash is left missing and remembered in `failed`,
+    so only that block is fetched again and its sender is known.
+    """
+
+    __slots__ = ("index", "length", "owner", "block_hashes", "buffer", "have", "sources", "received", "failed")
+
+    def __init__(self, index, length, block_hashes, owner=None):
+        self.index = index
+        self.length = length
+        self.owner = owner
+        self.block_hashes = block_hashes
+        self.buffer = bytearray(length)
+        self.have = bytearray(block_hashes.blocks_in_piece(index))
+        self.sources = [None] * len(self.have)  # Connection each block came from
+        self.received = 0
+        self.failed = []  # [(block, source)] of blocks that failed their hash
+
+    def add_block(self, begin, block, source=None):
+        """
+        Verify and keep the whole blocks covered by a received range.
+
+        Returns:
+            bool: False if the range is not aligned to blocks.
+        """
+        block_size = self.block_hashes.block_size
+        end = begin + len(block)
+        if begin % block_size or end > self.length or (end % block_size and end != self.length):
+            return False
+        view = memoryview(block)
+        for number in range(begin // block_size, -(-end // block_size)):
+            offset = number * block_size - begin
+            data = view[offset : offset + block_size]
+            if self.have[number]:
+                continue
+            if not self.block_hashes.block_matches(self.index, number, data):
+                self.failed.append((number, source))
+                continue
+            start = number * block_size
+            self.buffer[start : start + len(data)] = data
+            self.have[number] = 1
+            self.sources[number] = source
+            self.received += len(data)
+        return True
+
+    def missing_ranges(self):
+        """Get the (begin, length) ranges still missing, adjacent blocks merged."""
+        ranges = []
+        for number, have in enumerate(self.have):
+            if have:
+                continue
+            begin, length = self.block_hashes.block_range(self.index, number)
+            if ranges and ranges[-1][0] + ranges[-1][1] == begin:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+            else:
+                ranges.append((begin, length))
+        return ranges
+
+    def is_complete(self):
+        return self.received == self.length
+
+    def data(self):
+        return self.buffer
 
 
 class PieceManager:
-    def __init__(self, torrent_file, file_dir):
+    def __init__(
+        self,
+        torrent_file,
+        file_dir,
+        disk_io=None,
+        piece_cache=None,
+        read_ahead=0,
+        allocation="sparse",
+        reputation=None,
+        file_priorities=None,
+    ):
         """
         Initialize the PieceManager with a .torrent file and download directory.
 
         Args:
             torrent_file (str): Path to the .torrent file.
             dir (str): Directory where the files will be saved/to upload.
+            disk_io (DiskIOManager): Optional background disk I/O subsystem used
+                by save_piece_async(). Pieces are saved inline when omitted.
+            piece_cache (PieceCache): Optional read cache for verified pieces.
+            read_ahead (int): Number of following pieces to load into the cache
+                on a cache miss.
+            allocation (str): Storage allocation mode, one of ALLOCATION_MODES.
+            reputation (PeerReputation): Optional smart-ban, told who sent the
+                blocks of pieces that fail their hash.
+            file_priorities (list[int]): Priority of every file in torrent
+                order, NORMAL_PRIORITY by default. Files with priority SKIP
+                are neither downloaded nor created on disk.
         """
+        if allocation not in ALLOCATION_MODES:
+            raise ValueError(f"Unknown allocation mode: {allocation}")
         self.torrent_file = torrent_file
         self.file_dir = file_dir
+        self.disk_io = disk_io
+        self.piece_cache = piece_cache
+        self.read_ahead = read_ahead
+        self.reputation = reputation
+        self.pending_pieces = set()  # Pieces queued for writing, not yet verified
+        self.claimed_pieces = {}  # {index: owner}, pieces being downloaded
+        self.incoming = {}  # {index: IncomingPiece}, partly received pieces
+        self.hash_failures = 0
+        self.block_failures = 0
+        self.bad_block_sources = {}  # {owner: blocks that failed their hash}
+        self.pending_lock = threading.Lock()
         self.bitfield = []
         self.completed_pieces = set()
         self.piece_length = 0
         self.total_pieces = 0
-        self.pieces_hash = []
-        self.pieces_dict = {}
-        self.pieces_dict_origin = {}
-        self.local_pieces_dict = {}
+        self.piece_hashes = PieceHashes(b"")
+        self.block_hashes = None  # BlockHashes if the torrent has per-block hashes
+        self.file_index = None
         self.files = []
+        self.allocation = allocation
+        self.file_sizes = {}  # {path: length}
+        self.allocated_files = set()
+        self.allocation_lock = threading.Lock()
+        self.file_priorities = []
+        self.piece_priorities = []  # Highest priority of the files in each piece
+        self.partfile = ""
+        self.partfile_paths = set()  # Skipped files whose bytes go to the partfile
         self._load_torrent()
+        self._init_file_priorities(file_priorities)
+        self._allocate_files()
         self._map_pieces_to_files()
-        self._map_local_pieces_to_files()   
+        self._update_piece_priorities()
         self._initialize_bitfield()
     def _map_pieces_to_files(self):
         """
-        Map torrent pieces to their original files, tracking the file, length, and offset 
-        for each piece across multiple files.
+        Build the piece-to-file index. A piece may span several files; the
+        segments of a piece are resolved on demand from cumulative file offsets
+        instead of being stored per piece.
         """
-        piece_length = self.piece_length
-        self.pieces_dict_origin = {}
-
-        file_index = 0
-        file_offset = 0
-        
-        for piece_index in range(self.total_pieces):
-            # Reset piece-specific tracking for each piece
-            piece_remaining = piece_length
-            piece_origins = []
-
-            # Continue until we've filled the entire piece
-            while piece_remaining > 0 and file_index < len(self.files):
-                current_file = self.files[file_index]
-                file_name = current_file["path"]
-                file_length = current_file["length"]
-
-                # Calculate how much we can take from the current file
-                available_in_file = file_length - file_offset
-                take_from_file = min(piece_remaining, available_in_file)
-
-                if take_from_file > 0:
-                    # Add file contribution to this piece
-                    piece_origins.append({
-                        "file": file_name,
-                        "length": take_from_file,
-                        "offset": file_offset,
-                    })
-
-                    # Update tracking variables
-                    piece_remaining -= take_from_file
-                    file_offset += take_from_file
-
-                # Move to next file if current file is exhausted
-                if file_offset >= file_length:
-                    file_index += 1
-                    file_offset = 0
-
-            # Store the piece origins
-            self.pieces_dict_origin[piece_index] = piece_origins
-
+        self.file_index = FileOffsetIndex(self.files, self.piece_length)
         print(f"[INFO] Mapped {self.total_pieces} pieces to their origin files.")
-        return self.pieces_dict_origin
-    def _map_local_pieces_to_files(self):
-        """
-        Maps local pieces to their origin files, tracking the file, length, and offset 
-        for each piece across multiple local files.
-        5 piece, mot so file, 1 piêc sẽ map qua các file, ánh xạ 1-n
-        1- file1, file2
-        2- file2 (continue), file3
-        sẽ có ofset để biết đọc từ đâu
-        piece leng mặc định là 512kb = 1024*512
-        sẽ có file bị segment, lỗi, nó sẽ skip cái piece đó lun
-        đó, mất file r, nó skip piêc lun
-        ví dụ sai file , nó sẽ hash để so sánh, nếu sai nó skip lun
-        """
-        piece_length = self.piece_length
-        self.local_pieces_dict = {}
-
-        file_index = 0
-        file_offset = 0
-        
-        for piece_index in range(self.total_pieces):
-            # Reset piece-specific tracking for each piece
-            piece_remaining = piece_length
-            piece_origins = []
-            if file_index >= len(self.files):
-                print(f"[ERROR] No more files available. Skipping piece {piece_index}.")
-                break
-            if not os.path.exists(self.files[file_index]["path"]):
-                print(f"[ERROR] File {self.files[file_index]["path"]} does not exist.Skipping piece {piece_index}.")
-                if piece_index+1 < self.total_pieces:
-                    file_offset += self.pieces_dict_origin[piece_index+1][0]['offset']
-                    file_index+=1
-                    continue    
-                else:
-                    print(f"[ERROR] File {self.files[file_index]["path"]} does not exist.Skipping piece {piece_index}.")
-                    break
-
-            # Continue until we've filled the entire piece
-            piece_data = b""
-            while piece_remaining > 0 and file_index < len(self.files):
-                current_file = self.files[file_index]
-                file_name = current_file["path"]
-                if not os.path.exists(self.files[file_index]["path"]):
-                    break
-                file_length = current_file["length"]
-
-                # Calculate how much we can take from the current file
-                available_in_file = file_length - file_offset
-                take_from_file = min(piece_remaining, available_in_file)
-
-                piece_remaining -= take_from_file
-                if take_from_file > 0:
-                    # Add file contribution to this piece
-                    piece_origins.append({
-                        "file": file_name,
-                        "length": take_from_file,
-                        "offset": file_offset,
-                    })
-
-                    # Open the file and read the piece
-                    with open(file_name, 'rb') as file:
-                        file.seek(file_offset)
-                        piece_data += file.read(take_from_file)
-                        if piece_data and piece_remaining == 0:
-                            expected_hash = self.pieces_hash[piece_index * 20 : (piece_index + 1) * 20]
-                            actual_hash = hashlib.sha1(piece_data).digest()
-                            if actual_hash != expected_hash:
-                                print(f"[ERROR] Piece {piece_index} is corrupted. Skipping.")
-                                # remove the last file contribution
-                                if len(piece_origins) > 0:
-                                    piece_origins.pop()
-                                file_offset += self.pieces_dict_origin[piece_index+1][0]['offset']
-                                continue
-
-                    # Update tracking variables
-                    file_offset += take_from_file
-
-                # Move to next file if current file is exhausted
-                if file_offset >= file_length:
-                    file_index += 1
-                    file_offset = 0
-
-            # Store the piece origins
-            self.local_pieces_dict[piece_index] = piece_origins
-
-        print(f"[INFO] Mapped {self.total_pieces} local pieces to their origin files.")
-        return self.local_pieces_dict
-
-
-
+        return self.file_index
 
     def _load_torrent(self):
         """Load metadata from the .torrent file."""
         try:
             torrent_data = self.torrent_file.json_torrent
-            print(f"[INFO] Loading torrent file: {torrent_data}")
+            print(f"[INFO] Loading torrent file: {self.torrent_file.torrent_file}")
             # Extract essential metadata
             self.piece_length = torrent_data[b"info"][b"piece length"]
-            self.pieces_hash = torrent_data[b"info"][b"pieces"]
-            print(f"[INFO] Piece length: {self.piece_length}, Pieces hash: {self.pieces_hash}")
-            self.total_pieces = (
-                len(self.pieces_hash) // 20
-            )  # SHA1 hash size is 20 bytes
+            # Digest table shared with the Torrent, backed by the .torrent file bytes
+            self.piece_hashes = self.torrent_file.piece_hashes
+            self.total_pieces = len(self.piece_hashes)
+            self.block_hashes = getattr(self.torrent_file, "block_hashes", None)
+            print(f"[INFO] Piece length: {self.piece_length}, Pieces: {self.total_pieces}")
 
             # Load files information
             if b"files" in torrent_data[b"info"]:
@@ -216,19 +250,55 @@ class PieceManager:
                 self.completed_pieces.add(index)
     def get_piece_length(self,index):
         """Get the length of each piece."""
-        return sum(self.pieces_dict_origin[index][i]['length'] for i in range(len(self.pieces_dict_origin[index])))
+        return self.file_index.piece_size(index)
     def is_piece_complete(self, index):
         """Check if a specific piece is already downloaded."""
-        piece_data = self.get_piece(index)
+        piece_data = self._read_piece(index)
         if piece_data:
-            expected_hash = self.pieces_hash[index * 20 : (index + 1) * 20]
-            actual_hash = hashlib.sha1(piece_data).digest()
-            return actual_hash == expected_hash
+            return self.piece_hashes.matches(index, hashlib.sha1(piece_data).digest())
         return False
 
     def get_piece(self, index):
         """
-        Retrieve a piece by its index, handling multiple files and file offsets.
+        Retrieve a piece by its index, serving verified pieces from the read cache.
+
+        Args:
+            index (int): The index of the piece to retrieve.
+
+        Returns:
+            bytes: The data for the requested piece, or None if an error occurs.
+        """
+        if self.piece_cache is None or self.bitfield[index] != 1:
+            return self._read_piece(index)
+
+        piece_data = self.piece_cache.get((id(self), index))
+        if piece_data is not None:
+            return piece_data
+
+        piece_data = self._read_piece(index)
+        if piece_data:
+            self.piece_cache.put((id(self), index), piece_data)
+            self._schedule_read_ahead(index)
+        return piece_data
+
+    def _schedule_read_ahead(self, index):
+        """Load the pieces following `index` into the cache on a disk worker."""
+        if self.read_ahead <= 0 or self.disk_io is None:
+            return
+        for next_index in range(index + 1, min(index + 1 + self.read_ahead, self.total_pieces)):
+            if self.bitfield[next_index] == 1 and not self.piece_cache.contains((id(self), next_index)):
+                self.disk_io.submit_read(self._prefetch_piece, next_index)
+
+    def _prefetch_piece(self, index):
+        if self.piece_cache.contains((id(self), index)):
+            return
+        piece_data = self._read_piece(index)
+        if piece_data:
+            self.piece_cache.put((id(self), index), piece_data, prefetch=True)
+
+    def _read_piece(self, index):
+        """
+        Read a piece from disk, handling multiple files and file offsets.
         
         Args:
             index (int): The index of the piece to retrieve.
@@ -237,104 +307,435 @@ class PieceManager:
             bytes: The data for the requested piece, or None if an error occurs.
         """
         try:
-            # Retrieve the piece information from the local_pieces_dict
-            piece_info = self.local_pieces_dict.get(index)
-            if not piece_info:
-                print(f"[ERROR] get_piece() - Piece {index} not found in local_pieces_dict.")
+            segments = self._piece_segments(index)
+            if not segments:
+                print(f"[ERROR] get_piece() - Piece {index} does not exist.")
                 return None
 
-
-            piece_data = b""
-            if not piece_info:
-                print(f"[ERROR] get_piece() - Piece {index} not found in local_pieces_dict.")
-                return None
-            for file_info in piece_info:
-                file_path = file_info["file"]
-                file_length = file_info["length"]
-                offset = file_info["offset"]
-                
+            parts = []
+            for file_path, offset, length in segments:
                 if not os.path.exists(file_path):
                     print(f"[ERROR] get_piece() - File {file_path} does not exist.")
                     return None  # If any file doesn't exist, return None for the whole piece
 
-
                 with open(file_path, "rb") as file:
                     file.seek(offset)
+                    parts.append(file.read(length))
 
-                    # Calculate how much data we can read from this file
-
-                    data = file.read(file_length)
-
-                    # Add the data to the cumulative piece data
-                    piece_data += data
-
-            return piece_data
+            return b"".join(parts)
 
         except Exception as e:
             print(f"[ERROR] get_piece() - Error occurred while retrieving piece {index}: {e}")
             return None
 
+    def split_piece(self, index, data):
+        """
+        Split piece data into the file segments it belongs to.
 
+        Args:
+            index (int): The index of the piece.
+            data (bytes): The piece data.
 
-    def save_piece(self, index, data):
+        Yields:
+            tuple: (file_path, offset, chunk) for each file the piece spans.
         """
-        Save a downloaded piece to the appropriate file(s), creating files if necessary.
+        view = memoryview(data)
+        position = 0
+        for file_path, offset, length in self._piece_segments(index):
+            yield file_path, offset, view[position : position + length]
+            position += length
+
+    def _piece_segments(self, index):
+        """
+        Get the file segments of a piece as stored on disk.
+
+        Segments of skipped files that were never created live in the
+        partfile instead, at their offset in the torrent byte stream. Only
+        pieces shared with a wanted file are written, so the sparse partfile
+        holds little more than the boundary pieces.
+        """
+        segments = self.file_index.piece_segments(index)
+        if not self.partfile_paths:
+            return segments
+        routed = []
+        position = index * self.piece_length
+        for file_path, offset, length in segments:
+            if file_path in self.partfile_paths:
+                routed.append((self.partfile, position, length))
+            else:
+                routed.append((file_path, offset, length))
+            position += length
+        return routed
+
+    def _init_file_priorities(self, file_priorities):
+        if file_priorities is None:
+            file_priorities = [NORMAL_PRIORITY] * len(self.files)
+        if len(file_priorities) != len(self.files):
+            raise ValueError(f"Expected {len(self.files)} file priorities, got {len(file_priorities)}")
+        self.file_priorities = list(file_priorities)
+        name = self.torrent_file.name or "torrent"
+        self.partfile = os.path.join(self.file_dir, f".{name}.parts")
+        self.partfile_paths = {
+            file_data["path"]
+            for file_data, priority in zip(self.files, self.file_priorities)
+            if priority == SKIP
+        }
+
+    def _update_piece_priorities(self):
+        """Give every piece the highest priority of the files it holds data of."""
+        priorities = [SKIP] * self.total_pieces
+        for file_number, priority in enumerate(self.file_priorities):
+            for index in self.file_index.file_pieces(file_number):
+                if priority > priorities[index]:
+                    priorities[index] = priority
+        # Updated in place, the piece picker holds a reference
+        self.piece_priorities[:] = priorities
+
+    def set_file_priority(self, file_number, priority):
+        """
+        Change the priority of a file, SKIP to stop downloading it.
+
+        A skipped file that was never created keeps its share of boundary
+        pieces in the partfile; when it is wanted again, those bytes are moved
+        into the file.
 
         Args:
-            index (int): The index of the piece.
-            data (bytes): The data to save.
+            file_number (int): Index of the file in the torrent.
+            priority (int): SKIP, NORMAL_PRIORITY or higher.
         """
-        # Retrieve the piece info from the local_pieces_dict
-        piece_info = self.pieces_dict_origin.get(index)
-        if piece_info is None:
-            print(f"[ERROR] Piece index {index} does not exist in local_pieces_dict.")
+        path = self.files[file_number]["path"]
+        with self.allocation_lock:
+            self.file_priorities[file_number] = priority
+            self._update_piece_priorities()
+            if priority == SKIP:
+                if path not in self.allocated_files:
+                    self.partfile_paths.add(path)
+                return
+            if path not in self.partfile_paths:
+                return
+            # Read the verified boundary pieces while they still map to the partfile
+            pieces = [
+                (index, self._read_piece(index))
+                for index in self.file_index.file_pieces(file_number)
+                if self.bitfield[index] == 1
+            ]
+            self.partfile_paths.discard(path)
+
+        self.prepare_file(path)
+        for index, data in pieces:
+            if not data:
+                continue
+            with open(path, "r+b") as file:
+                for file_path, offset, chunk in self.split_piece(index, data):
+                    if file_path == path:
+                        file.seek(offset)
+                        file.write(chunk)
+        print(f"[INFO] Moved {len(pieces)} pieces of {path} out of the partfile")
+
+    def is_wanted(self, index):
+        """Check whether a piece holds data of a file that is not skipped."""
+        return self.piece_priorities[index] != SKIP
+
+    def is_finished(self):
+        """Check whether every wanted piece is downloaded."""
+        return all(
+            self.bitfield[index] == 1 or priority == SKIP
+            for index, priority in enumerate(self.piece_priorities)
+        )
+
+    def _allocate_files(self):
+        """Index file sizes and create every target file according to the allocation mode."""
+        self.file_sizes = {file_data["path"]: file_data["length"] for file_data in self.files}
+        if self.allocation == "none":
+            return
+        for file_path in self.file_sizes:
+            if file_path in self.partfile_paths:
+                continue
+            try:
+                self.prepare_file(file_path)
+            except OSError as e:
+                print(f"[ERROR] Failed to allocate {file_path}: {e}")
+        print(f"[INFO] Allocated {len(self.allocated_files)} files ({self.allocation}).")
+
+    def prepare_file(self, file_path):
+        """Make sure a target file (and its directory) exists before writing to it."""
+        if file_path in self.allocated_files:
             return
 
-        # Iterate over the list of file information for the piece
-        for file_info in piece_info:
-            file_path = file_info["file"]
-            piece_length = file_info["length"]
-            offset = file_info["offset"]
+        with self.allocation_lock:
+            if file_path in self.allocated_files:
+                return
 
             # Ensure the directory for the file exists
             os.makedirs(os.path.dirname(file_path), exist_ok=True)
 
-            # Find the total size of the file associated with this piece
-            file_size = None
-            for file_data in self.files:
-                if file_data["path"] == file_path:
-                    file_size = file_data["length"]
-                    break
+            size = None if self.allocation == "none" else self.file_sizes.get(file_path)
+            fd = os.open(file_path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+            try:
+                # Never shrink an existing file, only extend it to its final size
+                if size is not None and os.fstat(fd).st_size < size:
+                    self._reserve(fd, file_path, size)
+            finally:
+                os.close(fd)
+
+            self.allocated_files.add(file_path)
+
+    def _reserve(self, fd, file_path, size):
+        """Grow an open file to `size` bytes, either sparse or fully allocated."""
+        if self.allocation == "full" and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, size)
+                return
+            except OSError as e:
+                print(f"[WARNING] posix_fallocate failed for {file_path}, falling back to sparse: {e}")
+        os.ftruncate(fd, size)
+
+    def save_piece(self, index, data, verified=False):
+        """
+        Save a downloaded piece to the appropriate file(s), creating files if necessary.
+
+        Args:
+            index (int): The index of the piece.
+            data (bytes): The data to save.
+            verified (bool): The data was already checked against the piece
+                hash, so it is not read back after writing.
+        """
+        if not 0 <= index < self.total_pieces:
+            print(f"[ERROR] Piece index {index} does not exist.")
+            return
 
-            # If the file doesn't exist, create it and set its size
-            if not os.path.exists(file_path):
-                with open(file_path, "wb") as f:
-                    if file_size is not None:
-                        f.truncate(file_size)
+        if self.piece_cache is not None:
+            self.piece_cache.invalidate((id(self), index))
+
+        for file_path, offset, chunk in self.split_piece(index, data):
+            self.prepare_file(file_path)
 
             # Open the file in read and write binary mode
             with open(file_path, "r+b") as file:
                 # Move to the correct starting position within the file
                 file.seek(offset)
+                file.write(chunk)
 
-                # Write the data to the correct position in the file
-                data_to_write = data[:piece_length]
-                file.write(data_to_write)
-
-                # Remove the written part from the data
-                data = data[piece_length:]
-
-            # After writing, if all data has been written, break out of the loop
-            if len(data) == 0:
-                break
-        self._map_local_pieces_to_files()
-
+        if verified:
+            self.mark_piece_completed(index)
+            print(f"[DEBUG] Saved verified piece {index}, length: {len(data)}")
         # Mark as complete and verify the saved piece
-        if not self.verify_piece(index):
+        elif not self.verify_piece(index):
             print(f"[ERROR] Piece {index} failed verification after saving.")
         else:
             print(f"[DEBUG] Saved and verified piece {index}, length: {len(data)}")
 
+    def save_piece_async(self, index, data, callback=None, verified=False):
+        """
+        Queue a downloaded piece on the disk I/O subsystem.
+
+        The write and the verification run on a disk worker; the piece counts as
+        pending (neither missing nor complete) until then. Blocks while the disk
+        queue is full, which throttles the calling network thread.
+
+        Args:
+            index (int): The index of the piece.
+            data (bytes): The data to save.
+            callback (callable): Called as callback(index, verified) when done.
+            verified (bool): The data already matched the piece hash; the worker
+                then writes it without reading it back.
+        """
+        if self.disk_io is None:
+            self.save_piece(index, data, verified)
+            if callback:
+                callback(index, self.bitfield[index] == 1)
+            return
+
+        with self.pending_lock:
+            if index in self.pending_pieces or self.bitfield[index] == 1:
+                print(f"[DEBUG] Piece {index} is already saved or queued, ignoring.")
+                return
+            self.pending_pieces.add(index)
+
+        if self.piece_cache is not None:
+            self.piece_cache.invalidate((id(self), index))
+
+        if not self.disk_io.submit_piece(self, index, data, callback, verified):
+            self.finish_pending_piece(index)
+
+    def receive_block(self, index, begin, block, callback=None, owner=None, source=None):
+        """
+        Take a received block, verifying the piece in memory before it hits the disk.
+
+        Blocks are fed to an incremental SHA-1 as they arrive. Once the piece is
+        complete its digest is checked against the torrent, and only a matching
+        piece is queued for writing, as already verified data. A mismatch drops
+        the piece and any claim on it, so the scheduler fetches it again.
+
+        With block hashes, every block is checked against its leaf instead. A
+        bad block is dropped alone and stays missing (see missing_blocks()),
+        and the blocks already verified are kept even if another connection
+        takes the piece over. A piece whose blocks all matched their leaves
+        matches its root, so it is queued without hashing it again.
+
+        Args:
+            index (int): The index of the piece.
+            begin (int): Offset of the block inside the piece.
+            block (bytes | memoryview): The block data.
+            callback (callable): Passed to save_piece_async().
+            owner: The connection the block came from, holding the claim.
+            source: The peer credited with the block, `owner` by default.
+
+        Returns:
+            bool | None: None while the piece is incomplete, True once it was
+            verified and queued, False if it failed verification or the block
+            was out of order (not aligned to blocks, with block hashes).
+        """
+        if not 0 <= index < self.total_pieces:
+            print(f"[ERROR] Piece index {index} does not exist.")
+            return False
+        if source is None:
+            source = owner
+
+        with self.pending_lock:
+            piece = self.incoming.get(index)
+            if piece is None or (piece.owner != owner and self.block_hashes is None):
+                if self.block_hashes is not None:
+                    piece = BlockVerifiedPiece(index, self.get_piece_length(index), self.block_hashes, owner)
+                else:
+                    piece = IncomingPiece(index, self.get_piece_length(index), owner)
+                self.incoming[index] = piece
+            piece.owner = owner
+
+        if self.block_hashes is not None:
+            if not piece.add_block(begin, block, source):
+                print(f"[ERROR] Unaligned block {begin} of piece {index}, ignoring it.")
+                return False
+            self._record_bad_blocks(piece)
+        elif not piece.add_block(begin, block, source):
+            print(f"[ERROR] Unexpected block {begin} of piece {index}, dropping the piece.")
+            self._reject_piece(piece, hash_failed=False)
+            return False
+        if not piece.is_complete():
+            return None
+
+        with self.pending_lock:
+            if self.incoming.get(index) is piece:
+                del self.incoming[index]
+
+        if self.block_hashes is None and not self.piece_hashes.matches(index, piece.hasher.digest()):
+            print(f"[ERROR] Piece {index} failed hash check on receive.")
+            self._reject_piece(piece)
+            return False
+
+        data = piece.data()
+        if self.reputation is not None:
+            # Good data convicts whoever sent different blocks before
+            self.reputation.piece_passed(index, data)
+        self.save_piece_async(index, data, callback, verified=True)
+        return True
+
+    def _record_bad_blocks(self, piece):
+        """Count the blocks of a piece that failed their hash, per sender."""
+        with self.pending_lock:
+            failed, piece.failed = piece.failed, []
+            counts = {}
+            for number, source in failed:
+                self.block_failures += 1
+                self.bad_block_sources[source] = self.bad_block_sources.get(source, 0) + 1
+                counts[source] = counts.get(source, 0) + 1
+        for number, source in failed:
+            print(f"[ERROR] Block {number} of piece {piece.index} from {source} failed hash check.")
+        if self.reputation is not None:
+            for source, count in counts.items():
+                self.reputation.bad_blocks(source, piece.index, count)
+
+    def missing_blocks(self, index):
+        """
+        Get the byte ranges of a piece that still have to be downloaded.
+
+        Without block hashes a piece is always fetched whole.
+
+        Returns:
+            list[tuple]: (begin, length) ranges, in order.
+        """
+        with self.pending_lock:
+            piece = self.incoming.get(index)
+            if isinstance(piece, BlockVerifiedPiece):
+                return piece.missing_ranges()
+        return [(0, self.get_piece_length(index))]
+
+    def _reject_piece(self, piece, hash_failed=True):
+        """Forget a piece that failed verification so it is downloaded again."""
+        with self.pending_lock:
+            if self.incoming.get(piece.index) is piece:
+                del self.incoming[piece.index]
+            if piece.owner is not None and self.claimed_pieces.get(piece.index) == piece.owner:
+                del self.claimed_pieces[piece.index]
+            if hash_failed:
+                self.hash_failures += 1
+        if hash_failed and self.reputation is not None:
+            self.reputation.piece_failed(piece.index, piece.data(), piece.sources)
+
+    def has_pending_pieces(self):
+        """Check whether any piece is still being downloaded or queued for writing."""
+        with self.pending_lock:
+            return bool(self.pending_pieces or self.claimed_pieces)
+
+    def claim_piece(self, index, owner):
+        """
+        Reserve a missing piece for one download, so others don't fetch it too.
+
+        Args:
+            index (int): The index of the piece.
+            owner: The connection downloading it.
+
+        Returns:
+            bool: False if the piece is done, queued or claimed by someone else.
+        """
+        with self.pending_lock:
+            if (
+                self.bitfield[index] == 1
+                or index in self.pending_pieces
+                or self.claimed_pieces.get(index, owner) != owner
+            ):
+                return False
+            self.claimed_pieces[index] = owner
+            return True
+
+    def release_piece(self, index, owner=None):
+        """
+        Give up a claim, e.g. when the download failed or timed out.
+
+        Args:
+            index (int): The index of the piece.
+            owner: Only release the claim if it belongs to this owner.
+
+        Returns:
+            bool: True if a claim was released.
+        """
+        with self.pending_lock:
+            if index not in self.claimed_pieces:
+                return False
+            if owner is not None and self.claimed_pieces[index] != owner:
+                return False
+            del self.claimed_pieces[index]
+            self._drop_incoming(index)
+            return True
+
+    def release_claims(self, owner):
+        """Give up every claim of an owner, e.g. when its connection closes."""
+        with self.pending_lock:
+            for index in [i for i, o in self.claimed_pieces.items() if o == owner]:
+                del self.claimed_pieces[index]
+            for index in [i for i, piece in self.incoming.items() if piece.owner == owner]:
+                self._drop_incoming(index)
+
+    def _drop_incoming(self, index):
+        """Forget a partly received piece, unless its blocks were verified one by one."""
+        if not isinstance(self.incoming.get(index), BlockVerifiedPiece):
+            self.incoming.pop(index, None)
+
+    def finish_pending_piece(self, index):
+        """Drop a piece from the pending set once its disk job has finished."""
+        with self.pending_lock:
+            self.pending_pieces.discard(index)
+
     def verify_piece(self, index):
         """
         Verify a specific piece by its index.
@@ -345,18 +746,15 @@ class PieceManager:
         Returns:
             bool: True if the piece is verified, False otherwise.
         """
-        # Retrieve the piece data using the existing get_piece() method
-        piece_data = self.get_piece(index)
+        # Read the piece back from disk, never from the cache
+        piece_data = self._read_piece(index)
         if not piece_data:
             print(f"[ERROR] Could not read piece {index}")
             return False
 
-        # Calculate the SHA-1 hash of the piece
-        expected_hash = self.pieces_hash[index * 20 : (index + 1) * 20]  # Assuming 20-byte hashes
+        # Calculate the SHA-1 hash of the piece and compare it in place
         actual_hash = hashlib.sha1(piece_data).digest()
-
-        # Compare the actual hash with the expected hash
-        if actual_hash == expected_hash:
+        if self.piece_hashes.matches(index, actual_hash):
             self.mark_piece_completed(index)
             print(f"[INFO] Verified piece {index} successfully.")
             return True
@@ -368,7 +766,6 @@ class PieceManager:
         """Mark a specific piece as completed."""
         self.bitfield[index] = 1
         self.completed_pieces.add(index)
-        self._map_local_pieces_to_files()
         print(f"[INFO] Piece {index} marked as completed")
 
     def verify_all_pieces(self):
@@ -387,10 +784,16 @@ class PieceManager:
 
     def get_next_missing_piece(self):
         """Get the next missing piece to download."""
-        missing_pieces = [i for i in range(self.total_pieces) if self.bitfield[i] == 0]
+        with self.pending_lock:
+            busy = self.pending_pieces.union(self.claimed_pieces)
+        # Pieces made only of skipped files are never downloaded
+        missing_pieces = [
+            i for i in range(self.total_pieces) if self.bitfield[i] == 0 and self.piece_priorities[i] != SKIP
+        ]
         print(f"[DEBUG] Missing pieces: {self.bitfield}")
         if missing_pieces:
-            return missing_pieces
+            # Pieces being downloaded or waiting on the disk queue are neither missing nor done
+            return [i for i in missing_pieces if i not in busy]
         else:
             print(f"[INFO] All pieces have been downloaded!")
             return None
@@ -0,0 +1,112 @@
+import threading
+import time
+
+
+class PiecePicker:
+    def __init__(self, total_pieces, availability=None, priorities=None):
+        """
+        Decides in which order missing pieces are downloaded.
+
+        Pieces with a deadline come first, earliest deadline first: they are
+        what a streaming reader is blocked on or about to read. Everything
+        else goes by piece priority (see PieceManager.set_file_priority()),
+        then rarest-first, so pieces few peers hold are spread before those
+        peers leave; ties go to the lower index, which keeps a swarm with
+        uniform availability downloading sequentially.
+
+        Deadlines are set per owner (e.g. one per open stream) and a piece
+        uses the earliest one, so readers of the same file don't undo each
+        other's deadlines.
+
+        Args:
+            total_pieces (int): Number of pieces in the torrent.
+            availability (list[int]): Live count of peers holding each piece,
+                e.g. HaveBroadcaster.availability. Without it only deadlines
+                and the index decide.
+            priorities (list[int]): Live priority of each piece, higher first,
+                e.g. PieceManager.piece_priorities.
+        """
+        self.total_pieces = total_pieces
+        self.availability = availability
+        self.priorities = priorities
+        self.owner_deadlines = {}  # {owner: {index: monotonic deadline}}
+        self.deadlines = {}  # {index: earliest deadline of any owner}
+        self.lock = threading.Lock()
+
+        self.deadlines_met = 0
+        self.deadlines_missed = 0
+
+    def set_deadlines(self, owner, deadlines):
+        """
+        Replace the deadlines of an owner.
+
+        Args:
+            owner: Whoever needs the pieces, e.g. a stream.
+            deadlines (dict): {index: time.monotonic() deadline}.
+        """
+        with self.lock:
+            if deadlines:
+                self.owner_deadlines[owner] = dict(deadlines)
+            else:
+                self.owner_deadlines.pop(owner, None)
+            self._merge()
+
+    def clear_deadlines(self, owner):
+        """Drop every deadline of an owner."""
+        self.set_deadlines(owner, None)
+
+    def _merge(self):
+        merged = {}
+        for deadlines in self.owner_deadlines.values():
+            for index, deadline in deadlines.items():
+                if deadline < merged.get(index, float("inf")):
+                    merged[index] = deadline
+        self.deadlines = merged
+
+    def order(self, candidates):
+        """
+        Sort pieces by download priority.
+
+        Args:
+            candidates (list[int]): Missing pieces that may be requested.
+
+        Returns:
+            list[int]: The same pieces, most urgent first.
+        """
+        deadlines = self.deadlines  # Replaced, never mutated, so no lock needed
+        availability = self.availability
+        priorities = self.priorities
+
+        def priority(index):
+            deadline = deadlines.get(index)
+            if deadline is not None:
+                return (0, deadline, index)
+            return (
+                1,
+                -priorities[index] if priorities else 0,
+                availability[index] if availability else 0,
+                index,
+            )
+
+        return sorted(candidates, key=priority)
+
+    def piece_completed(self, index):
+        """Count whether a piece with a deadline arrived in time."""
+        deadline = self.deadlines.get(index)
+        if deadline is None:
+            return
+        with self.lock:
+            if time.monotonic() <= deadline:
+                self.deadlines_met += 1
+            else:
+                self.deadlines_missed += 1
+
+    def get_stats(self):
+        """Get deadline metrics."""
+        with self.lock:
+            return {
+                "deadlines": len(self.deadlines),
+                "streams": len(self.owner_deadlines),
+                "deadlines_met": self.deadlines_met,
+                "deadlines_missed": self.deadlines_missed,
+            }
@@ -0,0 +1,147 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from merkle import BLOCK_SIZE
+
+
+class PeerReputation:
+    def __init__(
+        self,
+        connection_manager=None,
+        ban_threshold=2,
+        throttle_delay=30.0,
+        block_size=BLOCK_SIZE,
+        max_suspect_pieces=256,
+    ):
+        """
+        Smart-ban: finds the peers that send corrupt data and shuts them out.
+
+        When a piece fails its hash, the digest of every block is kept with
+        the peer that supplied it. Once the piece has been downloaded again
+        and verified, each kept block is compared with the good data; peers
+        whose blocks differ are proven culprits, the others are cleared.
+        With per-block hashes the sender of a bad block is known right away
+        and reported through bad_blocks().
+
+        Each piece a peer is proven to have corrupted is a strike. A peer is
+        throttled through the connection manager on its first strike and
+        banned at `ban_threshold` strikes.
+
+        Args:
+            connection_manager (ConnectionManager): Receives throttles and bans.
+            ban_threshold (int): Strikes after which a peer is banned.
+            throttle_delay (float): Seconds a peer with strikes isn't reconnected to.
+            block_size (int): Granularity at which failed pieces are compared.
+            max_suspect_pieces (int): Failed pieces remembered at most; the
+                oldest are forgotten first.
+        """
+        self.connection_manager = connection_manager
+        self.ban_threshold = ban_threshold
+        self.throttle_delay = throttle_delay
+        self.block_size = block_size
+        self.max_suspect_pieces = max_suspect_pieces
+
+        # {index: [(begin, length, digest, source)]}, blocks of failed attempts
+        self.suspects = OrderedDict()
+        self.strikes = {}  # {source: pieces it was proven to have corrupted}
+        self.lock = threading.Lock()
+
+        self.pieces_failed = 0
+        self.culprits_found = 0
+        self.cleared = 0
+
+    def piece_failed(self, index, data, sources):
+        """
+        Remember who sent what for a piece that failed its hash.
+
+        Args:
+            index (int): The index of the piece.
+            data (bytes): The data that failed verification.
+            sources (list[tuple]): (begin, length, source) of every received range.
+        """
+        view = memoryview(data)
+        blocks = []
+        for begin, length, source in sources:
+            if source is None:
+                continue
+            for offset in range(begin, begin + length, self.block_size):
+                end = min(offset + self.block_size, begin + length)
+                blocks.append((offset, end - offset, hashlib.sha1(view[offset:end]).digest(), source))
+
+        with self.lock:
+            self.pieces_failed += 1
+            self.suspects.setdefault(index, []).extend(blocks)
+            self.suspects.move_to_end(index)
+            while len(self.suspects) > self.max_suspect_pieces:
+                self.suspects.popitem(last=False)
+
+    def piece_passed(self, index, data):
+        """
+        Compare a verified piece with its failed attempts to find the culprits.
+
+        Args:
+            index (int): The index of the piece.
+            data (bytes): The verified data.
+
+        Returns:
+            set: Sources that sent corrupt blocks of this piece.
+        """
+        with self.lock:
+            blocks = self.suspects.pop(index, None)
+        if not blocks:
+            return set()
+
+        view = memoryview(data)
+        culprits = {}
+        innocent = set()
+        for begin, length, digest, source in blocks:
+            if hashlib.sha1(view[begin : begin + length]).digest() != digest:
+                culprits[source] = culprits.get(source, 0) + 1
+            else:
+                innocent.add(source)
+
+        innocent -= culprits.keys()
+        with self.lock:
+            self.cleared += len(innocent)
+        for source, count in culprits.items():
+            print(f"[WARNING] Peer {source} sent {count} corrupt blocks of piece {index}")
+            self._strike(source)
+        return set(culprits)
+
+    def bad_blocks(self, source, index, count=1):
+        """Blocks failed their own hash, so their sender is a proven culprit."""
+        if source is None:
+            return
+        print(f"[WARNING] Peer {source} sent {count} corrupt blocks of piece {index}")
+        self._strike(source)
+
+    def _strike(self, source):
+        with self.lock:
+            strikes = self.strikes.get(source, 0) + 1
+            self.strikes[source] = strikes
+            self.culprits_found += 1
+        if self.connection_manager is None:
+            return
+        if strikes >= self.ban_threshold:
+            if strikes == self.ban_threshold:
+                print(f"[WARNING] Banning peer {source} after {strikes} corrupt pieces")
+            self.connection_manager.ban(source)
+        else:
+            print(f"[INFO] Throttling peer {source} for {self.throttle_delay:.0f}s")
+            self.connection_manager.throttle(source, self.throttle_delay)
+
+    def get_strikes(self, source):
+        with self.lock:
+            return self.strikes.get(source, 0)
+
+    def get_stats(self):
+        """Get smart-ban metrics."""
+        with self.lock:
+            return {
+                "pieces_failed": self.pieces_failed,
+                "suspect_pieces": len(self.suspects),
+                "culprits_found": self.culprits_found,
+                "peers_with_strikes": len(self.strikes),
+                "cleared": self.cleared,
+            }
@@ -0,0 +1,146 @@
+import io
+import time
+
+
+class TorrentStream(io.RawIOBase):
+    def __init__(
+        self,
+        piece_manager,
+        piece_picker,
+        piece_available,
+        file_number,
+        read_ahead=4,
+        deadline_step=0.5,
+        timeout=None,
+    ):
+        """
+        Read-only, seekable file object over one file of a torrent being downloaded.
+
+        A read blocks until every piece under the requested range is verified,
+        then reads the bytes straight from the target file. Each read sets
+        deadlines on the piece picker: the pieces under the read position are
+        due within `deadline_step` seconds and the next `read_ahead` pieces
+        one step apart after them, so downloads follow the reader while
+        rarest-first fills in the rest.
+
+        Use Peer.open_stream() rather than creating streams directly.
+
+        Args:
+            piece_manager (PieceManager): Storage of the torrent.
+            piece_picker (PiecePicker): Receives the deadlines.
+            piece_available (threading.Condition): Notified when a piece is saved.
+            file_number (int): Index of the file in the torrent.
+            read_ahead (int): Pieces past the read position given a deadline.
+            deadline_step (float): Seconds between read-ahead deadlines.
+            timeout (float): Seconds a read waits for data before raising
+                TimeoutError, forever by default.
+        """
+        super().__init__()
+        self.piece_manager = piece_manager
+        self.piece_picker = piece_picker
+        self.piece_available = piece_available
+        self.read_ahead = read_ahead
+        self.deadline_step = deadline_step
+        self.timeout = timeout
+
+        file_index = piece_manager.file_index
+        self.path = file_index.paths[file_number]
+        self.start = file_index.offsets[file_number]  # Offset of the file in the torrent
+        self.length = file_index.lengths[file_number]
+        self.piece_length = file_index.piece_length
+        self.position = 0
+        self.file = None  # Opened once the first bytes are verified
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.length + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self.position = position
+        return position
+
+    def available(self):
+        """Get the number of verified bytes from the read position on, readable without blocking."""
+        bitfield = self.piece_manager.bitfield
+        position = self.start + self.position
+        end = self.start + self.length
+        index = position // self.piece_length
+        while position < end and bitfield[index] == 1:
+            index += 1
+            position = index * self.piece_length
+        return max(0, min(position, end) - self.start - self.position)
+
+    def readinto(self, buffer):
+        """Read into a buffer, blocking until the bytes are verified."""
+        if self.closed:
+            raise ValueError("I/O operation on closed stream")
+        size = min(len(buffer), self.length - self.position)
+        if size <= 0:
+            return 0
+
+        begin = self.start + self.position
+        first = begin // self.piece_length
+        last = (begin + size - 1) // self.piece_length
+        self._set_deadlines(first, last)
+        self._wait_for_pieces(first, last)
+
+        if self.file is None:
+            self.file = open(self.path, "rb", buffering=0)
+        self.file.seek(self.position)
+        count = self.file.readinto(memoryview(buffer)[:size])
+        self.position += count
+        return count
+
+    def _set_deadlines(self, first, last):
+        """Make the pieces of the current read due first and the next ones after them."""
+        bitfield = self.piece_manager.bitfield
+        now = time.monotonic()
+        due = now + self.deadline_step
+        deadlines = {index: due for index in range(first, last + 1) if bitfield[index] != 1}
+        end = min(last + 1 + self.read_ahead, self.piece_manager.total_pieces)
+        for step, index in enumerate(range(last + 1, end), 2):
+            if bitfield[index] != 1:
+                deadlines[index] = now + step * self.deadline_step
+        self.piece_picker.set_deadlines(self, deadlines)
+        if deadlines:
+            # Download loops idle on this condition pick up the new priorities
+            with self.piece_available:
+                self.piece_available.notify_all()
+
+    def _wait_for_pieces(self, first, last):
+        bitfield = self.piece_manager.bitfield
+        with self.piece_available:
+            ready = self.piece_available.wait_for(
+                lambda: self.closed or all(bitfield[i] == 1 for i in range(first, last + 1)),
+                self.timeout,
+            )
+        if self.closed:
+            raise ValueError("Stream closed while waiting for data")
+        if not ready:
+            raise TimeoutError(f"Pieces {first}-{last} of {self.path} not available in time")
+
+    def close(self):
+        if self.closed:
+            return
+        self.piece_picker.clear_deadlines(self)
+        if self.file is not None:
+            self.file.close()
+        super().close()
+        # Wake a read blocked in another thread
+        with self.piece_available:
+            self.piece_available.notify_all()
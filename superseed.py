@@ -0,0 +1,199 @@
+import threading
+
+from message import MessageFactory
+
+
+class SuperSeeder:
+    def __init__(self, total_pieces, availability=None, pieces_per_peer=1):
+        """
+        Super-seeding: an initial seeder hides its pieces and hands them out one at a time.
+
+        Every connected peer is shown only `pieces_per_peer` pieces, each a
+        different rare piece that no other peer is being offered. A peer is
+        shown its next piece once the one it was given is announced by
+        another peer, i.e. it was uploaded onward rather than just consumed,
+        so the seeder sends each piece about once. If the peer that was
+        given a piece is the only one still lacking it elsewhere, the next
+        piece is revealed as soon as it announces having it.
+
+        Once every piece has been seen in the swarm there is a full
+        distributed copy; the seeder then reveals everything and seeds
+        normally.
+
+        Args:
+            total_pieces (int): Number of pieces in the torrent.
+            availability (list[int]): Live count of connected peers holding
+                each piece, e.g. HaveBroadcaster.availability.
+            pieces_per_peer (int): Pieces offered to a peer at a time.
+        """
+        self.total_pieces = total_pieces
+        self.availability = availability
+        self.pieces_per_peer = pieces_per_peer
+        self.message_factory = MessageFactory()
+
+        self.active = True
+        self.senders = {}  # {key: MessageSender}
+        self.has = {}  # {key: bytearray, 1 for pieces the peer holds}
+        self.revealed = {}  # {key: set of pieces ever shown to the peer}
+        self.offered = {}  # {index: key}, pieces waiting to spread from a peer
+        self.seen = bytearray(total_pieces)  # Pieces some peer has announced
+        self.times_offered = [0] * total_pieces
+        self.lock = threading.Lock()
+
+        self.pieces_revealed = 0
+        self.bytes_served = 0
+
+    def add_peer(self, key, sender):
+        """
+        Start handing out pieces to a connection.
+
+        Args:
+            key: Unique key of the connection.
+            sender (MessageSender): Used to reveal pieces later.
+
+        Returns:
+            bytearray: The bitfield to send the peer instead of our real one.
+        """
+        bitfield = bytearray(self.total_pieces)
+        with self.lock:
+            if not self.active:
+                return bytearray(b"\x01" * self.total_pieces)
+            self.senders[key] = sender
+            self.has[key] = bytearray(self.total_pieces)
+            self.revealed[key] = set()
+            for index in self._offer(key):
+                bitfield[index] = 1
+        return bitfield
+
+    def remove_peer(self, key):
+        """A connection closed; pieces it was given and didn't pass on are offered again."""
+        with self.lock:
+            self.senders.pop(key, None)
+            self.has.pop(key, None)
+            self.revealed.pop(key, None)
+            for index, owner in list(self.offered.items()):
+                if owner == key:
+                    del self.offered[index]
+
+    def is_revealed(self, key, index):
+        """Check whether a piece may be served to a peer."""
+        if not self.active:
+            return True
+        with self.lock:
+            return index in self.revealed.get(key, ())
+
+    def served(self, length):
+        """Count bytes uploaded while super-seeding."""
+        with self.lock:
+            if self.active:
+                self.bytes_served += length
+
+    def record_bitfield(self, key, bitfield):
+        """The peer sent its bitfield."""
+        for index in range(min(len(bitfield), self.total_pieces)):
+            if bitfield[index]:
+                self.record_have(key, index)
+
+    def record_have(self, key, index):
+        """The peer announced a piece; reveal more to whoever passed it on."""
+        reveals = {}
+        with self.lock:
+            has = self.has.get(key)
+            if not self.active or has is None or not 0 <= index < self.total_pieces or has[index]:
+                return
+            has[index] = 1
+            self.seen[index] = 1
+
+            owner = self.offered.get(index)
+            if owner is not None and (owner != key or self._nobody_else_needs(key, index)):
+                # The piece spread, or can't spread any further: next piece for its owner
+                del self.offered[index]
+                reveals[owner] = self._offer(owner)
+
+            finished = all(self.seen)
+            if finished:
+                senders = self._finish()
+        if finished:
+            full = bytearray(b"\x01" * self.total_pieces)
+            for sender in senders:
+                try:
+                    sender.send_bitfield(full)
+                except OSError:
+                    pass
+        else:
+            self._reveal(reveals)
+
+    def _nobody_else_needs(self, key, index):
+        return all(has[index] for other, has in self.has.items() if other != key)
+
+    def _offer(self, key):
+        """Pick pieces for a peer and mark them offered. Caller holds the lock."""
+        has = self.has[key]
+        revealed = self.revealed[key]
+        waiting = sum(1 for owner in self.offered.values() if owner == key)
+        picked = []
+        for _ in range(self.pieces_per_peer - waiting):
+            index = self._pick(has, revealed)
+            if index is None:
+                break
+            self.offered[index] = key
+            revealed.add(index)
+            self.times_offered[index] += 1
+            self.pieces_revealed += 1
+            picked.append(index)
+        return picked
+
+    def _pick(self, has, revealed):
+        """The rarest piece the peer lacks, preferring ones nobody is being offered."""
+        availability = self.availability
+        best = None
+        best_key = None
+        for index in range(self.total_pieces):
+            if has[index] or index in revealed:
+                continue
+            key = (
+                index in self.offered,
+                self.seen[index],
+                availability[index] if availability else 0,
+                self.times_offered[index],
+                index,
+            )
+            if best_key is None or key < best_key:
+                best, best_key = index, key
+        return best
+
+    def _reveal(self, reveals):
+        for key, indexes in reveals.items():
+            sender = self.senders.get(key)
+            if sender is None or not indexes:
+                continue
+            print(f"[DEBUG] SuperSeeder revealing pieces {indexes} to {key}")
+            try:
+                sender.sendall(b"".join(self.message_factory.have(i) for i in indexes))
+            except OSError as e:
+                print(f"[DEBUG] SuperSeeder could not reveal pieces to {key}: {e}")
+
+    def _finish(self):
+        """
+        Every piece is in the swarm: stop hiding pieces. Caller holds the lock.
+
+        Returns:
+            list: Senders of the connections that must get our full bitfield.
+        """
+        print(f"[INFO] Super-seeding done after uploading {self.bytes_served} bytes, seeding normally")
+        self.active = False
+        senders = list(self.senders.values())
+        self.senders.clear()
+        self.offered.clear()
+        return senders
+
+    def get_stats(self):
+        """Get super-seeding metrics."""
+        with self.lock:
+            return {
+                "active": self.active,
+                "peers": len(self.senders),
+                "pieces_revealed": self.pieces_revealed,
+                "bytes_served": self.bytes_served,
+                "pieces_in_swarm": sum(self.seen),
+            }
@@ -0,0 +1,202 @@
+import math
+import socket
+import threading
+import time
+
+from message import MessageFactory
+
+
+class Timer:
+    """A scheduled callback, returned by TimerWheel.schedule()."""
+
+    __slots__ = ("expires", "callback", "args", "cancelled")
+
+    def __init__(self, expires, callback, args):
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Stop the callback from running. Cheap; the wheel drops it lazily."""
+        self.cancelled = True
+
+
+class TimerWheel:
+    def __init__(self, tick=0.1, slots=512):
+        """
+        Hashed timing wheel: many timers, one thread.
+
+        Timers are hashed into `slots` buckets by expiry tick. The wheel thread
+        wakes once per tick and only looks at the bucket of that tick, so
+        scheduling and cancelling are O(1) and thousands of connection timers
+        cost no more than one. Timers further away than one rotation stay in
+        their bucket until their round comes.
+
+        Callbacks run on the wheel thread and must not block.
+
+        Args:
+            tick (float): Resolution in seconds.
+            slots (int): Number of buckets in the wheel.
+        """
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.position = 0  # Last processed tick
+        self.start_time = time.monotonic()
+        self.lock = threading.Lock()
+        self.shutdown_event = threading.Event()
+
+        self.fired = 0
+
+        self.thread = threading.Thread(target=self._run, name="timer-wheel", daemon=True)
+        self.thread.start()
+
+    def schedule(self, delay, callback, *args):
+        """
+        Run callback(*args) after `delay` seconds.
+
+        Returns:
+            Timer: Handle to cancel the callback.
+        """
+        timer = Timer(time.monotonic() + delay, callback, args)
+        # One extra tick so a bucket is never processed before its timers expire
+        ticks = max(1, math.ceil(delay / self.tick)) + 1
+        with self.lock:
+            self.slots[(self.position + ticks) % len(self.slots)].append(timer)
+        return timer
+
+    def _run(self):
+        while not self.shutdown_event.is_set():
+            now = time.monotonic()
+            target = int((now - self.start_time) / self.tick)
+            due = []
+            with self.lock:
+                # Catch up on every tick since the last pass
+                while self.position < target:
+                    self.position += 1
+                    bucket = self.slots[self.position % len(self.slots)]
+                    waiting = []
+                    for timer in bucket:
+                        if timer.cancelled:
+                            continue
+                        if timer.expires <= now:
+                            due.append(timer)
+                        else:
+                            waiting.append(timer)
+                    bucket[:] = waiting
+
+            for timer in due:
+                if timer.cancelled:
+                    continue
+                self.fired += 1
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    print(f"[ERROR] TimerWheel callback {timer.callback} failed: {e}")
+
+            next_tick = self.start_time + (self.position + 1) * self.tick
+            self.shutdown_event.wait(max(0.0, next_tick - time.monotonic()))
+
+    def pending(self):
+        """Get the number of scheduled timers, cancelled ones included."""
+        with self.lock:
+            return sum(len(bucket) for bucket in self.slots)
+
+    def shutdown(self):
+        """Stop the wheel thread; pending timers never fire."""
+        self.shutdown_event.set()
+        self.thread.join()
+
+
+class _Watch:
+    __slots__ = ("sender", "reader", "label", "timer", "active")
+
+    def __init__(self, sender, reader, label):
+        self.sender = sender
+        self.reader = reader
+        self.label = label
+        self.timer = None
+        self.active = True  # False once unwatched or dropped
+
+
+class ConnectionWatchdog:
+    def __init__(self, timer_wheel, keep_alive_interval=60.0, idle_timeout=180.0):
+        """
+        Keeps links alive and drops dead ones, using timers on a shared wheel.
+
+        Each watched connection has one timer that re-arms itself. When it
+        fires, a keep-alive is sent if we have been silent for
+        `keep_alive_interval`, and the connection is shut down if the peer has
+        been silent for `idle_timeout`, which wakes the thread blocked reading it.
+
+        Args:
+            timer_wheel (TimerWheel): Wheel running the checks.
+            keep_alive_interval (float): Seconds of our silence before a keep-alive.
+            idle_timeout (float): Seconds of peer silence before the link is dropped.
+        """
+        self.timer_wheel = timer_wheel
+        self.keep_alive_interval = keep_alive_interval
+        self.idle_timeout = idle_timeout
+        self.keep_alive = MessageFactory.keep_alive()
+
+        self.keep_alives_sent = 0
+        self.idle_dropped = 0
+
+    def watch(self, sender, reader, label):
+        """
+        Start watching a connection.
+
+        Args:
+            sender (MessageSender): Writes of the connection.
+            reader (MessageReader): Reads of the connection.
+            label: Name used in log messages.
+
+        Returns:
+            Handle for unwatch().
+        """
+        watch = _Watch(sender, reader, label)
+        self._arm(watch, min(self.keep_alive_interval, self.idle_timeout))
+        return watch
+
+    def unwatch(self, watch):
+        """Stop watching a connection."""
+        watch.active = False
+        if watch.timer is not None:
+            watch.timer.cancel()
+
+    def _arm(self, watch, delay):
+        watch.timer = self.timer_wheel.schedule(max(delay, self.timer_wheel.tick), self._check, watch)
+
+    def _check(self, watch):
+        if not watch.active:
+            return
+        sender, reader = watch.sender, watch.reader
+        now = time.monotonic()
+
+        silent_for = now - reader.last_received
+        if silent_for >= self.idle_timeout:
+            print(f"[INFO] Dropping idle connection {watch.label} after {silent_for:.0f}s of silence")
+            self.idle_dropped += 1
+            watch.active = False
+            try:
+                # Wakes the thread blocked in recv on this socket
+                sender.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            return
+
+        if now - sender.last_sent >= self.keep_alive_interval:
+            # Skip if a message is being written; the link isn't idle then
+            if sender.try_sendall(self.keep_alive):
+                self.keep_alives_sent += 1
+
+        next_keep_alive = sender.last_sent + self.keep_alive_interval - now
+        next_idle = reader.last_received + self.idle_timeout - now
+        self._arm(watch, min(next_keep_alive, next_idle))
+
+    def get_stats(self):
+        """Get keep-alive and idle-drop counts."""
+        return {
+            "keep_alives_sent": self.keep_alives_sent,
+            "idle_dropped": self.idle_dropped,
+        }
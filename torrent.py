@@ -1,25 +1,90 @@
 from lib import *
+import bencode
+from merkle import BLOCK_SIZE, BlockHashes
+
+
+class PieceHashes:
+    """
+    Indexable table of the 20-byte SHA-1 piece digests of a torrent.
+
+    The table is a window on the raw .torrent bytes, so it is never copied and
+    can be shared by every component that verifies pieces.
+    """
+
+    DIGEST_SIZE = 20
+    __slots__ = ("buffer", "start", "count")
+
+    def __init__(self, buffer, start=0, end=None):
+        """
+        Args:
+            buffer (bytes): Buffer holding the concatenated digests.
+            start (int): Offset of the first digest in the buffer.
+            end (int): Offset just past the last digest, the end of the buffer by default.
+        """
+        end = len(buffer) if end is None else end
+        self.buffer = buffer
+        self.start = start
+        self.count = (end - start) // self.DIGEST_SIZE
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        """Get the digest of a piece as bytes."""
+        if not 0 <= index < self.count:
+            raise IndexError(f"piece index {index} out of range")
+        offset = self.start + index * self.DIGEST_SIZE
+        return self.buffer[offset : offset + self.DIGEST_SIZE]
+
+    def matches(self, index, digest):
+        """Check a digest against the expected one without slicing the table."""
+        return (
+            0 <= index < self.count
+            and len(digest) == self.DIGEST_SIZE
+            and self.buffer.startswith(digest, self.start + index * self.DIGEST_SIZE)
+        )
 
 
 class Torrent:
     def __init__(self):
         self.torrent_file = ""
         self.json_torrent = {}
+        self._info_hash = None
+        self._info = None
         self.tracker_url = ""
         self.name = ""
         self.pieces = []
+        self.piece_hashes = PieceHashes(b"")
+        self.block_hashes = None  # BlockHashes, for torrents with per-block hashes
         self.files = []
         self.piece_length = 0
 
     def load_torrent(self, torrent_file):
-        """Load metadata from the .torrent file."""
+        """
+        Load metadata from the .torrent file.
+
+        The file is read and decoded once; the info_hash is computed from the
+        exact bytes of the encoded info dictionary and cached with the other
+        derived metadata.
+        """
         self.torrent_file = torrent_file
+        self._info_hash = None
+        self._info = None
 
         try:
             with open(torrent_file, "rb") as f:
-                torrent_data = bencodepy.decode(f.read())
+                raw = f.read()
+
+            # Large strings such as "pieces" stay views into `raw`, never copied
+            spans = {}
+            torrent_data = bencode.decode(raw, spans, copy_limit=4096)
 
             self.json_torrent = torrent_data
+            if (b"info",) in spans:
+                start, end = spans[(b"info",)]
+                self._info_hash = hashlib.sha1(memoryview(raw)[start:end]).digest()
+            else:
+                print("[ERROR] Missing 'info' key in torrent data")
             # Attempt to load essential torrent data
             try:
                 self.tracker_url = torrent_data[b"announce"].decode()
@@ -34,10 +99,15 @@ class Torrent:
 
             try:
                 self.pieces = torrent_data[b"info"][b"pieces"]
+                start, end = spans[(b"info", b"pieces")]
+                # The span covers "<length>:<digests>", skip the length prefix
+                self.piece_hashes = PieceHashes(raw, raw.index(b":", start) + 1, end)
             except KeyError as e:
                 print(f"[ERROR] Missing 'pieces' key in torrent data: {e}")
                 self.pieces = 0
 
+            self.block_hashes = self._load_block_hashes(torrent_data)
+
             try:
                 self.name = torrent_data[b"info"][b"name"].decode()
             except KeyError as e:
@@ -62,47 +132,81 @@ class Torrent:
         except Exception as e:
             print(f"[ERROR] An unexpected error occurred: {e}")
 
-    @property
-    def info_hash(self):
-        try:
-            with open(self.torrent_file, "rb") as f:
-                torrent_data = f.read()
+    def _load_block_hashes(self, torrent_data):
+        """
+        Load the optional per-block Merkle hashes.
 
-            start = torrent_data.find(b"4:infod") + len("4:infod") - 1
-            end = -1
-            print(torrent_data)
-            return hashlib.sha1(torrent_data[start:end]).digest()
+        The piece roots are part of the info dictionary; the block digests
+        under the top-level "block hashes" key are only used if they rebuild
+        every root. Otherwise the torrent is verified per piece as usual.
 
-        except FileNotFoundError as e:
-            print(f"[ERROR] The file {self.torrent_file} was not found: {e}")
-            torrent_data = {}
-        except Exception as e:
-            print(f"[ERROR] An unexpected error occurred: {e}")
-
-    @property
-    def info(self):
+        Returns:
+            BlockHashes: The block hash table, or None.
+        """
+        info = torrent_data.get(b"info", {})
+        if b"piece roots" not in info:
+            return None
         try:
-            with open(self.torrent_file, "rb") as f:
-                torrent_data = bencodepy.decode(f.read())
+            if b"files" in info:
+                total_length = sum(file[b"length"] for file in info[b"files"])
+            else:
+                total_length = info[b"length"]
+            block_hashes = BlockHashes(
+                torrent_data[b"block hashes"],
+                info[b"piece roots"],
+                self.piece_length,
+                total_length,
+                info.get(b"block size", BLOCK_SIZE),
+            )
+        except (KeyError, ValueError) as e:
+            print(f"[WARNING] Ignoring block hashes of {self.torrent_file}: {e}")
+            return None
+
+        if block_hashes.total_pieces != len(self.piece_hashes):
+            print(f"[WARNING] Ignoring block hashes of {self.torrent_file}: piece count mismatch")
+            return None
+        bad = block_hashes.verify()
+        if bad:
+            print(
+                f"[WARNING] Ignoring block hashes of {self.torrent_file}: "
+                f"{len(bad)} pieces don't match their root"
+            )
+            return None
+        return block_hashes
 
-            try:
-                info = torrent_data[b"info"]
-            except KeyError as e:
-                print(f"[ERROR] Missing 'info' key in torrent data: {e}")
-                info = {}
-
-            start = 0
-            end = 0
-            for file in info[b"files"]:
-                size = math.ceil(file[b"length"] / self.piece_length)
-                end += size
-                file["pieces_index"] = list(range(start, end))
-                start = end
+    @property
+    def info_hash(self):
+        """SHA-1 of the encoded info dictionary, computed once at load time."""
+        return self._info_hash
 
-            return info
+    @property
+    def info(self):
+        """The info dictionary, with the range of pieces holding each file's data."""
+        if self._info is None:
+            self._info = self._build_info()
+        return self._info
 
-        except FileNotFoundError as e:
-            print(f"[ERROR] The file {self.torrent_file} was not found: {e}")
-            torrent_data = {}
-        except Exception as e:
-            print(f"[ERROR] An unexpected error occurred: {e}")
+    def _build_info(self):
+        try:
+            info = dict(self.json_torrent[b"info"])
+        except KeyError as e:
+            print(f"[ERROR] Missing 'info' key in torrent data: {e}")
+            return {}
+
+        # Files are laid out back to back, so a piece may hold data of several files
+        files = []
+        offset = 0
+        for file in info.get(b"files", []):
+            file = dict(file)
+            length = file[b"length"]
+            if length and self.piece_length:
+                file["pieces_index"] = range(
+                    offset // self.piece_length, (offset + length - 1) // self.piece_length + 1
+                )
+            else:
+                file["pieces_index"] = range(0)
+            offset += length
+            files.append(file)
+        if files:
+            info[b"files"] = files
+        return info
@@ -1,7 +1,8 @@
 import socket
 from bencodepy import encode
 from hashlib import md5, sha1
-from os import path, walk
+from merkle import block_size_for, hash_blocks, merkle_root
+from os import path, stat, walk
 from time import time
 from urllib.parse import urlparse
 
@@ -54,12 +55,17 @@ class makeTorrent:
     def getBencoded(self):
         return encode(self.tdict)
 
-    def multi_file(self, basePath, check_md5=False):
+    def multi_file(self, basePath, check_md5=False, progress=None, block_hashes=False):
         """
         Generate multi-file torrent
           check_md5: adds md5sum to the torrentlist
           basePath: path to folder
+          progress: optional callable(bytes_done, bytes_total), called once per piece
+          block_hashes: also store a Merkle tree of 16 KiB block hashes per piece,
+            so blocks can be verified and re-fetched one by one
         Torrent name will automatically be basePath
+        Files are streamed through one fixed-size piece buffer that carries over
+        file boundaries, so memory use does not depend on the size of the share.
         """
         if 'length' in self.tdict['info']:
             raise TypeError('Cannot add multi-file to single-file torrent')
@@ -68,42 +74,64 @@ class makeTorrent:
         realPath = path.abspath(basePath).replace('\\', '/').replace('\\\\', '/')
         toGet = []
         fileList = []
-        info_pieces = b""
-        data = b""
         for root, subdirs, files in walk(realPath):
             for f in files:
                 subPath = path.relpath(path.join(root, f), start=realPath).replace('\\', '/').replace('\\\\', '/').split('/')
                 subPath = [str(p) for p in subPath]
                 toGet.append(subPath)
-        for pathList in toGet:
-            length = 0
-            filePath = ('/').join(pathList)
+
+        sizes = [stat(path.join(basePath, '/'.join(pathList))).st_size for pathList in toGet]
+        total = sum(sizes)
+        done = 0
+
+        piece_hashes = []
+        block_size = block_size_for(self.piece_length)
+        piece_roots = []
+        leaves = []
+
+        def add_piece(piece):
+            piece_hashes.append(sha1(piece).digest())
+            if block_hashes:
+                piece_leaves = hash_blocks(piece, block_size)
+                piece_roots.append(merkle_root(piece_leaves))
+                leaves.extend(piece_leaves)
+
+        buf = bytearray(self.piece_length)
+        view = memoryview(buf)
+        filled = 0
+        for pathList, size in zip(toGet, sizes):
             if check_md5:
                 md5sum = md5()
             fileDict = {
                 'path': pathList,
-                'length': len(open(path.join(basePath, filePath), "rb").read())
+                'length': size
             }
-            with open(path.join(basePath, filePath), "rb") as fn:
-                while True:
-                    filedata = fn.read(self.piece_length)
-
-                    if len(filedata) == 0:
-                        break
-                    length += len(filedata)
-
-                    data += filedata
-
-                    if len(data) >= self.piece_length:
-                        info_pieces += sha1(data[:self.piece_length]).digest()
-                        data = data[self.piece_length:]
-
+            remaining = size
+            with open(path.join(basePath, '/'.join(pathList)), "rb", buffering=0) as fn:
+                while remaining > 0:
+                    # Fill the rest of the current piece straight from the file
+                    n = fn.readinto(view[filled:filled + min(self.piece_length - filled, remaining)])
+                    if not n:
+                        raise IOError(f'{"/".join(pathList)} shrank while hashing')
                     if check_md5:
-                        md5sum.update(filedata)
-                        fileDict['md5sum'] = md5sum.hexdigest()
+                        md5sum.update(view[filled:filled + n])
+                    filled += n
+                    remaining -= n
+                    done += n
+
+                    if filled == self.piece_length:
+                        add_piece(view)
+                        filled = 0
+                        if progress:
+                            progress(done, total)
+            if check_md5:
+                fileDict['md5sum'] = md5sum.hexdigest()
             fileList.append(fileDict)
-        if len(data) > 0:
-            info_pieces += sha1(data).digest()
+        if filled > 0:
+            add_piece(view[:filled])
+            if progress:
+                progress(done, total)
+        info_pieces = b''.join(piece_hashes)
         self.tdict['info'].update(
             {
                 'name': str(path.basename(realPath)),
@@ -111,6 +139,15 @@ class makeTorrent:
                 'pieces': info_pieces
             }
         )
+        if block_hashes:
+            # Roots are covered by the info hash, the leaves are checked against them
+            self.tdict['info'].update(
+                {
+                    'block size': block_size,
+                    'piece roots': b''.join(piece_roots)
+                }
+            )
+            self.tdict['block hashes'] = b''.join(leaves)
         info_hash = sha1(encode(self.tdict['info'])).hexdigest()
         return {'Created': info_hash}
 
@@ -177,15 +214,16 @@ def get_external_ip():
     except Exception as e:
         return "127.0.0.1"
 
-# Create the torrent
-mk = makeTorrent(announce=f"http://{get_external_ip()}:8000/")
-# name = './TO_BE_SHARED copy 2'
-# name = './TO_BE_SHARED copy'
-#name = './TO_BE_SHARED'
-name = ['./TO_BE_SHARED','./TO_BE_SHARED_copy','./TO_BE_SHARED_copy_2']
-for i in name:
-    mk.multi_file(i)
-
-    # Write the encoded torrent to a file
-    with open(f'./torrents/{i}.torrent', 'wb') as tf:
-        tf.write(mk.getBencoded())
+if __name__ == '__main__':
+    # Create the torrent
+    mk = makeTorrent(announce=f"http://{get_external_ip()}:8000/")
+    # name = './TO_BE_SHARED copy 2'
+    # name = './TO_BE_SHARED copy'
+    #name = './TO_BE_SHARED'
+    name = ['./TO_BE_SHARED','./TO_BE_SHARED_copy','./TO_BE_SHARED_copy_2']
+    for i in name:
+        mk.multi_file(i)
+
+        # Write the encoded torrent to a file
+        with open(f'./torrents/{i}.torrent', 'wb') as tf:
+            tf.write(mk.getBencoded())
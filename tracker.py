@@ -2,17 +2,20 @@ from lib import *
 
 
 class Tracker:
-    def __init__(self, tracker_id: str, ip: str, port: int):
+    def __init__(self, tracker_id: str, ip: str, port: int, interval: int = 120):
         """Initialize the tracker with basic configuration.
 
         Args:
             tracker_id: Unique identifier for this tracker
             ip: IP address to bind to
             port: Port number to listen on
+            interval: Seconds peers wait between announces; peers find each
+                other through peer exchange in between
         """
         self.tracker_id = tracker_id
         self.ip = ip
         self.port = port
+        self.interval = interval
         self.peers: Dict[str, Dict] = {}  # info_hash -> peer_dict
         self.last_cleanup = datetime.now()
 
@@ -153,7 +156,7 @@ class Tracker:
                 peers = self._get_peers(data["info_hash"])
                 print(self.peers)
                 response_data = {
-                    "interval": 5,  # 2 minutes
+                    "interval": self.interval,
                     "min interval": 0,
                     "tracker id": self.tracker_id,
                     "complete": complete,
@@ -1,5 +1,8 @@
 from lib import *
 import socket
+import bencode
+from fileindex import FileOffsetIndex
+from merkle import block_size_for, hash_blocks, merkle_root
 def get_files_in_directory(directory):
     """Recursively gets all files in the directory with improved cross-platform handling."""
     # Use Path for robust cross-platform path handling
@@ -26,43 +29,71 @@ def split_path(path):
     return Path(path).parts
 
 
-def split_file(file_path, piece_size=512 * 1024):
+def choose_piece_size(total_size, max_pieces=2048, min_size=16 * 1024, max_size=16 * 1024 * 1024):
     """
-    Splits the file into pieces and returns a concatenated byte string
-    of the SHA-1 hashes of each piece with improved error handling.
-    """
-    pieces = b""  # Initialize an empty bytes object to store all SHA-1 hashes
-    piece_sizes = []
-    
-    try:
-        file_size = os.path.getsize(file_path)
+    Pick a power-of-two piece size for a torrent of `total_size` bytes.
 
-        with open(file_path, "rb") as f:
-            if file_size <= piece_size:
-                piece = f.read()
-                hash_piece = hashlib.sha1(piece).digest()
-                pieces += hash_piece
-                return pieces
+    Uses the smallest size that keeps the piece count at or below `max_pieces`,
+    so bitfields and piece hash lists stay small for large shares while small
+    shares still get fine-grained pieces.
+    """
+    piece_size = min_size
+    while piece_size < max_size and total_size > piece_size * max_pieces:
+        piece_size *= 2
+    return piece_size
 
-            index = 0
-            while True:
-                piece = f.read(piece_size)
-                if not piece:
-                    break
-                piece_sizes.append(len(piece))
 
-                # Calculate the SHA-1 hash of the piece
-                hash_piece = hashlib.sha1(piece).digest()
+def hash_piece_range(files, piece_size, first_piece, last_piece, block_size=None):
+    """
+    Hash pieces [first_piece, last_piece) of the continuous stream formed by `files`.
 
-                # Concatenate the hash to the pieces byte string
-                pieces += hash_piece
-                index += 1
+    Pieces run across file boundaries, matching the layout PieceManager expects.
 
-        return pieces
+    Args:
+        files (list[dict]): Files in torrent order, each with "path" (full path) and "length".
+        piece_size (int): Piece length in bytes.
+        first_piece (int): First piece index to hash.
+        last_piece (int): Piece index to stop before.
+        block_size (int): If given, also hash every block of this size and
+            build a Merkle root per piece.
 
-    except (IOError, OSError) as e:
-        print(f"[ERROR] Error processing file {file_path}: {e}")
-        return b""
+    Returns:
+        bytes: The concatenated SHA-1 digests of the pieces. With `block_size`,
+        a tuple (piece digests, piece roots, block digests) instead.
+    """
+    index = FileOffsetIndex(files, piece_size)
+    buf = bytearray(piece_size)
+    view = memoryview(buf)
+    digests = []
+    roots = []
+    leaves = []
+    handle_path, handle = None, None
+    try:
+        for piece_index in range(first_piece, last_piece):
+            filled = 0
+            for file_path, offset, length in index.piece_segments(piece_index):
+                if file_path != handle_path:
+                    if handle:
+                        handle.close()
+                    handle_path, handle = file_path, open(file_path, "rb", buffering=0)
+                handle.seek(offset)
+                end = filled + length
+                while filled < end:
+                    n = handle.readinto(view[filled:end])
+                    if not n:
+                        raise IOError(f"{file_path} is shorter than expected")
+                    filled += n
+            digests.append(hashlib.sha1(view[:filled]).digest())
+            if block_size:
+                piece_leaves = hash_blocks(view[:filled], block_size)
+                roots.append(merkle_root(piece_leaves))
+                leaves.extend(piece_leaves)
+    finally:
+        if handle:
+            handle.close()
+    if block_size:
+        return b"".join(digests), b"".join(roots), b"".join(leaves)
+    return b"".join(digests)
 
 
 def generate_torrent(
@@ -70,9 +101,27 @@ def generate_torrent(
     files_directory,
     tracker_url,
     output_name,
-    piece_size=512 * 1024,
+    piece_size=None,
+    workers=None,
+    block_hashes=False,
 ):
-    """Generates a .torrent file for the specified directory with robust cross-platform support."""
+    """
+    Generates a .torrent file for the specified directory with robust cross-platform support.
+
+    The files are hashed as one continuous stream, split into byte ranges of
+    whole pieces that are hashed in parallel. hashlib and file reads release
+    the GIL, so a thread pool keeps several cores busy.
+
+    Args:
+        directory (str): Directory the .torrent file is written to.
+        files_directory (str): Directory to share.
+        tracker_url (str): Announce URL.
+        output_name (str): File name of the .torrent file.
+        piece_size (int): Piece length in bytes, chosen from the total size when omitted.
+        workers (int): Number of hashing threads, the CPU count when omitted.
+        block_hashes (bool): Also store per-piece Merkle trees of block hashes,
+            letting peers verify and re-fetch single blocks.
+    """
     # Use Path for consistent directory handling
     directory = Path(directory)
     files_directory = Path(files_directory)
@@ -82,39 +131,73 @@ def generate_torrent(
     
     file_paths = get_files_in_directory(files_directory)
     
-    pieces = []
     files = []
+    stream = []
 
     # Process each file in the directory
     for relative_path, full_path in file_paths:
         try:
             file_length = os.path.getsize(full_path)
-
-            # Calculate the pieces for the current file
-            hash_piece = split_file(full_path, piece_size)
-            pieces.append(hash_piece)
-            files.append(
-                {
-                    "length": file_length,
-                    "path": relative_path.split('/'),  # Use list of path components
-                }
-            )
-        except Exception as e:
+        except OSError as e:
             print(f"[ERROR] Skipping file {full_path}: {e}")
+            continue
+        files.append(
+            {
+                "length": file_length,
+                "path": relative_path.split('/'),  # Use list of path components
+            }
+        )
+        stream.append({"length": file_length, "path": full_path})
+
+    total_size = sum(file_info["length"] for file_info in files)
+    if piece_size is None:
+        piece_size = choose_piece_size(total_size)
+    total_pieces = math.ceil(total_size / piece_size)
+
+    # Several ranges per worker so a slow range does not leave cores idle
+    workers = workers or os.cpu_count() or 1
+    ranges_count = max(1, min(total_pieces, workers * 4))
+    step = math.ceil(total_pieces / ranges_count) if total_pieces else 1
+    ranges = [(start, min(start + step, total_pieces)) for start in range(0, total_pieces, step)]
+
+    block_size = block_size_for(piece_size) if block_hashes else None
+    try:
+        if workers == 1 or len(ranges) <= 1:
+            pieces = [
+                hash_piece_range(stream, piece_size, start, end, block_size) for start, end in ranges
+            ]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                pieces = list(
+                    executor.map(
+                        lambda r: hash_piece_range(stream, piece_size, r[0], r[1], block_size), ranges
+                    )
+                )
+    except (IOError, OSError) as e:
+        print(f"[ERROR] Failed to hash {files_directory}: {e}")
+        return
+
+    if block_hashes:
+        pieces, roots, leaves = zip(*pieces) if pieces else ((), (), ())
 
     # Create the torrent metadata
     torrent_info = {
         "announce": tracker_url,
         "info": {
-            "piece_length": piece_size,
+            "piece length": piece_size,
             "pieces": b"".join(pieces),
             "name": files_directory.name,  # Consistent and cross-platform
             "files": files,  # Already sorted during processing
         },
     }
+    if block_hashes:
+        # Roots are covered by the info hash, the leaves are checked against them
+        torrent_info["info"]["block size"] = block_size
+        torrent_info["info"]["piece roots"] = b"".join(roots)
+        torrent_info["block hashes"] = b"".join(leaves)
 
     # Encode the metadata using Bencode
-    encoded_torrent = bencodepy.encode(torrent_info)
+    encoded_torrent = bencode.encode(torrent_info)
 
     # Write the .torrent file
     torrent_file_path = directory / output_name